@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare the clobberer by-builder summary query against the query it
+replaced, using a synthetic dataset in an empty database (by default, an
+in-memory SQLite database):
+
+    python misc/clobberer_benchmark.py --builds 100000
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import time
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+import relengapi.app
+from relengapi.blueprints.clobberer import latest
+from relengapi.blueprints.clobberer.models import DB_DECLARATIVE_BASE
+from relengapi.blueprints.clobberer.test_api import grouped_by_builder
+from relengapi.blueprints.clobberer.test_api import populate
+from relengapi.lib import db
+
+# the blueprints can only be imported once relengapi.app has set up Flask
+assert relengapi.app
+
+
+def timed(fn, repeat):
+    """Return the best time, in seconds, of `repeat` calls to `fn`"""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the clobberer by-builder queries on synthetic data')
+    parser.add_argument("--db-url", default='sqlite://',
+                        help="Empty database to fill (default in-memory sqlite)")
+    parser.add_argument("--builds", type=int, default=100000,
+                        help="Number of builds to create")
+    parser.add_argument("--branches", type=int, default=20,
+                        help="Number of branches to spread the builds over")
+    parser.add_argument("--slaves", type=int, default=500,
+                        help="Number of slaves with specific clobbers")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times to run each query")
+    args = parser.parse_args()
+
+    engine = sa.create_engine(args.db_url)
+    db.declarative_base(DB_DECLARATIVE_BASE).metadata.create_all(bind=engine)
+    session = orm.sessionmaker(bind=engine)()
+
+    start = time.time()
+    populate(session, args.builds, args.branches, args.slaves)
+    print "populated {} builds in {:.1f}s".format(
+        args.builds, time.time() - start)
+
+    branch = 'branch-0'
+    for name, query in [('grouped', grouped_by_builder),
+                        ('latest', latest.by_builder)]:
+        elapsed = timed(lambda: query(session, branch).all(), args.repeat)
+        print "{:>8}: {:.3f}s".format(name, elapsed)
+
+if __name__ == '__main__':
+    main()
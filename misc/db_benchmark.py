@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure the cost of getting database sessions from many threads.
+
+Run this in a development environment, with RELENGAPI_SETTINGS pointing to
+the configuration to measure:
+
+    python misc/db_benchmark.py --threads 64
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import threading
+
+import requests
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.serving import make_server
+
+import relengapi.app
+from relengapi.lib.testing.benchmark import in_threads
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def bench_lookups(app, dbname, threads, lookups):
+    """Look up the engine and session for `dbname` `lookups` times in each
+    thread, returning the mean time per lookup, in microseconds"""
+    def fn():
+        for _ in xrange(lookups):
+            app.db.engine(dbname)
+            app.db.session(dbname)
+    elapsed = in_threads(threads, fn)
+    return elapsed * 1e6 / (threads * lookups)
+
+
+def bench_request_cycle(app, dbname, threads, requests_per_thread):
+    """Push and pop a request context, getting a session for `dbname`
+    within it, `requests_per_thread` times in each thread, returning the
+    mean time per request, in microseconds.  This includes the session
+    teardown at the end of each request, but no HTTP handling."""
+    def fn():
+        for _ in xrange(requests_per_thread):
+            with app.test_request_context():
+                app.db.session(dbname)()
+    elapsed = in_threads(threads, fn)
+    return elapsed * 1e6 / (threads * requests_per_thread)
+
+
+def bench_requests(app, dbname, threads, requests_per_thread):
+    """Serve, from a threaded WSGI server, a WSGI application that gets a
+    session for `dbname` in a request context of `app`, and request it
+    `requests_per_thread` times from each thread, returning the number of
+    requests per second.  The app's URL map is not changed."""
+    def wsgi_app(environ, start_response):
+        with app.request_context(environ):
+            app.db.session(dbname)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+    server = make_server('127.0.0.1', 0, wsgi_app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    server_thd = threading.Thread(target=server.serve_forever)
+    server_thd.daemon = True
+    server_thd.start()
+    url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    def fn():
+        session = requests.Session()
+        for _ in xrange(requests_per_thread):
+            session.get(url).raise_for_status()
+    try:
+        elapsed = in_threads(threads, fn)
+    finally:
+        server.shutdown()
+    return threads * requests_per_thread / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the cost of getting database sessions from many threads')
+    parser.add_argument("--dbname", default='relengapi',
+                        help="Database to get sessions for")
+    parser.add_argument("--threads", type=int, default=64,
+                        help="Number of concurrent threads")
+    parser.add_argument("--lookups", type=int, default=10000,
+                        help="Number of direct lookups per thread")
+    parser.add_argument("--requests", type=int, default=50,
+                        help="Number of HTTP requests per thread")
+    args = parser.parse_args()
+
+    # logging every request would swamp the measurement
+    logging.getLogger().addHandler(logging.NullHandler())
+    var_name = 'RELENGAPI_SETTINGS'
+    if var_name in os.environ:
+        os.environ[var_name] = os.path.abspath(os.environ[var_name])
+    app = relengapi.app.create_app(cmdline=True)
+
+    with app.app_context():
+        us = bench_lookups(app, args.dbname, args.threads, args.lookups)
+        print "lookups: {:.2f}us each".format(us)
+        for threads in 1, args.threads:
+            us = bench_request_cycle(app, args.dbname, threads,
+                                     args.lookups / 10)
+            print "request cycle, {} threads: {:.1f}us each".format(threads, us)
+        rate = bench_requests(app, args.dbname, args.threads, args.requests)
+        print "requests: {:.0f}/s".format(rate)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Measure the cost of getting memcached clients from many threads, and show
+the resulting pool statistics.
+
+Run this in a development environment, with RELENGAPI_SETTINGS pointing to
+the configuration to measure:
+
+    python misc/memcached_benchmark.py --cache 127.0.0.1:11211
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import threading
+import time
+
+import relengapi.app
+from relengapi.lib.testing.benchmark import in_threads
+
+
+def bench_uses(app, config, threads, uses, hold):
+    """Check out a memcached client for `config` `uses` times in each
+    thread, holding it for `hold` seconds to stand in for a round-trip to
+    the server.  Returns the number of uses per second and the mean and
+    maximum time to check out a client, in microseconds."""
+    lock = threading.Lock()
+    waits = []
+
+    def fn():
+        thread_waits = []
+        for _ in xrange(uses):
+            start = time.time()
+            with app.memcached.cache(config):
+                thread_waits.append(time.time() - start)
+                time.sleep(hold)
+        with lock:
+            waits.extend(thread_waits)
+    elapsed = in_threads(threads, fn)
+    return (threads * uses / elapsed,
+            sum(waits) * 1e6 / len(waits), max(waits) * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the cost of getting memcached clients from many threads')
+    parser.add_argument("--cache", default='127.0.0.1:11211',
+                        help="Comma-separated memcached servers, or a URL "
+                             "such as elasticache://host:port")
+    parser.add_argument("--threads", type=int, default=64,
+                        help="Number of concurrent threads")
+    parser.add_argument("--uses", type=int, default=200,
+                        help="Number of client checkouts per thread")
+    parser.add_argument("--hold", type=float, default=0.001,
+                        help="Seconds to hold each client")
+    args = parser.parse_args()
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    var_name = 'RELENGAPI_SETTINGS'
+    if var_name in os.environ:
+        os.environ[var_name] = os.path.abspath(os.environ[var_name])
+    app = relengapi.app.create_app(cmdline=True)
+
+    config = args.cache
+    if '://' not in config:
+        config = config.split(',')
+    with app.app_context():
+        for threads in 1, args.threads:
+            rate, mean, worst = bench_uses(app, config, threads, args.uses,
+                                           args.hold)
+            print "{} threads: {:.0f} uses/s, checkout {:.1f}us mean, " \
+                "{:.1f}us max".format(threads, rate, mean, worst)
+        for name, status in sorted(app.memcached.pool_status().iteritems()):
+            print "{}: {}".format(name, ', '.join(
+                '{}={}'.format(k, v) for k, v in sorted(status.iteritems())))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""add composite (tree, when) index to treestatus_log
+
+Revision ID: 6224081d4716
+Revises: 993e4d841aa
+Create Date: 2026-10-19 08:20:11.402518
+
+"""
+from __future__ import absolute_import
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6224081d4716'
+down_revision = '993e4d841aa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_treestatus_log_tree_when', 'treestatus_log',
+                    ['tree', 'when'], unique=False)
+    op.drop_index('ix_treestatus_log_tree', table_name='treestatus_log')
+
+
+def downgrade():
+    op.create_index('ix_treestatus_log_tree', 'treestatus_log',
+                    ['tree'], unique=False)
+    op.drop_index('ix_treestatus_log_tree_when', table_name='treestatus_log')
@@ -0,0 +1,58 @@
+"""add treestatus_log_tags, backfilled from treestatus_log.tags
+
+Revision ID: bfa2862653c8
+Revises: 6224081d4716
+Create Date: 2026-10-19 08:41:37.118204
+
+"""
+from __future__ import absolute_import
+
+import json
+
+import sqlalchemy as sa
+from alembic import context
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'bfa2862653c8'
+down_revision = '6224081d4716'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    log_tags = op.create_table(
+        'treestatus_log_tags',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('log_id', sa.Integer(), nullable=False),
+        sa.Column('tag', sa.String(length=255), nullable=False),
+        sa.ForeignKeyConstraint(['log_id'], ['treestatus_log.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_treestatus_log_tags_log_id', 'treestatus_log_tags',
+                    ['log_id'], unique=False)
+    op.create_index('ix_treestatus_log_tags_tag_log_id', 'treestatus_log_tags',
+                    ['tag', 'log_id'], unique=False)
+
+    # existing rows can't be read when generating SQL offline
+    if context.is_offline_mode():
+        return
+
+    log = sa.table('treestatus_log',
+                   sa.column('id', sa.Integer),
+                   sa.column('tags', sa.Text))
+    conn = op.get_bind()
+    rows = []
+    for log_id, tags in conn.execute(sa.select([log.c.id, log.c.tags])):
+        rows.extend({'log_id': log_id, 'tag': t}
+                    for t in sorted(set(json.loads(tags))))
+    if rows:
+        op.bulk_insert(log_tags, rows)
+
+
+def downgrade():
+    op.drop_index('ix_treestatus_log_tags_tag_log_id',
+                  table_name='treestatus_log_tags')
+    op.drop_index('ix_treestatus_log_tags_log_id',
+                  table_name='treestatus_log_tags')
+    op.drop_table('treestatus_log_tags')
@@ -0,0 +1,75 @@
+"""add treestatus_intervals, backfilled from treestatus_log
+
+Revision ID: df982f0efa1d
+Revises: bfa2862653c8
+Create Date: 2026-10-19 09:02:54.730115
+
+"""
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+from alembic import context
+from alembic import op
+
+from relengapi.lib import db
+
+# revision identifiers, used by Alembic.
+revision = 'df982f0efa1d'
+down_revision = 'bfa2862653c8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    intervals = op.create_table(
+        'treestatus_intervals',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('tree', sa.String(length=32), nullable=False),
+        sa.Column('status', sa.String(length=64), nullable=False),
+        sa.Column('started', db.UTCDateTime(), nullable=False),
+        sa.Column('ended', db.UTCDateTime(), nullable=True),
+        sa.Column('duration', sa.BigInteger(), nullable=True),
+        sa.Column('log_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['log_id'], ['treestatus_log.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_treestatus_intervals_log_id', 'treestatus_intervals',
+                    ['log_id'], unique=False)
+    op.create_index('ix_treestatus_intervals_tree_started',
+                    'treestatus_intervals', ['tree', 'started'], unique=False)
+
+    # existing rows can't be read when generating SQL offline
+    if context.is_offline_mode():
+        return
+
+    # replay the log of status changes for each tree
+    log = sa.table('treestatus_log',
+                   sa.column('id', sa.Integer),
+                   sa.column('tree', sa.String),
+                   sa.column('when', db.UTCDateTime),
+                   sa.column('status', sa.String))
+    q = sa.select([log.c.id, log.c.tree, log.c.when, log.c.status])
+    q = q.where(log.c.status != 'no change')
+    q = q.order_by(log.c.tree, log.c.when, log.c.id)
+    rows = []
+    current = None
+    for log_id, tree, when, status in op.get_bind().execute(q):
+        if current and current['tree'] == tree:
+            if current['status'] == status:
+                continue
+            current['ended'] = when
+            current['duration'] = int(
+                (when - current['started']).total_seconds() * 1000)
+        current = {'tree': tree, 'status': status, 'started': when,
+                   'ended': None, 'duration': None, 'log_id': log_id}
+        rows.append(current)
+    if rows:
+        op.bulk_insert(intervals, rows)
+
+
+def downgrade():
+    op.drop_index('ix_treestatus_intervals_tree_started',
+                  table_name='treestatus_intervals')
+    op.drop_index('ix_treestatus_intervals_log_id',
+                  table_name='treestatus_intervals')
+    op.drop_table('treestatus_intervals')
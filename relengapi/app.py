@@ -26,6 +26,8 @@ from relengapi.lib import layout
 from relengapi.lib import logging as relengapi_logging
 from relengapi.lib import memcached
 from relengapi.lib import monkeypatches
+from relengapi.lib import profiling
+from relengapi.lib.permissions import p
 
 # apply monkey patches
 monkeypatches.monkeypatch()
@@ -67,6 +69,150 @@ class VersionInfo(wsme.types.Base):
     blueprints = {unicode: BlueprintInfo}
 
 
+class DBPoolInfo(wsme.types.Base):
+
+    "Information about a database connection pool"
+
+    #: SQLAlchemy pool class
+    pool_class = unicode
+
+    #: Configured number of connections kept open, if the pool has a fixed size
+    size = int
+
+    #: Number of idle connections in the pool
+    checkedin = int
+
+    #: Number of connections in use
+    checkedout = int
+
+    #: Number of connections beyond ``size`` (negative if not all are open)
+    overflow = int
+
+    #: Number of connections opened
+    connects = int
+
+    #: Number of times a connection was taken from the pool
+    checkouts = int
+
+    #: Number of times a connection was tested before use
+    pings = int
+
+    #: Number of those tests that failed
+    ping_failures = int
+
+
+class EndpointQueryInfo(wsme.types.Base):
+
+    "Information about the database queries made by requests to an endpoint"
+
+    #: Number of requests which made any queries
+    requests = int
+
+    #: Total number of queries
+    queries = int
+
+    #: Total time spent on those queries, in seconds
+    time = float
+
+    #: Largest number of queries made by a single request
+    max_queries = int
+
+    #: Statements (normalized to remove literals and parameters) which a
+    #: single request ran many times, a sign of an N+1 query pattern, with
+    #: the number of requests which did so
+    repeated = {unicode: int}
+
+
+class MemcachedPoolInfo(wsme.types.Base):
+
+    "Information about a pool of memcached clients"
+
+    #: Maximum number of clients
+    size = int
+
+    #: Number of clients in existence
+    open = int
+
+    #: Number of idle clients
+    idle = int
+
+    #: Number of clients in use
+    in_use = int
+
+    #: Number of clients created
+    created = int
+
+    #: Number of times a client was taken from the pool
+    checkouts = int
+
+    #: Number of checkouts which had to wait for a client
+    waits = int
+
+    #: Number of checkouts which gave up waiting
+    timeouts = int
+
+    #: Number of clients closed because they were idle too long
+    discarded = int
+
+
+class AWSPoolInfo(wsme.types.Base):
+
+    "Information about a pool of connections to an AWS service in a region"
+
+    #: Maximum number of connections
+    size = int
+
+    #: Number of connections in existence
+    open = int
+
+    #: Number of idle connections
+    idle = int
+
+    #: Number of connections in use
+    in_use = int
+
+    #: Number of connections created
+    created = int
+
+    #: Number of times a connection was taken from the pool
+    checkouts = int
+
+    #: Number of checkouts which had to wait for a connection
+    waits = int
+
+    #: Number of checkouts which gave up waiting
+    timeouts = int
+
+    #: Number of connections closed because they were too old or had failed
+    discarded = int
+
+
+class CacheInfo(wsme.types.Base):
+
+    "Information about the use of a namespace in memcached"
+
+    #: Number of keys found in the cache
+    hits = int
+
+    #: Number of keys not found
+    misses = int
+
+    #: Number of keys set
+    sets = int
+
+    #: Number of keys deleted
+    deletes = int
+
+    #: Number of values recomputed before they expired
+    refreshes = int
+
+    #: Number of times a missing value was being computed by another caller
+    waits = int
+
+
+p.base.metrics.view.doc("See server metrics, such as database pool statistics")
+
+
 def _load_bp(n):
     relengapi_mod = __import__('relengapi.blueprints.' + n)
     return getattr(relengapi_mod.blueprints, n).bp
@@ -149,6 +295,9 @@ def create_app(cmdline=False, test_config=None):
             request_id=g.request_id,
             user=str(current_user))
 
+    # profiling needs g.request_id, so its hooks must follow setup_request
+    profiling.init_app(app)
+
     @app.route('/')
     def root():
         # render all of the blueprints' templates first
@@ -180,4 +329,39 @@ def create_app(cmdline=False, test_config=None):
                                                 version=relengapi_dist.version)
         return VersionInfo(distributions=dists, blueprints=blueprints)
 
+    @app.route('/metrics/db')
+    @p.base.metrics.view.require()
+    @api.apimethod({unicode: DBPoolInfo})
+    def db_metrics():
+        return {dbname: DBPoolInfo(**info)
+                for dbname, info in app.db.pool_status().iteritems()}
+
+    @app.route('/metrics/queries')
+    @p.base.metrics.view.require()
+    @api.apimethod({unicode: EndpointQueryInfo})
+    def query_metrics():
+        return {endpoint: EndpointQueryInfo(**info)
+                for endpoint, info in app.db.query_status().iteritems()}
+
+    @app.route('/metrics/memcached')
+    @p.base.metrics.view.require()
+    @api.apimethod({unicode: MemcachedPoolInfo})
+    def memcached_metrics():
+        return {name: MemcachedPoolInfo(**info)
+                for name, info in app.memcached.pool_status().iteritems()}
+
+    @app.route('/metrics/aws')
+    @p.base.metrics.view.require()
+    @api.apimethod({unicode: AWSPoolInfo})
+    def aws_metrics():
+        return {name: AWSPoolInfo(**info)
+                for name, info in app.aws.pool_status().iteritems()}
+
+    @app.route('/metrics/caches')
+    @p.base.metrics.view.require()
+    @api.apimethod({unicode: CacheInfo})
+    def cache_metrics():
+        return {namespace: CacheInfo(**info)
+                for namespace, info in memcached.cache_status().iteritems()}
+
     return app
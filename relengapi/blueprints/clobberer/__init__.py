@@ -5,35 +5,40 @@
 from __future__ import absolute_import
 
 import collections
-import re
 import time
+import uuid
 
 import flask_login
 import structlog
-import taskcluster
 from flask import Blueprint
 from flask import current_app
 from flask import g
 from flask import request
 from flask import url_for
 from flask.ext.login import current_user
-from sqlalchemy import and_
-from sqlalchemy import desc
-from sqlalchemy import func
 from sqlalchemy import not_
-from sqlalchemy import or_
 
+from relengapi.blueprints.clobberer import bulk
+from relengapi.blueprints.clobberer import cache
+from relengapi.blueprints.clobberer import heartbeats
+from relengapi.blueprints.clobberer import latest
 from relengapi.blueprints.clobberer import rest
+from relengapi.blueprints.clobberer import tc
+from relengapi.blueprints.clobberer.latest import RebuildLatestClobbersSubcommand
+from relengapi.blueprints.clobberer.models import BUILDDIR_REL_PREFIX
 from relengapi.blueprints.clobberer.models import DB_DECLARATIVE_BASE
 from relengapi.blueprints.clobberer.models import Build
 from relengapi.blueprints.clobberer.models import ClobberTime
 from relengapi.lib import angular
 from relengapi.lib import api
+from relengapi.lib import db
 from relengapi.lib.api import apimethod
 from relengapi.lib.permissions import p
 
 logger = structlog.get_logger()
 
+__all__ = ['RebuildLatestClobbersSubcommand', ]
+
 bp = Blueprint(
     'clobberer',
     __name__,
@@ -45,10 +50,6 @@ p.clobberer.post.clobber.doc('Submit clobber requests')
 
 bp.root_widget_template('clobberer_root_widget.html', priority=100)
 
-# prefix which denotes release builddirs
-BUILDDIR_REL_PREFIX = 'rel-'
-BUILDER_REL_PREFIX = 'release-'
-
 
 @bp.route('/')
 @bp.route('/<string:branch>')
@@ -63,35 +64,16 @@ def root(branch=None):
     )
 
 
-def _add_clobber(session, branch, builddir, slave=None):
-    """
-    A common method for adding clobber times to a session. The session passed
-    in is returned; but is only committed if the commit option is True.
-    """
-    if re.search('^' + BUILDDIR_REL_PREFIX + '.*', builddir) is None:
-        try:
-            who = current_user.authenticated_email
-        except AttributeError:
-            if current_user.anonymous:
-                who = 'anonymous'
-            else:
-                # TokenUser doesn't show up as anonymous; but also has no
-                # authenticated_email
-                who = 'automation'
-
-        clobber_time = ClobberTime.as_unique(
-            session,
-            branch=branch,
-            builddir=builddir,
-            slave=slave,
-        )
-        clobber_time.lastclobber = int(time.time())
-        clobber_time.who = who
-        session.add(clobber_time)
-        return None
-    logger.debug('Rejecting clobber of builddir with release prefix: {}'.format(
-        builddir))
-    return None
+def _who():
+    "Return the identity to record as requesting a clobber."
+    try:
+        return current_user.authenticated_email
+    except AttributeError:
+        if current_user.anonymous:
+            return 'anonymous'
+        # TokenUser doesn't show up as anonymous; but also has no
+        # authenticated_email
+        return 'automation'
 
 
 @bp.route('/clobber', methods=['POST'])
@@ -100,14 +82,10 @@ def _add_clobber(session, branch, builddir, slave=None):
 def clobber(body):
     "Request clobbers for particular branches and builddirs."
     session = g.db.session(DB_DECLARATIVE_BASE)
-    for clobber in body:
-        _add_clobber(
-            session,
-            branch=clobber.branch,
-            builddir=clobber.builddir,
-            slave=clobber.slave
-        )
+    clobbers = [(c.branch, c.builddir, c.slave) for c in body]
+    builddirs = bulk.add_clobbers(session, clobbers, _who(), int(time.time()))
     session.commit()
+    cache.lastclobber_invalidate(builddirs)
     return None
 
 
@@ -119,21 +97,10 @@ def clobber_by_builder(body):
     Request clobbers for app builddirs associated with a particular buildername.
     """
     session = g.db.session(DB_DECLARATIVE_BASE)
-    for clobber in body:
-        builddirs_query = session.query(Build.builddir, Build.branch).filter(
-            Build.buildername == clobber.buildername
-        )
-        if clobber.branch is not None:
-            builddirs_query = builddirs_query.filter(Build.branch == clobber.branch)
-
-        for result in builddirs_query.distinct():
-            _add_clobber(
-                session,
-                builddir=result[0],
-                branch=result[1],
-                slave=clobber.slave
-            )
+    clobbers = bulk.resolve_builders(session, body)
+    builddirs = bulk.add_clobbers(session, clobbers, _who(), int(time.time()))
     session.commit()
+    cache.lastclobber_invalidate(builddirs)
     return None
 
 
@@ -158,44 +125,13 @@ def lastclobber_all():
 
 
 @bp.route('/lastclobber/branch/by-builder/<string:branch>', methods=['GET'])
+@db.replica_reads
 @apimethod({unicode: [rest.ClobberTime]}, unicode)
 def lastclobber_by_builder(branch):
     "Return a dictionary of most recent ClobberTimes grouped by buildername."
     session = g.db.session(DB_DECLARATIVE_BASE)
-
-    # Isolates the maximum lastclobber for each builddir on a branch
-    max_ct_sub_query = session.query(
-        func.max(ClobberTime.lastclobber).label('lastclobber'),
-        ClobberTime.builddir,
-        ClobberTime.branch
-    ).group_by(
-        ClobberTime.builddir,
-        ClobberTime.branch
-    ).filter(ClobberTime.branch == branch).subquery()
-
-    # Finds the "greatest n per group" by joining with the max_ct_sub_query
-    # This is necessary to get the correct "who" values
-    sub_query = session.query(ClobberTime).join(max_ct_sub_query, and_(
-        ClobberTime.builddir == max_ct_sub_query.c.builddir,
-        ClobberTime.lastclobber == max_ct_sub_query.c.lastclobber,
-        ClobberTime.branch == max_ct_sub_query.c.branch)).subquery()
-
-    # Attaches builddirs, along with their max lastclobber to a buildername
-    full_query = session.query(
-        Build.buildername,
-        Build.builddir,
-        sub_query.c.lastclobber,
-        sub_query.c.who
-    ).outerjoin(
-        sub_query,
-        Build.builddir == sub_query.c.builddir,
-    ).filter(
-        Build.branch == branch,
-        not_(Build.buildername.startswith(BUILDER_REL_PREFIX))
-    ).distinct().order_by(Build.buildername)
-
     summary = collections.defaultdict(list)
-    for result in full_query:
+    for result in latest.by_builder(session, branch):
         buildername, builddir, lastclobber, who = result
         summary[buildername].append(
             rest.ClobberTime(
@@ -208,34 +144,45 @@ def lastclobber_by_builder(branch):
     return summary
 
 
+def _clobber_times(branch, builddir):
+    """Get all clobber times for the given builddir, as rest.ClobberTime
+    instances, consulting the cache first."""
+    def load():
+        session = g.db.session(DB_DECLARATIVE_BASE)
+        q = session.query(
+            ClobberTime.slave,
+            ClobberTime.lastclobber,
+            ClobberTime.who
+        ).filter(
+            ClobberTime.builddir == builddir,
+            ClobberTime.branch == branch,
+        )
+        return [tuple(row) for row in q]
+    cached = cache.lastclobber_cache.get_or_set((branch, builddir), load)
+    return [rest.ClobberTime(branch=branch, builddir=builddir, slave=slave,
+                             lastclobber=lastclobber, who=who)
+            for slave, lastclobber, who in cached]
+
+
 @bp.route('/lastclobber', methods=['GET'])
 def lastclobber():
     "Get the max/last clobber time for a particular builddir and branch."
 
-    session = g.db.session(DB_DECLARATIVE_BASE)
     now = int(time.time())
     branch = request.args.get('branch')
     slave = request.args.get('slave')
     builddir = request.args.get('builddir')
     buildername = request.args.get('buildername')
     # TODO: Move the builds update to a separate endpoint (requires client changes)
-    build = Build.as_unique(
-        session,
-        branch=branch,
-        builddir=builddir,
-        buildername=buildername,
-    )
-    # Always force the time to update
-    build.last_build_time = now
-    session.add(build)
-    session.commit()
+    heartbeats.record_heartbeat(branch, builddir, buildername, now)
 
-    max_ct = session.query(ClobberTime).filter(
-        ClobberTime.builddir == builddir,
-        ClobberTime.branch == branch,
+    max_ct = None
+    for ct in _clobber_times(branch, builddir):
         # a NULL slave value signifies all slaves
-        or_(ClobberTime.slave == slave, ClobberTime.slave == None)  # noqa
-    ).order_by(desc(ClobberTime.lastclobber)).first()
+        if ct.slave not in (slave, None):
+            continue
+        if not max_ct or ct.lastclobber > max_ct.lastclobber:
+            max_ct = ct
 
     if max_ct:
         # The client parses this result by colon as:
@@ -258,66 +205,30 @@ def forceclobber():
     return "{}:{}:forceclobber".format(builddir, future_time)
 
 
-def tc_branches():
-    decision_namespace = 'gecko.v2.%s.latest.firefox.decision'
-
-    index = taskcluster.Index()
-    queue = taskcluster.Queue()
-
-    result = index.listNamespaces('gecko.v2', dict(limit=1000))
-
-    branches = {
-        i['name']: dict(name=i['name'], workerTypes=dict())
-        for i in result.get('namespaces', [])
-    }
-
-    for branchName, branch in branches.items():
-
-        # decision task might not exist
-        try:
-            decision_task = index.findTask(decision_namespace % branchName)
-            decision_graph = queue.getLatestArtifact(
-                decision_task['taskId'], 'public/graph.json')
-        except taskcluster.exceptions.TaskclusterRestFailure:
-            continue
-
-        for task in decision_graph.get('tasks', []):
-            task = task['task']
-            task_cache = task.get('payload', dict()).get('cache', dict())
-
-            provisionerId = task.get('provisionerId')
-            if provisionerId:
-                branch['provisionerId'] = provisionerId
-
-            workerType = task.get('workerType')
-            if workerType:
-                branch['workerTypes'].setdefault(
-                    workerType, dict(name=workerType, caches=[]))
-
-                if len(task_cache) > 0:
-                    branch['workerTypes'][workerType]['caches'] = list(set(
-                        branch['workerTypes'][workerType]['caches'] +
-                        task_cache.keys()
-                    ))
-
+def _tc_branch_types(branches):
     caches_to_skip = current_app.config.get('TASKCLUSTER_CACHES_TO_SKIP', [])
 
     return [
         rest.TCBranch(
-            name=branchName,
-            provisionerId=branch.get('provisionerId'),
+            name=branch['name'],
+            provisionerId=branch['provisionerId'],
             workerTypes={
                 workerType: rest.TCWorkerType(
                         name=workerType,
                         caches=[
                             cache
-                            for cache in branch['workerTypes'][workerType]['caches']
+                            for cache in caches
                             if cache not in caches_to_skip
                         ],
                     )
-                for workerType in branch['workerTypes']
+                for workerType, caches in branch['workerTypes'].items()
             })
-        for branchName, branch in branches.items()]
+        for branch in branches]
+
+
+def tc_branches():
+    "Fetch all the gecko branches from Taskcluster, without caching"
+    return _tc_branch_types(tc.fetch_branches())
 
 
 @bp.route('/tc/branches', methods=['GET'])
@@ -325,50 +236,30 @@ def tc_branches():
 def tc_branches_cached():
     """List of all the gecko branches with their worker types
     """
-
-    def cache_key():
-        return time.time() // current_app.config.get(
-            'TASKCLUSTER_CACHE_DURATION', 60 * 5)
-
-    def cache(fun):
-        def wrap(*args, **kwargs):
-            key = cache_key()
-            if getattr(fun, '__cache_key', None) != key:
-                fun.__cache_value = fun(*args, **kwargs)
-                fun.__cache_key = key
-            return getattr(fun, '__cache_value', None)
-        return wrap
-
-    return cache(tc_branches)()
+    return _tc_branch_types(tc.get_branches())
 
 
 @bp.route('/tc/purgecache', methods=['POST'])
-@apimethod(None, body=[rest.TCPurgeCacheRequest])
+@apimethod(rest.TCPurgeCacheJob, body=[rest.TCPurgeCacheRequest])
 @p.clobberer.post.clobber.require()
 def tc_purgecache(body):
-    """Purge cache on taskcluster
+    """Purge cache on taskcluster, several caches at a time, and return the
+    outcome for each cache
     """
-
-    credentials = []
-
-    client_id = current_app.config.get('TASKCLUSTER_CLIENTID')
-    access_token = current_app.config.get('TASKCLUSTER_ACCESSTOKEN')
-
-    if client_id and access_token:
-        credentials = [dict(
-            credentials=dict(
-                clientId=client_id,
-                accessToken=access_token,
-            ))]
-
-    purge_cache = taskcluster.PurgeCache(*credentials)
-
-    for item in body:
-        purge_cache.purgeCache(item.provisionerId,
-                               item.workerType,
-                               dict(cacheName=item.cacheName))
-
-    return None
+    job_id = str(uuid.uuid4())
+    caches = [(item.provisionerId, item.workerType, item.cacheName)
+              for item in body]
+    errors = tc.purge_caches(caches, job_id)
+    return rest.TCPurgeCacheJob(
+        id=job_id,
+        results=[
+            rest.TCPurgeCacheResult(
+                provisionerId=provisionerId,
+                workerType=workerType,
+                cacheName=cacheName,
+                purged=error is None,
+                error=error)
+            for (provisionerId, workerType, cacheName), error in zip(caches, errors)])
 
 
 _ROR = "https://github.com/mozilla/build-relengapi-clobberer"
@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import collections
+
+import sqlalchemy as sa
+import structlog
+from sqlalchemy import and_
+from sqlalchemy import or_
+
+from relengapi.blueprints.clobberer.models import BUILDDIR_REL_PREFIX
+from relengapi.blueprints.clobberer.models import Build
+from relengapi.blueprints.clobberer.models import ClobberTime
+from relengapi.blueprints.clobberer.models import LatestClobber
+
+logger = structlog.get_logger()
+
+# maximum number of rows in a single statement; this keeps the number of
+# bound parameters below SQLite's limit of 999
+BATCH_SIZE = 150
+
+
+def _batches(items):
+    items = list(items)
+    for i in xrange(0, len(items), BATCH_SIZE):
+        yield items[i:i + BATCH_SIZE]
+
+
+def resolve_builders(session, requests):
+    """Find the (branch, builddir, slave) clobbers for each of the given
+    ClobberRequestByBuilder objects, using one query per batch of requests."""
+    builddirs = collections.defaultdict(set)
+    for batch in _batches(requests):
+        conditions = []
+        for req in batch:
+            cond = Build.buildername == req.buildername
+            if req.branch is not None:
+                cond = and_(cond, Build.branch == req.branch)
+            conditions.append(cond)
+        q = session.query(
+            Build.buildername,
+            Build.branch,
+            Build.builddir,
+        ).filter(or_(*conditions)).distinct()
+        for buildername, branch, builddir in q:
+            builddirs[buildername].add((branch, builddir))
+
+    clobbers = set()
+    for req in requests:
+        for branch, builddir in builddirs[req.buildername]:
+            if req.branch is None or branch == req.branch:
+                clobbers.add((branch, builddir, req.slave))
+    return clobbers
+
+
+def _upsert(session, model, keys, wanted, values, update_filter=None, retries=1):
+    """Set `values` on every row of `model` whose `keys` columns match one of
+    the tuples in `wanted`, inserting rows for any that do not exist.  The
+    keys must include `builddir`.  If given, `update_filter` further limits
+    the existing rows that are updated.  If a unique index rejects an insert,
+    because a concurrent transaction inserted the same row, the batch is
+    retried as an update, up to `retries` times."""
+    columns = [getattr(model, k) for k in keys]
+    builddir_idx = keys.index('builddir')
+    existing = set()
+    ids = []
+    for batch in _batches(wanted):
+        # search by builddir, then match the full key here, where None
+        # compares equal to None, unlike NULL in SQL
+        q = session.query(model.id, *columns).filter(
+            model.builddir.in_(set(w[builddir_idx] for w in batch)))
+        for row in q:
+            key = tuple(row[1:])
+            if key in wanted:
+                existing.add(key)
+                ids.append(row[0])
+
+    table = model.__table__
+    for batch in _batches(ids):
+        update = table.update().where(table.c.id.in_(batch))
+        if update_filter is not None:
+            update = update.where(update_filter)
+        session.execute(update.values(values))
+    missing = [w for w in wanted if w not in existing]
+    for batch in _batches(missing):
+        try:
+            # MySQL and SQLite roll back only the failed statement, leaving
+            # the rest of the transaction intact
+            session.execute(table.insert().values(
+                [dict(zip(keys, w), **values) for w in batch]))
+        except sa.exc.IntegrityError:
+            if not retries:
+                raise
+            _upsert(session, model, keys, set(batch), values,
+                    update_filter=update_filter, retries=retries - 1)
+
+
+def add_clobbers(session, clobbers, who, when):
+    """Record the given (branch, builddir, slave) clobbers, along with the
+    latest clobber of each builddir, using a few multi-row statements.
+    Clobbers of release builddirs are ignored.  The session is not
+    committed; the caller must pass the (branch, builddir) pairs returned to
+    `cache.lastclobber_invalidate` once it is, as a cached lookup made
+    before the commit would otherwise be refilled with the old times."""
+    clobbers = set(clobbers)
+    for branch, builddir, slave in list(clobbers):
+        if builddir.startswith(BUILDDIR_REL_PREFIX):
+            logger.debug('Rejecting clobber of builddir with release prefix: {}'.format(
+                builddir))
+            clobbers.remove((branch, builddir, slave))
+    if not clobbers:
+        return set()
+
+    values = dict(lastclobber=when, who=who)
+    _upsert(session, ClobberTime, ('branch', 'builddir', 'slave'), clobbers, values)
+    builddirs = set(c[:2] for c in clobbers)
+    # don't replace a later clobber, in case clocks disagree
+    _upsert(session, LatestClobber, ('branch', 'builddir'), builddirs, values,
+            update_filter=LatestClobber.lastclobber <= when)
+    return builddirs
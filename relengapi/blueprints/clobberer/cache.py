@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+from contextlib import contextmanager
+
+from flask import current_app
+
+from relengapi.lib import memcached
+
+# cached clobber times are invalidated when a clobber is added, but expire
+# anyway in case an invalidation races with a concurrent cache fill
+LASTCLOBBER_TIMEOUT = 300
+
+
+@contextmanager
+def get_mc():
+    cfg = current_app.config.get('CLOBBERER_CACHE')
+    if not cfg:
+        yield None
+    else:
+        with current_app.memcached.cache(cfg) as mc:
+            yield mc
+
+
+def make_key(prefix, *parts):
+    """Make a memcached key from the given parts.  These generally come
+    straight from the client, so they are hashed to get a valid key."""
+    digest = hashlib.sha1(json.dumps(parts)).hexdigest()
+    return 'clobberer:{}:{}'.format(prefix, digest)
+
+
+# clobber times for each (branch, builddir), as lists of (slave,
+# lastclobber, who)
+lastclobber_cache = memcached.Cache('clobberer:lastclobber', 'CLOBBERER_CACHE',
+                                    timeout=LASTCLOBBER_TIMEOUT)
+
+
+def lastclobber_invalidate(builddirs):
+    """Invalidate the cached clobber times for each (branch, builddir) in
+    `builddirs`."""
+    # a clobber for all slaves affects lookups for every slave, so the cache
+    # is keyed by (branch, builddir) and every slave is invalidated at once
+    lastclobber_cache.delete_multi(builddirs)
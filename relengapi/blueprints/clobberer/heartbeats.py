@@ -0,0 +1,108 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import time
+
+import sqlalchemy as sa
+import structlog
+from flask import current_app
+
+from relengapi.blueprints.clobberer import cache
+from relengapi.blueprints.clobberer.models import DB_DECLARATIVE_BASE
+from relengapi.blueprints.clobberer.models import Build
+from relengapi.lib import badpenny
+
+logger = structlog.get_logger()
+
+# Heartbeats are appended to a memcached key for each BUCKET_SECONDS period.
+# Only the current bucket is ever appended to, so the flush task can safely
+# read and delete older buckets.  Buckets not flushed within BUCKET_EXPIRY
+# are lost.
+BUCKET_SECONDS = 60
+BUCKET_EXPIRY = 24 * 3600
+FLUSH_INTERVAL = 300
+
+# ids of known builds are cached for this long; a build deleted in the
+# interim loses its heartbeats until the cached id expires
+BUILD_ID_TIMEOUT = 3600
+
+# maximum number of builds updated by a single statement
+FLUSH_BATCH_SIZE = 1000
+
+
+def _bucket_key(bucket):
+    return 'clobberer:heartbeats:%d' % bucket
+
+
+def record_heartbeat(branch, builddir, buildername, when):
+    """Record that the given build ran at `when`.  If a cache is configured
+    and the build has been seen before, this only buffers the heartbeat for
+    `flush_heartbeats`; otherwise, the build is created or updated
+    immediately."""
+    build_key = cache.make_key('build', branch, builddir, buildername)
+    with cache.get_mc() as mc:
+        build_id = mc.get(build_key) if mc else None
+        if build_id is not None:
+            key = _bucket_key(when // BUCKET_SECONDS)
+            entry = '{} {}\n'.format(build_id, when)
+            # append fails if the key does not exist yet, and add fails if
+            # another process created it in the interim
+            if not mc.append(key, entry):
+                if not mc.add(key, entry, time=BUCKET_EXPIRY):
+                    mc.append(key, entry)
+            return
+
+    session = current_app.db.session(DB_DECLARATIVE_BASE)
+    build = Build.as_unique(
+        session,
+        branch=branch,
+        builddir=builddir,
+        buildername=buildername,
+    )
+    build.last_build_time = when
+    session.add(build)
+    session.commit()
+
+    with cache.get_mc() as mc:
+        if mc:
+            mc.set(build_key, build.id, time=BUILD_ID_TIMEOUT)
+
+
+@badpenny.periodic_task(seconds=FLUSH_INTERVAL)
+def flush_heartbeats(job_status):
+    """Write buffered build heartbeats to the database"""
+    with cache.get_mc() as mc:
+        if not mc:
+            return
+        current = int(time.time()) // BUCKET_SECONDS
+        first = current - BUCKET_EXPIRY // BUCKET_SECONDS
+        buffered = mc.get_multi([_bucket_key(b) for b in xrange(first, current)])
+        if buffered:
+            mc.delete_multi(buffered.keys())
+
+    # only the latest heartbeat for each build matters
+    latest = {}
+    for data in buffered.itervalues():
+        for line in data.splitlines():
+            build_id, when = map(int, line.split())
+            latest[build_id] = max(latest.get(build_id, 0), when)
+    if not latest:
+        return
+
+    # update all of the builds with a single statement per batch
+    session = current_app.db.session(DB_DECLARATIVE_BASE)
+    build_ids = sorted(latest)
+    for i in xrange(0, len(build_ids), FLUSH_BATCH_SIZE):
+        batch = dict((id, latest[id])
+                     for id in build_ids[i:i + FLUSH_BATCH_SIZE])
+        session.query(Build).filter(Build.id.in_(batch)).update(
+            {Build.last_build_time: sa.case(batch, value=Build.id)},
+            synchronize_session=False)
+    session.commit()
+
+    logmsg = "flushed heartbeats for {} builds".format(len(latest))
+    logger.info(logmsg)
+    job_status.log_message(logmsg)
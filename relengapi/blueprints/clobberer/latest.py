@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+from flask import current_app
+from sqlalchemy import and_
+from sqlalchemy import not_
+
+from relengapi.blueprints.clobberer.models import BUILDER_REL_PREFIX
+from relengapi.blueprints.clobberer.models import DB_DECLARATIVE_BASE
+from relengapi.blueprints.clobberer.models import Build
+from relengapi.blueprints.clobberer.models import ClobberTime
+from relengapi.blueprints.clobberer.models import LatestClobber
+from relengapi.lib import subcommands
+
+
+def rebuild(session):
+    """Recalculate the entire latest-clobber table from the clobber_times
+    table, and return the number of rows written."""
+    q = session.query(
+        ClobberTime.branch,
+        ClobberTime.builddir,
+        ClobberTime.lastclobber,
+        ClobberTime.who,
+    ).order_by(
+        ClobberTime.branch,
+        ClobberTime.builddir,
+        ClobberTime.lastclobber,
+        ClobberTime.id,
+    )
+    # later rows for each builddir replace earlier ones
+    rows = {}
+    for branch, builddir, lastclobber, who in q:
+        rows[branch, builddir] = dict(branch=branch, builddir=builddir,
+                                      lastclobber=lastclobber, who=who)
+
+    session.query(LatestClobber).delete()
+    if rows:
+        session.execute(LatestClobber.__table__.insert(), rows.values())
+    session.commit()
+    return len(rows)
+
+
+def by_builder(session, branch):
+    """Query (buildername, builddir, lastclobber, who) for every non-release
+    builder on the given branch, ordered by buildername.  As with the
+    grouped query this replaces, only clobbers on the same branch count, even
+    if other branches share the builddir."""
+    return session.query(
+        Build.buildername,
+        Build.builddir,
+        LatestClobber.lastclobber,
+        LatestClobber.who
+    ).outerjoin(
+        LatestClobber,
+        and_(LatestClobber.branch == Build.branch,
+             LatestClobber.builddir == Build.builddir),
+    ).filter(
+        Build.branch == branch,
+        not_(Build.buildername.startswith(BUILDER_REL_PREFIX))
+    ).distinct().order_by(Build.buildername)
+
+
+class RebuildLatestClobbersSubcommand(subcommands.Subcommand):
+
+    def make_parser(self, subparsers):
+        parser = subparsers.add_parser(
+            'clobberer-rebuild-latest',
+            help='recalculate the latest clobber for every builddir; run this '
+                 'after creating the clobber_latest table')
+        return parser
+
+    def run(self, parser, args):
+        session = current_app.db.session(DB_DECLARATIVE_BASE)
+        count = rebuild(session)
+        print "wrote latest clobbers for {} builddirs".format(count)
@@ -12,6 +12,10 @@ from relengapi.lib import db
 
 DB_DECLARATIVE_BASE = 'clobberer'
 
+# prefix which denotes release builddirs
+BUILDDIR_REL_PREFIX = 'rel-'
+BUILDER_REL_PREFIX = 'release-'
+
 
 class ClobbererBase(db.declarative_base(DB_DECLARATIVE_BASE)):
     __abstract__ = True
@@ -74,3 +78,16 @@ class ClobberTime(ClobbererBase, db.UniqueMixin):
             cls.slave == slave,
             cls.builddir == builddir,
         )
+
+
+class LatestClobber(ClobbererBase):
+    """The most recent clobber of a builddir on any slave, maintained along
+    with ClobberTime so that summaries do not need to search for it."""
+
+    __tablename__ = 'clobber_latest'
+    __table_args__ = (
+        sa.Index('ix_clobber_latest_branch_builddir', 'branch', 'builddir',
+                 unique=True),
+    )
+    lastclobber = sa.Column(sa.Integer, nullable=False)
+    who = sa.Column(sa.String(50))
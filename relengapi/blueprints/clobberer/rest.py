@@ -65,3 +65,25 @@ class TCPurgeCacheRequest(wsme.types.Base):
     provisionerId = wsme.types.wsattr(unicode, mandatory=False, default=None)
     workerType = wsme.types.wsattr(unicode, mandatory=False, default=None)
     cacheName = wsme.types.wsattr(unicode, mandatory=False, default=None)
+
+
+class TCPurgeCacheResult(wsme.types.Base):
+    """The outcome of purging a single cache on taskcluster
+    """
+
+    provisionerId = wsme.types.wsattr(unicode, mandatory=False, default=None)
+    workerType = wsme.types.wsattr(unicode, mandatory=False, default=None)
+    cacheName = wsme.types.wsattr(unicode, mandatory=False, default=None)
+    #: True if the cache was purged
+    purged = wsme.types.wsattr(bool, mandatory=True)
+    #: The error from taskcluster, if the purge failed
+    error = wsme.types.wsattr(unicode, mandatory=False, default=None)
+
+
+class TCPurgeCacheJob(wsme.types.Base):
+    """The outcome of a request to purge caches on taskcluster
+    """
+
+    #: An identifier for this request, included in the logs of each purge
+    id = wsme.types.wsattr(unicode, mandatory=True)
+    results = wsme.types.wsattr([TCPurgeCacheResult], mandatory=True)
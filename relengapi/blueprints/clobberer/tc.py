@@ -0,0 +1,163 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import json
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import memcache
+import structlog
+import taskcluster
+from flask import current_app
+
+from relengapi.blueprints.clobberer import cache
+from relengapi.lib import badpenny
+
+logger = structlog.get_logger()
+
+DECISION_NAMESPACE = 'gecko.v2.%s.latest.firefox.decision'
+
+# number of branches whose decision graphs are fetched concurrently
+FETCH_THREADS = 16
+
+# number of caches purged concurrently
+PURGE_THREADS = 8
+
+# with a cache configured, the branches are refreshed this often and served
+# from the cache in the interim, no matter how old
+REFRESH_INTERVAL = 300
+BRANCHES_KEY = 'clobberer:tc-branches:zlib'
+
+# without a cache, or while it is cold, each process keeps its own copy for
+# TASKCLUSTER_CACHE_DURATION seconds
+_local_cache = {}
+
+
+def _map_concurrently(fn, items, threads):
+    if not items:
+        return []
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(fn, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _fetch_branch(name):
+    """Get the provisionerId and the caches used by each worker type for a
+    branch, from its latest decision graph.  A branch with no decision graph
+    has no provisionerId and no worker types."""
+    branch = dict(name=name, provisionerId=None, workerTypes={})
+    # decision task might not exist
+    try:
+        decision_task = taskcluster.Index().findTask(DECISION_NAMESPACE % name)
+        decision_graph = taskcluster.Queue().getLatestArtifact(
+            decision_task['taskId'], 'public/graph.json')
+    except taskcluster.exceptions.TaskclusterRestFailure:
+        return branch
+
+    for task in decision_graph.get('tasks', []):
+        task = task['task']
+        task_cache = task.get('payload', dict()).get('cache', dict())
+
+        provisionerId = task.get('provisionerId')
+        if provisionerId:
+            branch['provisionerId'] = provisionerId
+
+        workerType = task.get('workerType')
+        if workerType:
+            caches = branch['workerTypes'].setdefault(workerType, [])
+            caches.extend(c for c in task_cache if c not in caches)
+    return branch
+
+
+def fetch_branches():
+    """Crawl the gecko.v2 index for branches, fetching their decision graphs
+    concurrently.  The result is a list of dictionaries with keys `name`,
+    `provisionerId`, and `workerTypes` (mapping each worker type to a list of
+    cache names)."""
+    result = taskcluster.Index().listNamespaces('gecko.v2', dict(limit=1000))
+    names = [ns['name'] for ns in result.get('namespaces', [])]
+    return _map_concurrently(_fetch_branch, names, FETCH_THREADS)
+
+
+def get_branches():
+    """Get the branches as returned by `fetch_branches`, from the cache if
+    one is configured and from a per-process copy otherwise."""
+    with cache.get_mc() as mc:
+        if mc:
+            data = mc.get(BRANCHES_KEY)
+            if data is not None:
+                return json.loads(zlib.decompress(data))['branches']
+
+    key = time.time() // current_app.config.get(
+        'TASKCLUSTER_CACHE_DURATION', 60 * 5)
+    if _local_cache.get('key') != key:
+        if mc:
+            # the cache is cold, because the refresher has not run yet, the
+            # value was evicted, or it could not be stored
+            logger.warning("Taskcluster branches are not cached; fetching them")
+            _local_cache['branches'] = refresh_branches()
+        else:
+            _local_cache['branches'] = fetch_branches()
+        _local_cache['key'] = key
+    return _local_cache['branches']
+
+
+def refresh_branches():
+    """Fetch the branches and store them in the cache"""
+    branches = fetch_branches()
+    data = zlib.compress(json.dumps(dict(fetched=time.time(), branches=branches)))
+    # memcached silently refuses values larger than this
+    if len(data) > memcache.SERVER_MAX_VALUE_LENGTH:
+        logger.error("Taskcluster branches are too large to cache ({} bytes)".format(
+            len(data)))
+        return branches
+    with cache.get_mc() as mc:
+        if mc:
+            mc.set(BRANCHES_KEY, data)
+    return branches
+
+
+def purge_caches(caches, job_id):
+    """Purge each of the given (provisionerId, workerType, cacheName) caches,
+    several at a time.  Return a list giving the error message for each
+    cache, or None if it was purged."""
+    credentials = []
+    client_id = current_app.config.get('TASKCLUSTER_CLIENTID')
+    access_token = current_app.config.get('TASKCLUSTER_ACCESSTOKEN')
+    if client_id and access_token:
+        credentials = [dict(
+            credentials=dict(
+                clientId=client_id,
+                accessToken=access_token,
+            ))]
+
+    def purge(item):
+        provisionerId, workerType, cacheName = item
+        try:
+            taskcluster.PurgeCache(*credentials).purgeCache(
+                provisionerId, workerType, dict(cacheName=cacheName))
+        except taskcluster.exceptions.TaskclusterFailure as e:
+            logger.warning("purging cache {} on {}/{} failed: {}".format(
+                cacheName, provisionerId, workerType, e), purge_job=job_id)
+            return str(e)
+        logger.info("purged cache {} on {}/{}".format(
+            cacheName, provisionerId, workerType), purge_job=job_id)
+        return None
+
+    return _map_concurrently(purge, caches, PURGE_THREADS)
+
+
+@badpenny.periodic_task(seconds=REFRESH_INTERVAL)
+def refresh_branches_task(job_status):
+    """Refresh the cached Taskcluster branches"""
+    if not current_app.config.get('CLOBBERER_CACHE'):
+        return
+    branches = refresh_branches()
+    job_status.log_message("fetched {} Taskcluster branches".format(len(branches)))
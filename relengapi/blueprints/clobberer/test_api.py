@@ -5,23 +5,34 @@
 from __future__ import absolute_import
 
 import json
+import random
 import time
 from copy import deepcopy
 
+import sqlalchemy as sa
+import taskcluster
+from mock import Mock
 from mock import patch
 from nose.tools import assert_greater
 from nose.tools import eq_
-
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import not_
+
+from relengapi.blueprints.clobberer import bulk
+from relengapi.blueprints.clobberer import heartbeats
+from relengapi.blueprints.clobberer import latest
+from relengapi.blueprints.clobberer import tc
+from relengapi.blueprints.clobberer.models import BUILDDIR_REL_PREFIX
+from relengapi.blueprints.clobberer.models import BUILDER_REL_PREFIX
 from relengapi.blueprints.clobberer.models import DB_DECLARATIVE_BASE
 from relengapi.blueprints.clobberer.models import Build
 from relengapi.blueprints.clobberer.models import ClobberTime
+from relengapi.blueprints.clobberer.models import LatestClobber
 from relengapi.lib import auth
 from relengapi.lib.permissions import p
 from relengapi.lib.testing.context import TestContext
 
-from . import BUILDDIR_REL_PREFIX
-from . import BUILDER_REL_PREFIX
-
 _clobber_args = {
     'branch': 'branch',
     'builddir': 'builddir',
@@ -316,7 +327,7 @@ def test_clobber_tc_purgecache_no_call(client):
         rv = client.post_json('/clobberer/tc/purgecache', data=[])
 
         eq_(rv.status_code, 200)
-        eq_(json.loads(rv.data)["result"], None)
+        eq_(json.loads(rv.data)["result"]["results"], [])
 
         eq_(p.called, False)
 
@@ -330,7 +341,8 @@ def test_clobber_tc_purgecache_wrong_args(client):
             data=[dict(wrong="something")])
 
         eq_(rv.status_code, 200)
-        eq_(json.loads(rv.data)["result"], None)
+        eq_(json.loads(rv.data)["result"]["results"], [dict(
+            cacheName=None, provisionerId=None, workerType=None, purged=True, error=None)])
 
         eq_(p.called, True)
         eq_(str(p.call_args), "call(None, None, {'cacheName': None})")
@@ -349,21 +361,50 @@ def test_clobber_tc_purgecache_works(client):
             )])
 
         eq_(rv.status_code, 200)
-        eq_(json.loads(rv.data)["result"], None)
+        eq_(json.loads(rv.data)["result"]["results"], [dict(
+            cacheName="1", provisionerId="2", workerType="3", purged=True, error=None)])
 
         eq_(p.called, True)
         eq_(str(p.call_args), "call(u'2', u'3', {'cacheName': u'1'})")
 
 
 @test_context
-def test_clobber_tc_branches_caching(client):
+def test_clobber_tc_purgecache_outcomes(client):
+    """Each cache is purged, and its outcome reported, independently"""
+    def purgeCache(provisionerId, workerType, payload):
+        if payload['cacheName'] == 'bad':
+            raise taskcluster.exceptions.TaskclusterRestFailure('nope', None)
+
+    with patch('taskcluster.PurgeCache.purgeCache', side_effect=purgeCache) as p:
+        caches = ['c%d' % i for i in range(20)]
+        caches.insert(5, 'bad')
+        rv = client.post_json(
+            '/clobberer/tc/purgecache',
+            data=[dict(cacheName=c, provisionerId="p", workerType="w") for c in caches])
+
+        eq_(rv.status_code, 200)
+        job = json.loads(rv.data)["result"]
+        assert job['id']
+        eq_([(r['cacheName'], r['purged'], r['error']) for r in job['results']],
+            [(c, c != 'bad', 'nope' if c == 'bad' else None) for c in caches])
+        eq_(p.call_count, len(caches))
 
-    with patch('relengapi.blueprints.clobberer.tc_branches',
-               return_value=[]) as p:
+
+_tc_branch = dict(name='branch1', provisionerId='prov1',
+                  workerTypes={'wt1': ['cache1', 'cache2']})
+
+
+@test_context
+def test_clobber_tc_branches_caching(client):
+    tc._local_cache.clear()
+    with patch('relengapi.blueprints.clobberer.tc.fetch_branches',
+               return_value=[_tc_branch]) as p:
         rv = client.get('/clobberer/tc/branches')
 
         eq_(rv.status_code, 200)
-        eq_(json.loads(rv.data)["result"], [])
+        eq_(json.loads(rv.data)["result"], [dict(
+            name='branch1', provisionerId='prov1',
+            workerTypes={'wt1': dict(name='wt1', caches=['cache1', 'cache2'])})])
 
         eq_(p.called, True)
         eq_(p.call_count, 1)
@@ -371,9 +412,6 @@ def test_clobber_tc_branches_caching(client):
         rv = client.get('/clobberer/tc/branches')
 
         eq_(rv.status_code, 200)
-        eq_(json.loads(rv.data)["result"], [])
-
-        eq_(p.called, True)
         eq_(p.call_count, 1)
 
 
@@ -415,3 +453,364 @@ def test_clobber_tc_branches():
                 eq_(getLatestArtifact.call_count, 1)
                 eq_(str(getLatestArtifact.call_args),
                     "call('task1', 'public/graph.json')")
+
+
+def test_clobber_tc_branches_no_decision_task():
+    """A branch with no decision task is still listed, with no worker types"""
+
+    from relengapi.blueprints.clobberer import tc_branches
+
+    with patch('taskcluster.Index.listNamespaces',
+               return_value=dict(namespaces=[dict(name="branch1")])), \
+            patch('taskcluster.Index.findTask',
+                  side_effect=taskcluster.exceptions.TaskclusterRestFailure(
+                      'nope', None)):
+        result = tc_branches()
+
+    eq_(len(result), 1)
+    eq_(result[0].name, 'branch1')
+    eq_(result[0].provisionerId, None)
+    eq_(result[0].workerTypes, {})
+
+
+cached_test_context = TestContext(databases=[DB_DECLARATIVE_BASE],
+                                  user=auth_user,
+                                  config={'CLOBBERER_CACHE': 'mock://clobberer'})
+
+
+def _get_lastclobber(client, **args):
+    rv = client.get(
+        '/clobberer/lastclobber?branch={branch}&builddir={builddir}&'
+        'buildername={buildername}&slave={slave}'.format(**args))
+    eq_(rv.status_code, 200)
+    return rv.data
+
+
+@cached_test_context
+def test_lastclobber_cached(app, client):
+    """With a cache configured, clobber times are served from the cache
+    until a new clobber for the builddir invalidates it"""
+    args = dict(_last_clobber_args, slave='slave1')
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.add(ClobberTime(branch='branch', builddir='builddir', slave=None,
+                            lastclobber=10, who='someone'))
+    session.commit()
+    eq_(_get_lastclobber(client, **args), 'builddir:10:someone\n')
+
+    # changes made behind the cache's back are not seen..
+    session.query(ClobberTime).update({ClobberTime.lastclobber: 20})
+    session.commit()
+    eq_(_get_lastclobber(client, **args), 'builddir:10:someone\n')
+
+    # ..but a clobber of the builddir, for any slave, is
+    rv = client.post_json('/clobberer/clobber', data=[
+        {'branch': 'branch', 'builddir': 'builddir', 'slave': 'slave2'}])
+    eq_(rv.status_code, 200)
+    eq_(_get_lastclobber(client, **args), 'builddir:20:someone\n')
+
+
+@cached_test_context
+def test_clobber_invalidates_after_commit(app, client):
+    """Cached clobber times are invalidated only once the clobber is
+    committed, so a concurrent lookup cannot cache the old times again"""
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    events = Mock()
+    with patch.object(session, 'commit', wraps=session.commit) as commit, \
+            patch('relengapi.blueprints.clobberer.cache.lastclobber_invalidate') \
+            as invalidate:
+        events.attach_mock(commit, 'commit')
+        events.attach_mock(invalidate, 'invalidate')
+        rv = client.post_json('/clobberer/clobber', data=[
+            {'branch': 'branch', 'builddir': 'builddir', 'slave': 'slave2'}])
+    eq_(rv.status_code, 200)
+    eq_([name for name, _, _ in events.mock_calls], ['commit', 'invalidate'])
+    invalidate.assert_called_once_with(set([('branch', 'builddir')]))
+
+
+@cached_test_context
+def test_lastclobber_heartbeats_buffered(app, client):
+    """With a cache configured, lastclobber creates builds the first time
+    they are seen, but then buffers build heartbeats until the
+    flush_heartbeats task writes them to the database"""
+    session = app.db.session(DB_DECLARATIVE_BASE)
+
+    def builds():
+        return sorted((b.buildername, b.last_build_time)
+                      for b in session.query(Build))
+
+    with patch('time.time', return_value=1000):
+        _get_lastclobber(client, slave='s', **_last_clobber_args)
+    with patch('time.time', return_value=1030):
+        _get_lastclobber(client, slave='s', **_last_clobber_args)
+    with patch('time.time', return_value=1050):
+        _get_lastclobber(client, **_last_clobber_args_with_slave)
+    with patch('time.time', return_value=1090):
+        _get_lastclobber(client, **_last_clobber_args_with_slave)
+    eq_(builds(), [('buildername', 1000), ('other_buildername', 1050)])
+
+    with app.app_context():
+        # only heartbeats from completed buckets are flushed
+        with patch('time.time', return_value=1090):
+            heartbeats.flush_heartbeats(Mock())
+        eq_(builds(), [('buildername', 1030), ('other_buildername', 1050)])
+
+        with patch('time.time', return_value=1200):
+            heartbeats.flush_heartbeats(Mock())
+        eq_(builds(), [('buildername', 1030), ('other_buildername', 1090)])
+
+        # nothing left to flush
+        job_status = Mock()
+        heartbeats.flush_heartbeats(job_status)
+        eq_(job_status.log_message.called, False)
+
+
+@cached_test_context
+def test_clobber_tc_branches_shared_cache(app, client):
+    """With a cache configured, branches are fetched when the cache is cold,
+    and then only by the refresh task"""
+    def get_branches():
+        rv = client.get('/clobberer/tc/branches')
+        eq_(rv.status_code, 200)
+        return [b['name'] for b in json.loads(rv.data)['result']]
+
+    tc._local_cache.clear()
+    with patch('relengapi.blueprints.clobberer.tc.fetch_branches',
+               return_value=[_tc_branch]) as fetch:
+        eq_(get_branches(), ['branch1'])
+        eq_(get_branches(), ['branch1'])
+        eq_(fetch.call_count, 1)
+
+    branch2 = dict(_tc_branch, name='branch2')
+    with patch('relengapi.blueprints.clobberer.tc.fetch_branches',
+               return_value=[branch2]) as fetch:
+        eq_(get_branches(), ['branch1'])
+        eq_(fetch.call_count, 0)
+
+        with app.app_context():
+            tc.refresh_branches_task(Mock())
+        eq_(fetch.call_count, 1)
+        eq_(get_branches(), ['branch2'])
+
+
+@cached_test_context
+def test_clobber_tc_branches_too_large(app, client):
+    """Branches too large to cache are kept in each process instead"""
+    tc._local_cache.clear()
+    with patch('relengapi.blueprints.clobberer.tc.fetch_branches',
+               return_value=[_tc_branch]) as fetch, \
+            patch('memcache.SERVER_MAX_VALUE_LENGTH', 10):
+        for _ in range(2):
+            rv = client.get('/clobberer/tc/branches')
+            eq_(rv.status_code, 200)
+            eq_([b['name'] for b in json.loads(rv.data)['result']], ['branch1'])
+        eq_(fetch.call_count, 1)
+
+
+latest_test_context = TestContext(databases=[DB_DECLARATIVE_BASE], user=auth_user)
+
+
+@latest_test_context
+def test_lastclobber_by_builder_latest(app, client):
+    """The by-builder view shows the latest clobber of each builddir, on any
+    slave"""
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.add(Build(branch='latest', builddir='ld', buildername='lb'))
+    session.commit()
+    with patch('time.time', return_value=1000):
+        client.post_json('/clobberer/clobber',
+                         data=[dict(branch='latest', builddir='ld', slave='s1')])
+    with patch('time.time', return_value=2000):
+        client.post_json('/clobberer/clobber',
+                         data=[dict(branch='latest', builddir='ld')])
+    with patch('time.time', return_value=1500):
+        client.post_json('/clobberer/clobber',
+                         data=[dict(branch='latest', builddir='ld', slave='s2')])
+
+    latest_clobbers = session.query(LatestClobber).filter_by(branch='latest')
+    eq_([(l.builddir, l.lastclobber) for l in latest_clobbers], [('ld', 2000)])
+
+    rv = client.get('/clobberer/lastclobber/branch/by-builder/latest')
+    clobbertimes = json.loads(rv.data)["result"]
+    eq_([(ct['builddir'], ct['lastclobber']) for ct in clobbertimes['lb']],
+        [('ld', 2000)])
+
+
+@latest_test_context
+def test_lastclobber_by_builder_same_branch(app, client):
+    """The by-builder view only counts clobbers on the same branch, even if
+    another branch uses the same builddir"""
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.add(Build(branch='b1', builddir='shared', buildername='n'))
+    session.add(Build(branch='b2', builddir='shared', buildername='n'))
+    session.commit()
+    with patch('time.time', return_value=1000):
+        client.post_json('/clobberer/clobber',
+                         data=[dict(branch='b2', builddir='shared')])
+
+    rv = client.get('/clobberer/lastclobber/branch/by-builder/b1')
+    eq_([(ct['builddir'], ct['lastclobber'])
+         for ct in json.loads(rv.data)["result"]['n']], [('shared', None)])
+    rv = client.get('/clobberer/lastclobber/branch/by-builder/b2')
+    eq_([(ct['builddir'], ct['lastclobber'])
+         for ct in json.loads(rv.data)["result"]['n']], [('shared', 1000)])
+
+
+@latest_test_context
+def test_rebuild_latest_empty(app):
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    eq_(latest.rebuild(session), 0)
+    eq_(session.query(LatestClobber).count(), 0)
+
+
+@latest_test_context
+def test_rebuild_latest(app):
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.add(ClobberTime(branch='b', builddir='d', slave=None,
+                            lastclobber=10, who='x'))
+    session.add(ClobberTime(branch='b', builddir='d', slave='s',
+                            lastclobber=20, who='y'))
+    session.add(ClobberTime(branch='b', builddir='e', slave=None,
+                            lastclobber=30, who='z'))
+    session.commit()
+    eq_(latest.rebuild(session), 2)
+    eq_(sorted((l.builddir, l.lastclobber, l.who)
+               for l in session.query(LatestClobber)),
+        [('d', 20, 'y'), ('e', 30, 'z')])
+
+
+def grouped_by_builder(session, branch):
+    """The by-builder query used before the latest-clobber table existed,
+    which finds the latest clobber of each builddir on the fly."""
+    # Isolates the maximum lastclobber for each builddir on a branch
+    max_ct_sub_query = session.query(
+        func.max(ClobberTime.lastclobber).label('lastclobber'),
+        ClobberTime.builddir,
+        ClobberTime.branch
+    ).group_by(
+        ClobberTime.builddir,
+        ClobberTime.branch
+    ).filter(ClobberTime.branch == branch).subquery()
+
+    # Finds the "greatest n per group" by joining with the max_ct_sub_query
+    sub_query = session.query(ClobberTime).join(max_ct_sub_query, and_(
+        ClobberTime.builddir == max_ct_sub_query.c.builddir,
+        ClobberTime.lastclobber == max_ct_sub_query.c.lastclobber,
+        ClobberTime.branch == max_ct_sub_query.c.branch)).subquery()
+
+    return session.query(
+        Build.buildername,
+        Build.builddir,
+        sub_query.c.lastclobber,
+        sub_query.c.who
+    ).outerjoin(
+        sub_query,
+        Build.builddir == sub_query.c.builddir,
+    ).filter(
+        Build.branch == branch,
+        not_(Build.buildername.startswith(BUILDER_REL_PREFIX))
+    ).distinct().order_by(Build.buildername)
+
+
+def populate(session, builds, branches, slaves, seed=0):
+    """Fill an empty database with `builds` builds spread over `branches`
+    branches, and clobber each builddir for all slaves and for a few
+    specific slaves."""
+    rnd = random.Random(seed)
+    now = int(time.time())
+    build_rows = []
+    clobber_rows = []
+    for i in xrange(builds):
+        branch = 'branch-%d' % (i % branches)
+        builddir = 'builddir-%d' % i
+        build_rows.append(dict(branch=branch, builddir=builddir,
+                               buildername='builder-%d' % i,
+                               last_build_time=now))
+        for slave in [None] + rnd.sample(xrange(slaves), 2):
+            clobber_rows.append(dict(
+                branch=branch, builddir=builddir,
+                slave=None if slave is None else 'slave-%d' % slave,
+                lastclobber=now - rnd.randint(0, 86400 * 30),
+                who='user-%d' % rnd.randint(0, 50)))
+    session.execute(Build.__table__.insert(), build_rows)
+    session.execute(ClobberTime.__table__.insert(), clobber_rows)
+    session.commit()
+    latest.rebuild(session)
+
+
+@latest_test_context
+def test_by_builder_agrees_with_grouped(app):
+    """The by-builder query using the latest-clobber table gives the same
+    results as the query it replaced"""
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    populate(session, builds=50, branches=2, slaves=10)
+    for branch in 'branch-0', 'branch-1':
+        eq_(latest.by_builder(session, branch).all(),
+            grouped_by_builder(session, branch).all())
+
+
+@latest_test_context
+def test_clobber_by_builder_bulk(app, client):
+    """Clobbering several builders at once creates each clobber time once,
+    and updates them in place when repeated"""
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    for branch, builddir, buildername in [
+            ('b1', 'd1', 'n1'), ('b1', 'd2', 'n1'), ('b2', 'd1', 'n1'),
+            ('b1', 'd3', 'n2'), ('b1', BUILDDIR_REL_PREFIX + 'd', 'n2')]:
+        session.add(Build(branch=branch, builddir=builddir, buildername=buildername))
+    session.commit()
+
+    def clobber_times():
+        return sorted((ct.branch, ct.builddir, ct.slave, ct.lastclobber)
+                      for ct in session.query(ClobberTime))
+
+    data = [dict(buildername='n1'), dict(buildername='n2', branch='b1', slave='s')]
+    with patch('time.time', return_value=1000):
+        rv = client.post_json('/clobberer/clobber/by-builder', data=data)
+    eq_(rv.status_code, 200)
+    eq_(clobber_times(), [
+        ('b1', 'd1', None, 1000),
+        ('b1', 'd2', None, 1000),
+        ('b1', 'd3', 's', 1000),
+        ('b2', 'd1', None, 1000),
+    ])
+
+    with patch('time.time', return_value=2000):
+        rv = client.post_json('/clobberer/clobber/by-builder', data=data)
+    eq_(clobber_times(), [
+        ('b1', 'd1', None, 2000),
+        ('b1', 'd2', None, 2000),
+        ('b1', 'd3', 's', 2000),
+        ('b2', 'd1', None, 2000),
+    ])
+    eq_(sorted((l.branch, l.builddir, l.lastclobber)
+               for l in session.query(LatestClobber)),
+        [('b1', 'd1', 2000), ('b1', 'd2', 2000), ('b1', 'd3', 2000),
+         ('b2', 'd1', 2000)])
+
+
+@latest_test_context
+def test_add_clobbers_insert_race(app):
+    """If a concurrent request inserts the latest clobber for a builddir
+    after it is looked up, it is updated instead"""
+    session = app.db.session(DB_DECLARATIVE_BASE)
+    session.add(LatestClobber(branch='b', builddir='d', lastclobber=10, who='x'))
+    session.commit()
+
+    real_query = session.query
+    lookups = []
+
+    def query(*args):
+        q = real_query(*args)
+        if args[0] is LatestClobber.id and not lookups:
+            # the first lookup misses the row, as if it were inserted
+            # just afterward
+            lookups.append(args)
+            return q.filter(sa.false())
+        return q
+    with patch.object(session, 'query', side_effect=query):
+        eq_(bulk.add_clobbers(session, [('b', 'd', None)], 'y', 20),
+            set([('b', 'd')]))
+    session.commit()
+    eq_(lookups, [(LatestClobber.id, LatestClobber.branch, LatestClobber.builddir)])
+    eq_([(l.lastclobber, l.who) for l in session.query(LatestClobber)],
+        [(20, 'y')])
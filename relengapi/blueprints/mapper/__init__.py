@@ -229,6 +229,7 @@ def get_rev(projects, vcs_type, commit):
 
 
 @bp.route('/<projects>/mapfile/full')
+@db.replica_reads
 def get_full_mapfile(projects):
     # (documentation in relengapi/docs/usage/mapper.rst)
     q = Hash.query.join(Project).filter(_project_filter(projects))
@@ -237,6 +238,7 @@ def get_full_mapfile(projects):
 
 
 @bp.route('/<projects>/mapfile/since/<since>')
+@db.replica_reads
 def get_mapfile_since(projects, since):
     # (documentation in relengapi/docs/usage/mapper.rst)
     try:
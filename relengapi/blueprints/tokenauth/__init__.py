@@ -88,7 +88,7 @@ def user_to_jsontoken(user):
         td = user.token_data
         attrs['id'] = td.id
         attrs['description'] = td.description
-        attrs['permissions'] = [str(p) for p in td.permissions]
+        attrs['permissions'] = sorted(str(p) for p in td.permissions)
         if td.user:
             attrs['user'] = td.user
 
@@ -348,7 +348,7 @@ def revoke_token(token_id):
     if not can_access_token('revoke', token_data.typ, token_data.user):
         raise Forbidden
 
-    perms_str = ', '.join(str(p) for p in token_data.permissions)
+    perms_str = ', '.join(sorted(str(p) for p in token_data.permissions))
     log = logger.bind(token_typ=token_data.typ, token_permissions=perms_str,
                       token_id=token_id, mozdef=True)
     log.info("Revoking {} token #{} with permissions {}".format(
@@ -356,6 +356,7 @@ def revoke_token(token_id):
 
     tables.Token.query.filter_by(id=token_id).delete()
     session.commit()
+    loader.invalidate_token(token_id)
     return None, 204
 
 
@@ -4,14 +4,19 @@
 
 from __future__ import absolute_import
 
+import collections
+import threading
 import time
 
 import structlog
+from flask import current_app
 from werkzeug.exceptions import BadRequest
 
 from relengapi.blueprints.tokenauth import tables
 from relengapi.blueprints.tokenauth import tokenstr
 from relengapi.lib import auth
+from relengapi.lib import memcached
+from relengapi.lib.permissions import PermissionSet
 from relengapi.lib.permissions import p
 
 logger = structlog.get_logger()
@@ -24,7 +29,11 @@ class TokenUser(auth.BaseUser):
     def __init__(self, claims, authenticated_email=None,
                  permissions=[], token_data={}):
         self.claims = claims
-        self._permissions = set(permissions)
+        # permission sets shared between tokens are already immutable
+        if isinstance(permissions, PermissionSet):
+            self._permissions = permissions
+        else:
+            self._permissions = PermissionSet(permissions)
         self.token_data = token_data
         if authenticated_email:
             self.authenticated_email = authenticated_email
@@ -51,6 +60,78 @@ def permlist_to_permissions(permlist):
     return [perm for perm in token_permissions if perm]
 
 
+# IDs of recently invalidated tokens, shared by all processes using the same
+# memcached.  Each marker outlives any user cached for the token before it
+# was invalidated.
+revoked_tokens = memcached.Cache('tokenauth:revoked', 'TOKENAUTH_CACHE')
+
+
+class TokenCache(object):
+
+    """A bounded LRU cache mapping token strings to the TokenUser objects
+    loaded from them.  Entries expire after `ttl` seconds, or when the token
+    itself expires.  Users loaded from tokens in the database are also
+    dropped when the token has been invalidated, in any process."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # token_str -> (expires, user), least recently used first
+        self._entries = collections.OrderedDict()
+
+    def get(self, token_str):
+        with self.lock:
+            try:
+                expires, user = self._entries.pop(token_str)
+            except KeyError:
+                return None
+            if time.time() >= expires:
+                return None
+            self._entries[token_str] = (expires, user)
+        # check for invalidation without the lock held, as this is a
+        # round-trip to memcached
+        if user.token_data and revoked_tokens.get(user.token_data.id):
+            self.invalidate(user.token_data.id)
+            return None
+        return user
+
+    def put(self, token_str, user):
+        expires = time.time() + self.ttl
+        if 'exp' in user.claims:
+            expires = min(expires, user.claims['exp'])
+        with self.lock:
+            self._entries.pop(token_str, None)
+            self._entries[token_str] = (expires, user)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token_id):
+        """Forget any cached users for the token with the given ID"""
+        with self.lock:
+            for token_str, (expires, user) in self._entries.items():
+                if user.token_data and user.token_data.id == token_id:
+                    del self._entries[token_str]
+
+
+def invalidate_token(token_id):
+    """Invalidate any cached users for the given token, in this process and
+    in every other; call this when a token is revoked or disabled."""
+    cache = getattr(current_app, 'tokenauth_cache', None)
+    if cache:
+        cache.invalidate(token_id)
+        revoked_tokens.set(token_id, True, timeout=cache.ttl)
+
+
+def _detached(token_data):
+    # the row belongs to the current request's session, so a cached user
+    # gets its own copy
+    return tables.Token(id=token_data.id, typ=token_data.typ,
+                        description=token_data.description, user=token_data.user,
+                        disabled=token_data.disabled,
+                        _permissions=token_data._permissions)
+
+
 class TokenLoader(object):
 
     def __init__(self):
@@ -88,6 +169,12 @@ class TokenLoader(object):
         return user
 
     def from_str(self, token_str):
+        cache = getattr(current_app, 'tokenauth_cache', None)
+        if cache:
+            user = cache.get(token_str)
+            if user:
+                return user
+
         claims = tokenstr.str_to_claims(token_str)
         if not claims:
             return
@@ -95,7 +182,13 @@ class TokenLoader(object):
             typ_fn = self.type_functions[claims['typ']]
         except KeyError:
             return
-        return typ_fn(claims)
+        user = typ_fn(claims)
+
+        if user and cache:
+            if user.token_data:
+                user.token_data = _detached(user.token_data)
+            cache.put(token_str, user)
+        return user
 
 
 token_loader = TokenLoader()
@@ -137,4 +230,11 @@ def usr_loader(claims):
 
 
 def init_app(app):
-    pass
+    ttl = app.config.get('TOKENAUTH_CACHE_TTL', 60)
+    # without a shared memcached, invalidations would not reach the other
+    # processes, so they could use revoked tokens until the TTL passed
+    if ttl and app.config.get('TOKENAUTH_CACHE'):
+        app.tokenauth_cache = TokenCache(
+            size=app.config.get('TOKENAUTH_CACHE_SIZE', 1000), ttl=ttl)
+    else:
+        app.tokenauth_cache = None
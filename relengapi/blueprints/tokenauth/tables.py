@@ -8,8 +8,29 @@ import sqlalchemy as sa
 
 from relengapi.blueprints.tokenauth import types
 from relengapi.lib import db
+from relengapi.lib.permissions import PermissionSet
 from relengapi.lib.permissions import p
 
+# decoded permission sets, keyed by their string representation; the sets are
+# immutable, so tokens with the same permissions share the same set
+_permission_sets = {}
+
+
+def permission_set(permissions_str):
+    """Return the PermissionSet of permissions named in the given
+    comma-separated string, decoding it only the first time it is seen"""
+    try:
+        return _permission_sets[permissions_str]
+    except KeyError:
+        pass
+    token_permissions = [p.get(permissionstr)
+                         for permissionstr in permissions_str.split(',')]
+    # silently ignore any nonexistent permissions; this allows us to remove unused
+    # permissions without causing tokens permitting those permissions to fail
+    # completely
+    perms = PermissionSet(a for a in token_permissions if a)
+    return _permission_sets.setdefault(permissions_str, perms)
+
 
 class Token(db.declarative_base('relengapi')):
     __tablename__ = 'auth_tokens'
@@ -28,7 +49,7 @@ class Token(db.declarative_base('relengapi')):
 
     def to_jsontoken(self):
         tok = types.JsonToken(id=self.id, typ=self.typ, description=self.description,
-                              permissions=[str(a) for a in self.permissions],
+                              permissions=sorted(str(a) for a in self.permissions),
                               disabled=self.disabled)
         if self.user:
             tok.user = self.user
@@ -36,9 +57,4 @@ class Token(db.declarative_base('relengapi')):
 
     @property
     def permissions(self):
-        token_permissions = [p.get(permissionstr)
-                             for permissionstr in self._permissions.split(',')]
-        # silently ignore any nonexistent permissions; this allows us to remove unused
-        # permissions without causing tokens permitting those permissions to fail
-        # completely
-        return [a for a in token_permissions if a]
+        return permission_set(self._permissions)
@@ -7,6 +7,7 @@ from __future__ import absolute_import
 import mock
 from flask import json
 from nose.tools import eq_
+from nose.tools import ok_
 
 from relengapi.blueprints.tokenauth import loader
 from relengapi.blueprints.tokenauth import tables
@@ -170,3 +171,94 @@ def test_usr_loader_disabled(app):
         session.commit()
         # no TokenUser results
         eq_(loader.usr_loader({'typ': 'usr', 'jti': 't2'}), None)
+
+
+CACHE_CONFIG = {'TOKENAUTH_CACHE': 'mock://tokenauth'}
+
+
+@test_context.specialize(db_setup=insert_usr, config=CACHE_CONFIG)
+def test_from_str_cached(app):
+    """from_str caches the users it loads, until the token is invalidated"""
+    tok = FakeSerializer.usr(2)
+    with app.app_context():
+        user = loader.token_loader.from_str(tok)
+        eq_(user.permissions, set([p.test_tokenauth.zig]))
+
+        # disable the token behind the cache's back; the cached user remains
+        session = app.db.session('relengapi')
+        tables.Token.query.first().disabled = True
+        session.commit()
+        eq_(loader.token_loader.from_str(tok), user)
+
+        loader.invalidate_token(2)
+        eq_(loader.token_loader.from_str(tok), None)
+
+
+@test_context.specialize(db_setup=insert_usr, config=CACHE_CONFIG)
+def test_from_str_invalidated_elsewhere(app):
+    """A token invalidated in another process is not used from the cache"""
+    tok = FakeSerializer.usr(2)
+    with app.app_context():
+        user = loader.token_loader.from_str(tok)
+        session = app.db.session('relengapi')
+        tables.Token.query.first().disabled = True
+        session.commit()
+        eq_(loader.token_loader.from_str(tok), user)
+
+        # simulate another process, which shares only the memcached
+        with mock.patch.object(app, 'tokenauth_cache',
+                               loader.TokenCache(size=10, ttl=60)):
+            loader.invalidate_token(2)
+        eq_(loader.token_loader.from_str(tok), None)
+
+
+@test_context.specialize(db_setup=insert_prm)
+def test_from_str_no_memcached(app):
+    """Without TOKENAUTH_CACHE, tokens are not cached"""
+    with app.app_context():
+        eq_(app.tokenauth_cache, None)
+
+
+@test_context.specialize(db_setup=insert_prm,
+                         config=dict(CACHE_CONFIG, TOKENAUTH_CACHE_TTL=0))
+def test_from_str_not_cached(app):
+    """With TOKENAUTH_CACHE_TTL set to 0, tokens are loaded every time"""
+    tok = FakeSerializer.prm(1)
+    with app.app_context():
+        eq_(app.tokenauth_cache, None)
+        ok_(loader.token_loader.from_str(tok))
+        session = app.db.session('relengapi')
+        tables.Token.query.delete()
+        session.commit()
+        eq_(loader.token_loader.from_str(tok), None)
+
+
+def test_TokenCache_lru():
+    cache = loader.TokenCache(size=2, ttl=60)
+    users = [loader.TokenUser({'typ': 'prm', 'jti': 't%d' % i}) for i in range(3)]
+    cache.put('a', users[0])
+    cache.put('b', users[1])
+    eq_(cache.get('a'), users[0])
+    # 'b' is now the least recently used, so it is evicted
+    cache.put('c', users[2])
+    eq_(cache.get('b'), None)
+    eq_(cache.get('a'), users[0])
+    eq_(cache.get('c'), users[2])
+
+
+def test_TokenCache_expiry():
+    cache = loader.TokenCache(size=10, ttl=60)
+    user = loader.TokenUser({'typ': 'prm', 'jti': 't1'})
+    tmp_user = loader.TokenUser({'typ': 'tmp', 'exp': 1000030})
+    with mock.patch('relengapi.blueprints.tokenauth.loader.time') as time:
+        time.time.return_value = 1000000
+        cache.put('prm', user)
+        cache.put('tmp', tmp_user)
+
+        # the tmp token expires before the TTL
+        time.time.return_value = 1000030
+        eq_(cache.get('prm'), user)
+        eq_(cache.get('tmp'), None)
+
+        time.time.return_value = 1000060
+        eq_(cache.get('prm'), None)
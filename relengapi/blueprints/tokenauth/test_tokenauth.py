@@ -36,7 +36,7 @@ def app_setup(app):
     # utility endpoint
     @app.route('/test_tokenauth')
     def test_route():
-        assert isinstance(current_user.permissions, set)
+        assert isinstance(current_user.permissions, (set, frozenset))
         return json.dumps({
             'id': current_user.get_id(),
             'permissions': sorted(str(a) for a in current_user.permissions),
@@ -633,7 +633,7 @@ def test_token_row_undefined_permissions(app):
         typ='prm',
         _permissions='test_tokenauth.zig,not.a.real.permission',
         description="permtest")
-    eq_(t.permissions, [p.test_tokenauth.zig])
+    eq_(t.permissions, frozenset([p.test_tokenauth.zig]))
 
 
 @test_context
@@ -645,4 +645,16 @@ def test_token_row_empty_permissions(app):
         typ='prm',
         permissions=[],
         description="permtest")
-    eq_(t.permissions, [])
+    eq_(t.permissions, frozenset())
+
+
+@test_context
+def test_token_row_shared_permissions(app):
+    """Token rows with the same permissions share one immutable permission
+    set."""
+    t1 = Token(id=21, typ='prm', description='a',
+               permissions=[p.test_tokenauth.zig])
+    t2 = Token(id=22, typ='prm', description='b',
+               _permissions='test_tokenauth.zig')
+    assert t1.permissions is t2.permissions
+    assert isinstance(t1.permissions, frozenset)
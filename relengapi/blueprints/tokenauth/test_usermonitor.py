@@ -130,3 +130,29 @@ def test_monitor_users_reenable(app):
             js = mock.Mock()
             usermonitor.monitor_users(js)
         assert_reenabled(app, js, [A, B])
+
+
+@test_context
+def test_monitor_users_disable_invalidates_cache(app):
+    """Disabling a token invalidates any cached users for it"""
+    with app.app_context():
+        insert_usr(app, permissions=[A, B])
+        with mocked_perms({'me@me.com': [A]}):
+            with mock.patch('relengapi.blueprints.tokenauth.loader.'
+                            'invalidate_token') as invalidate_token:
+                usermonitor.monitor_users(mock.Mock())
+        invalidate_token.assert_called_once_with(2)
+
+
+@test_context
+def test_monitor_users_batched_lookup(app):
+    """All users are looked up with a single call to the authz backend"""
+    with app.app_context():
+        insert_usr(app, permissions=[A])
+        with mock.patch('relengapi.lib.auth.perms_types.static.'
+                        'StaticAuthz.get_users_permissions') as gup:
+            gup.return_value = {'me@me.com': set([A])}
+            js = mock.Mock()
+            usermonitor.monitor_users(js)
+        gup.assert_called_once_with(set(['me@me.com']))
+        assert_enabled(app)
@@ -7,6 +7,7 @@ from __future__ import absolute_import
 import structlog
 from flask import current_app
 
+from relengapi.blueprints.tokenauth import loader
 from relengapi.blueprints.tokenauth import tables
 from relengapi.lib import badpenny
 
@@ -19,9 +20,14 @@ def monitor_users(job_status):
     # permissions.  If the token has more permissions than the user, disable
     # the token.
     session = current_app.db.session('relengapi')
-    for token in session.query(tables.Token).filter(tables.Token.typ == 'usr'):
-        token_perms = set(token.permissions)
-        user_perms = current_app.authz.get_user_permissions(token.user)
+    tokens = session.query(tables.Token).filter(tables.Token.typ == 'usr').all()
+    # look up each user once, letting the authz backend batch the lookups
+    users_perms = current_app.authz.get_users_permissions(
+        set(token.user for token in tokens))
+    disabled = []
+    for token in tokens:
+        token_perms = token.permissions
+        user_perms = users_perms[token.user]
         if user_perms is None:
             disable = True
         else:
@@ -30,7 +36,7 @@ def monitor_users(job_status):
             else:
                 disable = False
 
-        perm_str = ', '.join(str(p) for p in token.permissions)
+        perm_str = ', '.join(sorted(str(p) for p in token_perms))
         log = logger.bind(token_typ=token.typ, token_id=token.id,
                           token_user=token.user, token_permissions=perm_str, mozdef=True)
         if disable and not token.disabled:
@@ -39,6 +45,7 @@ def monitor_users(job_status):
             log.info(logmsg)
             job_status.log_message(logmsg)
             token.disabled = True
+            disabled.append(token.id)
         elif not disable and token.disabled:
             logmsg = "Re-enabling {} token #{} for user {} with permissions {}".format(
                 token.typ, token.id, token.user, perm_str)
@@ -46,6 +53,8 @@ def monitor_users(job_status):
             job_status.log_message(logmsg)
             token.disabled = False
     session.commit()
+    for token_id in disabled:
+        loader.invalidate_token(token_id)
 
 
 def init_app(app):
@@ -28,6 +28,7 @@ from relengapi.blueprints.tooltool import types
 from relengapi.blueprints.tooltool import util
 from relengapi.lib import angular
 from relengapi.lib import api
+from relengapi.lib import db
 from relengapi.lib import time
 from relengapi.lib.permissions import p
 
@@ -310,6 +311,7 @@ def patch_file(digest, body):
 
 
 @bp.route('/sha512/<digest>')
+@db.replica_reads
 @api.apimethod(None, unicode, unicode, status_code=302)
 def download_file(digest, region=None):
     """Fetch a link to the file with the given sha512 digest.  The response
@@ -6,14 +6,17 @@ from __future__ import absolute_import
 
 import json
 import logging
-from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
 
 import flask
+import pytz
 import sqlalchemy as sa
 from flask import Blueprint
 from flask import current_app
 from flask import url_for
 from flask.ext.login import current_user
+from sqlalchemy import orm
 from werkzeug.exceptions import BadRequest
 from werkzeug.exceptions import NotFound
 from wsme import Unset
@@ -22,7 +25,9 @@ from relengapi.blueprints.treestatus import model
 from relengapi.blueprints.treestatus import types
 from relengapi.lib import angular
 from relengapi.lib import api
+from relengapi.lib import db
 from relengapi.lib import http
+from relengapi.lib import memcached
 from relengapi.lib import time as relengapi_time
 from relengapi.lib.api import apimethod
 from relengapi.lib.permissions import p
@@ -36,10 +41,16 @@ p.treestatus.admin.doc('Administrate treestatus (add, delete, modify trees)')
 
 log = logging.getLogger(__name__)
 TREE_SUMMARY_LOG_LIMIT = 5
+MAX_PAGE_SIZE = 1000
+UPTIME_WINDOW = timedelta(days=30)
 public_data = http.response_headers(
     ('cache-control', 'no-cache'),
     ('access-control-allow-origin', '*'))
 
+# trees are cached by name until they are changed
+tree_cache = memcached.Cache('treestatus:tree', 'TREESTATUS_CACHE',
+                             datatype=types.JsonTree)
+
 
 bp.root_widget_template(
     'treestatus_root_widget.html', priority=100)
@@ -49,6 +60,8 @@ def update_tree_status(session, tree, status=None, reason=None,
                        tags=[], message_of_the_day=None):
     """Update the given tree's status; note that this does not commit
     the session.  Supply a tree object or name."""
+    when = relengapi_time.now()
+    status_changed = status is not None and status != tree.status
     if status is not None:
         tree.status = status
     if reason is not None:
@@ -64,49 +77,57 @@ def update_tree_status(session, tree, status=None, reason=None,
             reason = 'no change'
         l = model.DbLog(
             tree=tree.tree,
-            when=relengapi_time.now(),
+            when=when,
             who=str(current_user),
             status=status,
             reason=reason,
             tags=tags)
         session.add(l)
 
-    tree_cache_invalidate(tree.tree)
-
-
-@contextmanager
-def _get_mc():
-    cfg = current_app.config.get('TREESTATUS_CACHE')
-    if not cfg:
-        yield None
-    else:
-        with current_app.memcached.cache(cfg) as mc:
-            yield mc
-
-
-def tree_cache_get(tree):
-    with _get_mc() as mc:
-        if not mc:
-            return None
-        data = mc.get(tree.encode('utf-8'))
-        if not data:
-            return
-        return api.loads(types.JsonTree, data.decode('utf-8'))
-
-
-def tree_cache_set(tree, data):
-    with _get_mc() as mc:
-        if not mc:
-            return None
-        j = api.dumps(types.JsonTree, data)
-        mc.set(tree.encode('utf-8'), j.encode('utf-8'))
-
-
-def tree_cache_invalidate(tree):
-    with _get_mc() as mc:
-        if not mc:
-            return None
-        mc.delete(tree.encode('utf-8'))
+        if status_changed:
+            start_status_interval(session, tree.tree, status, when, log=l)
+
+    tree_cache.delete(tree.tree)
+
+
+def start_status_interval(session, tree, status, when, log):
+    """End the given tree's current status interval, if any, and begin a new
+    one with the given status, begun by the given log entry; note that this
+    does not commit the session."""
+    tbl = model.DbStatusInterval
+    # lock the open interval so that concurrent changes can't both end it
+    q = session.query(tbl).filter_by(tree=tree, ended=None)
+    current = q.with_for_update().first()
+    if current:
+        current.ended = when
+        current.duration = _ms(when - current.started)
+    session.add(tbl(tree=tree, status=status, started=when, log=log))
+
+
+def _ms(delta):
+    return int(delta.total_seconds() * 1000)
+
+
+def _paginate(q, tbl, before, limit, **scope):
+    """Apply keyset pagination on (when, id) to a query against `tbl`,
+    newest first.  Only rows strictly older than the row with id `before` are
+    returned, if given, and at most `limit` rows.  The `before` row must
+    match the column values given in `scope`, as the rows of `q` do."""
+    if before is not None:
+        last = current_app.db.session('relengapi').query(
+            tbl.when).filter(tbl.id == before).filter_by(**scope).first()
+        if not last:
+            raise BadRequest("no such entry {}".format(before))
+        q = q.filter(sa.or_(
+            tbl.when < last.when,
+            sa.and_(tbl.when == last.when, tbl.id < before)))
+    q = q.order_by(tbl.when.desc(), tbl.id.desc())
+    if limit is not None:
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise BadRequest("limit must be between 1 and {}".format(
+                MAX_PAGE_SIZE))
+        q = q.limit(limit)
+    return q
 
 
 @bp.route('/')
@@ -129,6 +150,7 @@ def show_tree_details(tree):
 
 @bp.route('/trees')
 @public_data
+@db.replica_reads
 @apimethod({unicode: types.JsonTree})
 def get_trees():
     """
@@ -164,15 +186,12 @@ def get_tree(tree):
     This endpoint is cached heavily and is safe to call frequently to verify
     the status of a tree.
     """
-    r = tree_cache_get(tree)
-    if r:
-        return r
-    t = current_app.db.session('relengapi').query(model.DbTree).get(tree)
-    if not t:
-        raise NotFound("No such tree")
-    j = t.to_json()
-    tree_cache_set(tree, j)
-    return j
+    def load():
+        t = current_app.db.session('relengapi').query(model.DbTree).get(tree)
+        if not t:
+            raise NotFound("No such tree")
+        return t.to_json()
+    return tree_cache.get_or_set(tree, load)
 
 
 @bp.route('/v0/trees/<path:tree>')
@@ -219,46 +238,158 @@ def kill_tree(tree):
     if not t:
         raise NotFound("No such tree")
     session.delete(t)
-    # delete from logs and change stack, too
+    # delete from logs, status intervals, and change stack, too
+    model.DbStatusInterval.query.filter_by(tree=tree).delete()
+    log_ids = session.query(model.DbLog.id).filter_by(tree=tree).subquery()
+    model.DbLogTag.query.filter(model.DbLogTag.log_id.in_(log_ids)).delete(
+        synchronize_session=False)
     model.DbLog.query.filter_by(tree=tree).delete()
     model.DbStatusChangeTree.query.filter_by(tree=tree).delete()
     session.commit()
-    tree_cache_invalidate(tree)
+    tree_cache.delete(tree)
     return None, 204
 
 
 @bp.route('/trees/<path:tree>/logs')
 @public_data
-@apimethod([types.JsonTreeLog], unicode, int)
-def get_logs(tree, all=0):
+@apimethod([types.JsonTreeLog], unicode, int, int, int, unicode)
+def get_logs(tree, all=0, limit=None, before=None, tag=None):
     """
-    Get a log of changes for the given tree.  This is limited to the most recent
-    5 entries by default.  Use `?all=1` to get all log entries.
+    Get a log of changes for the given tree, newest first.  This is limited to
+    the most recent 5 entries by default.
+
+    To page through the log, pass `?limit=N` to get up to N entries, then pass
+    the `id` of the last entry received as `?before=<id>` to get the next
+    page.  Use `?all=1` to get all log entries at once; this can be a very
+    large response for busy trees.
+
+    Use `?tag=<tag>` to get only log entries with the given tag.
     """
     # verify the tree exists first
     t = current_app.db.session('relengapi').query(model.DbTree).get(tree)
     if not t:
         raise NotFound("No such tree")
 
-    logs = []
+    if limit is None and not all:
+        limit = TREE_SUMMARY_LOG_LIMIT
+
     q = current_app.db.session('relengapi').query(
         model.DbLog).filter_by(tree=tree)
-    q = q.order_by(model.DbLog.when.desc())
-    if not all:
-        q = q.limit(TREE_SUMMARY_LOG_LIMIT)
+    if tag is not None:
+        q = q.join(model.DbLogTag).filter(model.DbLogTag.tag == tag)
+    q = _paginate(q, model.DbLog, before, limit, tree=tree)
+    return [l.to_json() for l in q]
 
-    logs = [l.to_json() for l in q]
-    return logs
+
+@bp.route('/tags')
+@public_data
+@apimethod([types.JsonTagSummary], unicode, unicode, datetime, datetime)
+def get_tag_summary(tree=None, status=None, since=None, until=None):
+    """
+    Get the number of log entries carrying each tag, per tree.
+
+    Use `?tree=<tree>` to limit the summary to one tree, and `?status=closed`
+    to count only entries with the given status (for example, to count
+    closures).  The `since` and `until` arguments limit the summary to log
+    entries at or after, and before, the given times, respectively.
+    """
+    session = current_app.db.session('relengapi')
+    log, tag = model.DbLog, model.DbLogTag
+    q = session.query(log.tree, tag.tag, sa.func.count(log.id))
+    q = q.select_from(tag).join(log)
+    if tree is not None:
+        q = q.filter(log.tree == tree)
+    if status is not None:
+        q = q.filter(log.status == status)
+    if since is not None:
+        q = q.filter(log.when >= since)
+    if until is not None:
+        q = q.filter(log.when < until)
+    q = q.group_by(log.tree, tag.tag).order_by(log.tree, tag.tag)
+    return [types.JsonTagSummary(tree=t, tag=tg, count=c) for t, tg, c in q]
+
+
+@bp.route('/trees/<path:tree>/uptime')
+@public_data
+@apimethod(types.JsonTreeUptime, unicode, datetime, datetime)
+def get_uptime(tree, since=None, until=None):
+    """
+    Get the time, in milliseconds, that the given tree spent in each status
+    between `since` and `until`, along with the time spent closed for each
+    tag given when the tree was closed.
+
+    The window defaults to the 30 days ending now.  Time before the tree's
+    first recorded status change is not counted.
+    """
+    session = current_app.db.session('relengapi')
+    if not session.query(model.DbTree).get(tree):
+        raise NotFound("No such tree")
+
+    # treat times without a timezone as UTC
+    since, until = [t.replace(tzinfo=pytz.UTC) if t and not t.tzinfo else t
+                    for t in (since, until)]
+    now = relengapi_time.now()
+    until = until or now
+    since = since or until - UPTIME_WINDOW
+    if since >= until:
+        raise BadRequest("since must be before until")
+
+    status_ms = {}
+    tag_ms = {}
+
+    def add(totals, key, ms):
+        totals[key] = totals.get(key, 0) + ms
+
+    # intervals wholly within the window have a precomputed duration, so
+    # they can be summed in the database
+    tbl = model.DbStatusInterval
+    within = (tbl.tree == tree, tbl.started >= since, tbl.ended <= until)
+    q = session.query(tbl.status, sa.func.sum(tbl.duration))
+    q = q.filter(*within).group_by(tbl.status)
+    for status, ms in q:
+        add(status_ms, status, int(ms))
+    q = session.query(model.DbLogTag.tag, sa.func.sum(tbl.duration))
+    q = q.select_from(tbl).join(model.DbLogTag,
+                                model.DbLogTag.log_id == tbl.log_id)
+    q = q.filter(tbl.status == 'closed', *within).group_by(model.DbLogTag.tag)
+    for tag, ms in q:
+        add(tag_ms, tag, int(ms))
+
+    # at most two intervals straddle the edges of the window (or are still
+    # ongoing); clip those here
+    q = session.query(tbl).options(orm.joinedload(tbl.log, 'tag_rows'))
+    q = q.filter(tbl.tree == tree, tbl.started < until,
+                 sa.or_(tbl.ended == None, tbl.ended > since),  # noqa
+                 sa.or_(tbl.started < since, tbl.ended == None,  # noqa
+                        tbl.ended > until))
+    for iv in q:
+        ms = _ms(min(iv.ended or now, until) - max(iv.started, since))
+        if ms <= 0:
+            continue
+        add(status_ms, iv.status, ms)
+        if iv.status == 'closed' and iv.log:
+            for t in iv.log.tag_rows:
+                add(tag_ms, t.tag, ms)
+
+    return types.JsonTreeUptime(tree=tree, since=since, until=until,
+                                status_durations=status_ms,
+                                closed_tag_durations=tag_ms)
 
 
 @bp.route('/stack', methods=['GET'])
-@apimethod([types.JsonStateChange])
-def get_stack():
+@apimethod([types.JsonStateChange], int, int)
+def get_stack(limit=None, before=None):
     """
     Get the "undo stack" of changes to trees, most recent first.
+
+    By default, the entire stack is returned.  To page through the stack,
+    pass `?limit=N` to get up to N changes, then pass the `id` of the last
+    change received as `?before=<id>` to get the next page.
     """
     tbl = model.DbStatusChange
-    return [ch.to_json() for ch in tbl.query.order_by(tbl.when.desc())]
+    q = tbl.query.options(orm.joinedload(tbl.trees))
+    q = _paginate(q, tbl, before, limit)
+    return [ch.to_json() for ch in q]
 
 
 @bp.route('/stack/<int:id>', methods=['DELETE'])
@@ -7,12 +7,14 @@ from __future__ import absolute_import
 import json
 import logging
 
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import Text
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import backref
 from sqlalchemy.orm import relation
 
 from relengapi.blueprints.treestatus import types
@@ -39,9 +41,13 @@ class DbTree(db.declarative_base('relengapi')):
 
 class DbLog(db.declarative_base('relengapi')):
     __tablename__ = 'treestatus_log'
+    __table_args__ = (
+        # per-tree log queries filter on tree and sort on when
+        Index('ix_treestatus_log_tree_when', 'tree', 'when'),
+    )
 
     id = Column(Integer, primary_key=True)
-    tree = Column(String(32), nullable=False, index=True)
+    tree = Column(String(32), nullable=False)
     when = Column(db.UTCDateTime, nullable=False, index=True)
     who = Column(Text, nullable=False)
     status = Column(String(64), nullable=False)
@@ -51,14 +57,23 @@ class DbLog(db.declarative_base('relengapi')):
     def __init__(self, tags=None, **kwargs):
         if tags is not None:
             kwargs['_tags'] = json.dumps(tags)
+            # index each distinct tag in treestatus_log_tags as well
+            kwargs['tag_rows'] = [DbLogTag(tag=t) for t in sorted(set(tags))]
         super(DbLog, self).__init__(**kwargs)
 
-    @hybrid_property
+    @property
     def tags(self):
-        return json.loads(self._tags)
+        # tags are never modified after the log entry is created, so the
+        # decoded value can be cached on the instance
+        try:
+            return self._decoded_tags
+        except AttributeError:
+            self._decoded_tags = json.loads(self._tags)
+            return self._decoded_tags
 
     def to_json(self):
         return types.JsonTreeLog(
+            id=self.id,
             tree=self.tree,
             when=self.when,
             who=self.who,
@@ -68,6 +83,43 @@ class DbLog(db.declarative_base('relengapi')):
         )
 
 
+class DbLogTag(db.declarative_base('relengapi')):
+    __tablename__ = 'treestatus_log_tags'
+    __table_args__ = (
+        Index('ix_treestatus_log_tags_tag_log_id', 'tag', 'log_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    log_id = Column(Integer, ForeignKey(DbLog.id), nullable=False, index=True)
+    tag = Column(String(255), nullable=False)
+
+    log = relation(DbLog, backref=backref('tag_rows', cascade='all, delete-orphan'))
+
+
+class DbStatusInterval(db.declarative_base('relengapi')):
+
+    """A period of time during which a tree had a particular status; this
+    is maintained from the tree log as trees change status."""
+
+    __tablename__ = 'treestatus_intervals'
+    __table_args__ = (
+        Index('ix_treestatus_intervals_tree_started', 'tree', 'started'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    tree = Column(String(32), nullable=False)
+    status = Column(String(64), nullable=False)
+    started = Column(db.UTCDateTime, nullable=False)
+    # ended and duration (in milliseconds) are null while the interval is
+    # ongoing
+    ended = Column(db.UTCDateTime, nullable=True)
+    duration = Column(BigInteger, nullable=True)
+    # the log entry which began this interval, for its tags
+    log_id = Column(Integer, ForeignKey(DbLog.id), nullable=True, index=True)
+
+    log = relation(DbLog)
+
+
 class DbStatusChange(db.declarative_base('relengapi')):
     __tablename__ = 'treestatus_changes'
     id = Column(Integer, primary_key=True)
@@ -9,6 +9,7 @@ import pprint
 from contextlib import contextmanager
 
 import mock
+import pytz
 from flask import json
 from nose.tools import eq_
 
@@ -164,27 +165,27 @@ def assert_change_last_state(app, change_id, **exp_last_states):
 
 @test_context.specialize(config={})
 def test_memcache_no_config(app):
-    """With no cache configured, the (private) memcached functions do nothing"""
+    """With no cache configured, the tree cache does nothing"""
     with app.app_context():
         # always misses
-        eq_(treestatus.tree_cache_get(u't'), None)
+        eq_(treestatus.tree_cache.get(u't'), None)
         # always succeed
-        eq_(treestatus.tree_cache_set(u't', types.JsonTree()), None)
-        eq_(treestatus.tree_cache_invalidate(u't'), None)
+        eq_(treestatus.tree_cache.set(u't', types.JsonTree()), None)
+        eq_(treestatus.tree_cache.delete(u't'), None)
 
 
 @test_context
 def test_memcache_functions(app):
-    """The (private) memcached functions correctly get, set, and invalidate
-    a cached item using a mock cache"""
+    """The tree cache correctly gets, sets, and invalidates a cached item
+    using a mock cache"""
     with app.app_context():
         tree = types.JsonTree(tree='t', status='o', reason='r',
                               message_of_the_day='motd')
-        eq_(treestatus.tree_cache_get(u't'), None)
-        treestatus.tree_cache_set(u't', tree)
-        eq_(treestatus.tree_cache_get(u't').status, 'o')
-        treestatus.tree_cache_invalidate(u't')
-        eq_(treestatus.tree_cache_get(u't'), None)
+        eq_(treestatus.tree_cache.get(u't'), None)
+        treestatus.tree_cache.set(u't', tree)
+        eq_(treestatus.tree_cache.get(u't').status, 'o')
+        treestatus.tree_cache.delete(u't')
+        eq_(treestatus.tree_cache.get(u't'), None)
 
 
 @test_context
@@ -262,7 +263,7 @@ def test_get_tree_cached(app, client):
     with app.app_context():
         tree = types.JsonTree(tree='tree1', status='o', reason='r',
                               message_of_the_day='motd')
-        treestatus.tree_cache_set(u'tree1', tree)
+        treestatus.tree_cache.set(u'tree1', tree)
     resp = client.get('/treestatus/trees/tree1')
     eq_(json.loads(resp.data)['result']['status'], 'o')
 
@@ -331,7 +332,7 @@ def test_delete_tree(app, client):
             who='jimmy',
             status='halfopen',
             reason='being difficult',
-            tags=[])
+            tags=['x'])
         session.add(l)
         session.commit()
 
@@ -344,6 +345,8 @@ def test_delete_tree(app, client):
 
     with app.app_context():
         eq_(model.DbLog.query.filter_by(tree='tree1')[:], [])
+        eq_(model.DbLogTag.query.all(), [])
+        eq_(model.DbStatusInterval.query.filter_by(tree='tree1')[:], [])
         eq_(model.DbStatusChangeTree.query.filter_by(tree='tree1')[:], [])
 
 
@@ -367,6 +370,7 @@ def test_get_logs(client):
     entries (newest first), with a no-cache header and ACAO *"""
     resp = client.get('/treestatus/trees/tree1/logs')
     eq_(json.loads(resp.data)['result'], [{
+        'id': 2,
         'tree': 'tree1',
         'tags': [],
         'who': 'dustin',
@@ -374,6 +378,7 @@ def test_get_logs(client):
         'reason': 'i really wanted to',
         'status': 'opened',
     }, {
+        'id': 3,
         'tree': 'tree1',
         'tags': ['a', 'b'],
         'who': 'dustin',
@@ -381,6 +386,7 @@ def test_get_logs(client):
         'reason': 'because',
         'status': 'closed',
     }, {
+        'id': 1,
         'tree': 'tree1',
         'tags': ['a'],
         'who': 'dustin',
@@ -417,6 +423,116 @@ def test_get_logs_all(client, app):
     eq_(len(json.loads(resp.data)['result']), 8)
 
 
+@test_context
+def test_get_logs_paginated(client, app):
+    """Getting /treestatus/trees/tree1/logs with ?limit and ?before pages
+    through the logs, newest first, breaking ties in `when` by id"""
+    session = app.db.session('relengapi')
+    for ln in range(3):
+        l = model.DbLog(
+            tree='tree1',
+            when=datetime.datetime(2015, 7, 14, 17, 44, 00),
+            who='jimmy',
+            status='halfopen',
+            reason='being difficult %d' % ln,
+            tags=[])
+        session.add(l)
+    session.commit()
+
+    resp = client.get('/treestatus/trees/tree1/logs?limit=2')
+    page = json.loads(resp.data)['result']
+    eq_([e['id'] for e in page], [2, 7])
+
+    resp = client.get('/treestatus/trees/tree1/logs?limit=2&before=7')
+    page = json.loads(resp.data)['result']
+    eq_([e['id'] for e in page], [6, 5])
+
+    resp = client.get('/treestatus/trees/tree1/logs?limit=5&before=5')
+    page = json.loads(resp.data)['result']
+    eq_([e['id'] for e in page], [3, 1])
+
+
+@test_context
+def test_get_logs_bad_limit(client):
+    """Getting /treestatus/trees/tree1/logs with an out-of-range limit is a
+    bad request"""
+    for limit in 0, treestatus.MAX_PAGE_SIZE + 1:
+        resp = client.get('/treestatus/trees/tree1/logs?limit=%d' % limit)
+        eq_(resp.status_code, 400)
+
+
+@test_context
+def test_get_logs_bad_before(client):
+    """Getting /treestatus/trees/tree1/logs with ?before naming a nonexistent
+    entry is a bad request"""
+    resp = client.get('/treestatus/trees/tree1/logs?before=999')
+    eq_(resp.status_code, 400)
+
+
+@test_context
+def test_get_logs_before_other_tree(client):
+    """Getting /treestatus/trees/tree1/logs with ?before naming another
+    tree's entry is a bad request"""
+    resp = client.get('/treestatus/trees/tree1/logs?before=4')
+    eq_(resp.status_code, 400)
+
+
+@test_context
+def test_get_logs_tag(client):
+    """Getting /treestatus/trees/tree1/logs?tag=a returns only log entries
+    with that tag"""
+    resp = client.get('/treestatus/trees/tree1/logs?tag=a')
+    eq_([(e['id'], e['tags']) for e in json.loads(resp.data)['result']],
+        [(3, ['a', 'b']), (1, ['a'])])
+
+
+@test_context
+def test_log_tags_indexed(app):
+    """Creating a log entry adds a row to treestatus_log_tags for each
+    distinct tag"""
+    with app.app_context():
+        session = app.db.session('relengapi')
+        l = model.DbLog(
+            tree='tree1',
+            when=datetime.datetime(2015, 7, 16, 17, 44, 00),
+            who='jimmy',
+            status='closed',
+            reason='dup tags',
+            tags=['y', 'x', 'y'])
+        session.add(l)
+        session.commit()
+        eq_(sorted(t.tag for t in model.DbLogTag.query.filter_by(log_id=l.id)),
+            ['x', 'y'])
+
+
+@test_context
+def test_get_tag_summary(client):
+    """Getting /treestatus/tags counts log entries per tree and tag"""
+    resp = client.get('/treestatus/tags')
+    eq_(json.loads(resp.data)['result'], [
+        {'tree': 'tree1', 'tag': 'a', 'count': 2},
+        {'tree': 'tree1', 'tag': 'b', 'count': 1},
+    ])
+
+
+@test_context
+def test_get_tag_summary_filtered(client):
+    """Getting /treestatus/tags with status, since, and until arguments
+    counts only matching log entries"""
+    resp = client.get('/treestatus/tags?tree=tree1&status=closed')
+    eq_(json.loads(resp.data)['result'], [
+        {'tree': 'tree1', 'tag': 'a', 'count': 1},
+        {'tree': 'tree1', 'tag': 'b', 'count': 1},
+    ])
+    resp = client.get('/treestatus/tags?since=2015-07-12T00:00:00'
+                      '&until=2015-07-14T00:00:00')
+    eq_(json.loads(resp.data)['result'], [
+        {'tree': 'tree1', 'tag': 'a', 'count': 1},
+    ])
+    resp = client.get('/treestatus/tags?tree=tree2')
+    eq_(json.loads(resp.data)['result'], [])
+
+
 @test_context
 def test_get_logs_nosuch(client):
     """Getting /treestatus/trees/NOSUCH/logs results in a 404"""
@@ -450,6 +566,24 @@ def test_get_stack(client):
     ])
 
 
+@test_context.specialize(db_setup=db_setup_stack)
+def test_get_stack_paginated(client):
+    """Getting /treestatus/stack with ?limit and ?before pages through the
+    list of changes, most recent first"""
+    resp = client.get('/treestatus/stack?limit=1')
+    res = json.loads(resp.data)['result']
+    eq_([(ch['id'], sorted(ch['trees'])) for ch in res],
+        [(2, ['tree1', 'tree2'])])
+
+    resp = client.get('/treestatus/stack?limit=1&before=2')
+    res = json.loads(resp.data)['result']
+    eq_([(ch['id'], sorted(ch['trees'])) for ch in res],
+        [(1, ['tree0', 'tree1'])])
+
+    resp = client.get('/treestatus/stack?limit=1&before=1')
+    eq_(json.loads(resp.data)['result'], [])
+
+
 @test_context.specialize(db_setup=db_setup_stack, user=sheriff)
 def test_revert_stack(app, client):
     """DELETEing /treestatus/stack/N with ?revert=1 undoes the effects of
@@ -767,3 +901,93 @@ def test_patch_trees_remember(app, client):
     assert_change_last_state(app, 3,
                              tree0=('closed', 'bug 123'),
                              tree1=('closed', 'bug 456'))
+
+
+def patch_trees(client, when, **update):
+    with set_time(when):
+        resp = client.patch('/treestatus/trees',
+                            data=json.dumps(update),
+                            headers=[('Content-Type', 'application/json')])
+    eq_(resp.status_code, 204)
+
+
+def get_uptime(client, since, until):
+    resp = client.get('/treestatus/trees/tree1/uptime?since=%s&until=%s'
+                      % (since, until))
+    eq_(resp.status_code, 200)
+    res = json.loads(resp.data)['result']
+    return res['status_durations'], res['closed_tag_durations']
+
+
+def dt(hour, minute=0):
+    return datetime.datetime(2015, 7, 20, hour, minute, tzinfo=pytz.UTC)
+
+
+@test_context.specialize(user=sheriff)
+def test_status_intervals(app, client):
+    """Changing a tree's status ends its current status interval and begins a
+    new one; changing only the reason does not"""
+    patch_trees(client, dt(0), trees=['tree1'], status='open')
+    patch_trees(client, dt(1), trees=['tree1'], status='closed',
+                tags=['infra'])
+    patch_trees(client, dt(2), trees=['tree1'], reason='still broken')
+    patch_trees(client, dt(3), trees=['tree1'], status='open')
+    with app.app_context():
+        tbl = model.DbStatusInterval
+        eq_([(iv.status, iv.started, iv.ended, iv.duration,
+              iv.log.tags if iv.log else None)
+             for iv in tbl.query.order_by(tbl.started)], [
+            ('open', dt(0), dt(1), 3600000, []),
+            ('closed', dt(1), dt(3), 7200000, ['infra']),
+            ('open', dt(3), None, None, []),
+        ])
+
+
+@test_context.specialize(user=admin)
+def test_make_tree_no_interval(app, client):
+    """Creating a tree does not begin a status interval, since there is no
+    log entry for it; as for trees that existed before intervals were
+    recorded, the first status change does"""
+    with set_time(dt(0)):
+        resp = client.put('/treestatus/trees/newtree', data=json.dumps(
+            dict(tree='newtree', status='open', reason='green',
+                 message_of_the_day='')),
+            headers=[('Content-Type', 'application/json')])
+    eq_(resp.status_code, 204)
+    with app.app_context():
+        eq_(model.DbStatusInterval.query.filter_by(tree='newtree')[:], [])
+
+
+@test_context.specialize(user=sheriff)
+def test_get_uptime(client):
+    """Getting /treestatus/trees/tree1/uptime sums the time spent in each
+    status and closed under each tag, clipped to the given window"""
+    patch_trees(client, dt(0), trees=['tree1'], status='open')
+    patch_trees(client, dt(1), trees=['tree1'], status='closed',
+                tags=['infra', 'other'])
+    patch_trees(client, dt(3), trees=['tree1'], status='open')
+
+    eq_(get_uptime(client, '2015-07-20T00:30:00', '2015-07-20T04:00:00'),
+        ({'open': 5400000, 'closed': 7200000},
+         {'infra': 7200000, 'other': 7200000}))
+    eq_(get_uptime(client, '2015-07-19T00:00:00', '2015-07-20T02:00:00'),
+        ({'open': 3600000, 'closed': 3600000},
+         {'infra': 3600000, 'other': 3600000}))
+    eq_(get_uptime(client, '2015-07-19T00:00:00', '2015-07-19T12:00:00'),
+        ({}, {}))
+
+
+@test_context
+def test_get_uptime_bad_window(client):
+    """Getting /treestatus/trees/tree1/uptime with since after until is a
+    bad request"""
+    resp = client.get('/treestatus/trees/tree1/uptime'
+                      '?since=2015-07-20T00:00:00&until=2015-07-19T00:00:00')
+    eq_(resp.status_code, 400)
+
+
+@test_context
+def test_get_uptime_nosuch(client):
+    """Getting /treestatus/trees/NOSUCH/uptime results in a 404"""
+    resp = client.get('/treestatus/trees/NOSUCH/uptime')
+    eq_(resp.status_code, 404)
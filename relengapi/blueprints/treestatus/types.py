@@ -37,6 +37,9 @@ class JsonTreeLog(wsme.types.Base):
 
     _name = 'TreeLog'
 
+    #: id of this log entry
+    id = wsme.types.wsattr(int, mandatory=True)
+
     #: the name of the tree
     tree = wsme.types.wsattr(unicode, mandatory=True)
 
@@ -56,6 +59,45 @@ class JsonTreeLog(wsme.types.Base):
     tags = wsme.types.wsattr([unicode], mandatory=True)
 
 
+class JsonTagSummary(wsme.types.Base):
+
+    """The number of log entries for a tree carrying a particular tag."""
+
+    _name = 'TreeTagSummary'
+
+    #: the name of the tree
+    tree = wsme.types.wsattr(unicode, mandatory=True)
+
+    #: the tag
+    tag = wsme.types.wsattr(unicode, mandatory=True)
+
+    #: the number of matching log entries with this tag
+    count = wsme.types.wsattr(int, mandatory=True)
+
+
+class JsonTreeUptime(wsme.types.Base):
+
+    """The time a tree spent in each status over a window of time.  All
+    durations are in milliseconds."""
+
+    _name = 'TreeUptime'
+
+    #: the name of the tree
+    tree = wsme.types.wsattr(unicode, mandatory=True)
+
+    #: the beginning of the window
+    since = wsme.types.wsattr(datetime, mandatory=True)
+
+    #: the end of the window
+    until = wsme.types.wsattr(datetime, mandatory=True)
+
+    #: time spent in each status, keyed by status
+    status_durations = wsme.types.wsattr({unicode: int}, mandatory=True)
+
+    #: time spent closed, keyed by the tags given when the tree was closed
+    closed_tag_durations = wsme.types.wsattr({unicode: int}, mandatory=True)
+
+
 class JsonStateChange(wsme.types.Base):
 
     """A change to one or more trees' status, suitable for reverting the
@@ -4,8 +4,12 @@
 
 from __future__ import absolute_import
 
+import hashlib
+import Queue
+import threading
 import time
 
+import structlog
 from flask import current_app
 from flask import flash
 from flask import redirect
@@ -20,7 +24,9 @@ from flask.ext.login import user_logged_in
 from flask.ext.login import user_logged_out
 
 from relengapi.lib import safety
-from relengapi.lib.permissions import p
+from relengapi.lib.permissions import PermissionSet
+
+logger = structlog.get_logger()
 
 
 class BaseUser(object):
@@ -48,7 +54,7 @@ class BaseUser(object):
         return self.get_permissions()
 
     def get_permissions(self):
-        return set()
+        return PermissionSet()
 
     def get_id(self):
         raise NotImplementedError
@@ -78,21 +84,118 @@ class HumanUser(BaseUser):
         return 'human:%s' % self.authenticated_email
 
     def get_permissions(self):
-        if self._permissions is not None:
-            return self._permissions
-        if 'perms' in session and session.get('perms_exp', 0) > time.time():
-            self._permissions = set(p[perm] for perm in session['perms'])
-        else:
-            self._permissions = perms = set()
-            permissions_stale.send(
-                current_app._get_current_object(), user=self, permissions=perms)
-            session['perms'] = [str(perm) for perm in perms]
-            lifetime = current_app.config.get(
-                'RELENGAPI_PERMISSIONS', {}).get('lifetime', 3600)
-            session['perms_exp'] = int(time.time() + lifetime)
+        if self._permissions is None:
+            self._permissions = current_app.permissions_cache.get(
+                self.authenticated_email)
         return self._permissions
 
 
+class PermissionsCache(object):
+
+    """Human users' permissions, kept on the server and keyed by email.
+
+    Permissions older than `refresh` seconds are refreshed, one user at a
+    time, by a single background thread, and the existing permissions
+    continue to be used until that refresh completes.  Only users with no
+    permissions newer than `lifetime` seconds -- new users, or those who have
+    been idle for a while -- wait for the permissions to be loaded.
+
+    If `cache_config` gives a memcached configuration, invalidations are
+    recorded there, and every process checks for them before using its
+    permissions.  Otherwise, an invalidation only affects this process."""
+
+    def __init__(self, app, lifetime, refresh, cache_config=None):
+        self.app = app
+        self.lifetime = lifetime
+        self.refresh = refresh
+        self.cache_config = cache_config
+        self.lock = threading.Lock()
+        # email -> (loaded time, PermissionSet)
+        self._entries = {}
+        self._refreshing = set()
+        self._queue = Queue.Queue()
+        self._refresher = None
+
+    def get(self, email):
+        now = time.time()
+        with self.lock:
+            loaded, permissions = self._entries.get(email, (0, None))
+        if loaded and loaded <= self._invalidated(email):
+            loaded = 0
+        age = now - loaded
+        if age < self.lifetime and age >= self.refresh:
+            self._start_refresh(email)
+        if age < self.lifetime:
+            return permissions
+        return self._load(email)
+
+    def invalidate(self, email):
+        """Forget the given user's permissions, so that they are loaded
+        afresh on the next request, in this process or any other sharing the
+        cache"""
+        with self.lock:
+            self._entries.pop(email, None)
+        if self.cache_config:
+            with self.app.memcached.cache(self.cache_config) as mc:
+                mc.set(self._cache_key(email), time.time(), time=self.lifetime)
+
+    def _cache_key(self, email):
+        # emails may contain characters that are not valid in keys
+        return 'permissions-invalidated:' + hashlib.sha1(
+            email.lower().encode('utf-8')).hexdigest()
+
+    def _invalidated(self, email):
+        if not self.cache_config:
+            return 0
+        with self.app.memcached.cache(self.cache_config) as mc:
+            return mc.get(self._cache_key(email)) or 0
+
+    def _start_refresh(self, email):
+        with self.lock:
+            if email in self._refreshing:
+                return
+            self._refreshing.add(email)
+            self._queue.put(email)
+            if not self._refresher:
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop, name='permissions-refresh')
+                self._refresher.daemon = True
+                self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            email = self._queue.get()
+            try:
+                self._refresh(email)
+            finally:
+                self._queue.task_done()
+
+    def _load(self, email):
+        perms = set()
+        permissions_stale.send(self.app, user=HumanUser(email), permissions=perms)
+        permissions = PermissionSet(perms)
+        now = time.time()
+        with self.lock:
+            # drop expired entries, rather than letting them pile up
+            for old_email, (loaded, _) in self._entries.items():
+                if now - loaded >= self.lifetime:
+                    del self._entries[old_email]
+            self._entries[email] = (now, permissions)
+        return permissions
+
+    def _refresh(self, email):
+        try:
+            with self.app.app_context():
+                self._load(email)
+        except Exception:
+            # the current permissions remain until they expire, and the
+            # refresh is retried on the next request
+            logger.exception("While refreshing permissions for %s" % email)
+        finally:
+            with self.lock:
+                self._refreshing.discard(email)
+
+
 _request_loaders = []
 
 
@@ -124,7 +227,7 @@ def _request_loader(request):
     for loader in _request_loaders:
         u = loader(request)
         if u:
-            if not isinstance(u.permissions, set):
+            if not isinstance(u.permissions, (set, frozenset)):
                 raise TypeError("user permissions must be a set")
             return u
 
@@ -137,19 +240,22 @@ def login_request():
     return render_template("login_request.html")
 
 
-def _clear_perms_cache():
+def _clear_perms_cache(user):
+    current_app.permissions_cache.invalidate(user.authenticated_email)
+    # permissions were once stored in the session; remove them from
+    # existing session cookies
     for k in 'perms', 'perms_exp':
         if k in session:
             del session[k]
 
 
 def logged_in(sender, user):
-    _clear_perms_cache()
+    _clear_perms_cache(user)
     flash("Logged in as %s" % user.authenticated_email, 'success')
 
 
 def logged_out(sender, user):
-    _clear_perms_cache()
+    _clear_perms_cache(user)
     flash("Logged out")
 
 
@@ -178,6 +284,12 @@ def init_app(app):
     # see https://github.com/maxcountryman/flask-login/issues/162
     user_logged_out.connect(logged_out, app)
 
+    perms_config = app.config.get('RELENGAPI_PERMISSIONS', {})
+    lifetime = perms_config.get('lifetime', 3600)
+    app.permissions_cache = PermissionsCache(
+        app, lifetime, perms_config.get('refresh', lifetime * 3 / 4),
+        perms_config.get('cache'))
+
     _init_mod(app, 'RELENGAPI_AUTHENTICATION', 'browserid', 'relengapi.lib.auth.auth_types')
     _init_mod(app, 'RELENGAPI_PERMISSIONS', 'static', 'relengapi.lib.auth.perms_types')
 
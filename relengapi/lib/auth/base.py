@@ -9,3 +9,10 @@ class BaseAuthz(object):
 
     def get_user_permissions(self, email):
         raise NotImplementedError
+
+    def get_users_permissions(self, emails):
+        """Get the permissions for each of the given users, as a dictionary
+        keyed by email.  Subclasses may override this to look up many users
+        more efficiently than one at a time."""
+        return dict((email, self.get_user_permissions(email))
+                    for email in set(emails))
@@ -4,18 +4,77 @@
 
 from __future__ import absolute_import
 
+import hashlib
 import itertools
+import json
+import Queue
+from contextlib import contextmanager
 
 import ldap
+import ldap.filter
 import structlog
+from flask import current_app
 
 from relengapi.lib.auth import base
 from relengapi.lib.auth import permissions_stale
 from relengapi.lib.permissions import p
 
 
+class LdapConnectionPool(object):
+
+    """A thread-safe pool of bound LDAP connections.  At most `size` idle
+    connections are kept; beyond that, connections are closed after use."""
+
+    def __init__(self, uri, login_dn, login_password, size):
+        self.uri = uri
+        self.login_dn = login_dn
+        self.login_password = login_password
+        self._idle = Queue.LifoQueue(maxsize=size)
+
+    @contextmanager
+    def connection(self):
+        try:
+            l = self._idle.get_nowait()
+        except Queue.Empty:
+            l = ldap.initialize(self.uri)
+            try:
+                l.simple_bind_s(self.login_dn, self.login_password)
+            except Exception:
+                self._unbind(l)
+                raise
+        try:
+            yield l
+        except Exception:
+            # a connection that raised an error may be broken, so it is
+            # closed rather than returned to the pool
+            self._unbind(l)
+            raise
+        try:
+            self._idle.put_nowait(l)
+        except Queue.Full:
+            self._unbind(l)
+
+    def clear(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                l = self._idle.get_nowait()
+            except Queue.Empty:
+                return
+            self._unbind(l)
+
+    def _unbind(self, l):
+        try:
+            l.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
 class LdapGroupsAuthz(base.BaseAuthz):
 
+    # number of users whose groups are resolved by a single search
+    batch_size = 50
+
     def __init__(self, app):
 
         permissions_cfg = app.config.get('RELENGAPI_PERMISSIONS', {})
@@ -35,6 +94,10 @@ class LdapGroupsAuthz(base.BaseAuthz):
         self.user_base = permissions_cfg['user_base']
         self.group_base = permissions_cfg['group_base']
         self.debug = permissions_cfg.get('debug')
+        self.cache_config = permissions_cfg.get('cache')
+        self.cache_ttl = permissions_cfg.get('cache_ttl', 300)
+        self.pool = LdapConnectionPool(self.uri, self.login_dn, self.login_password,
+                                       size=permissions_cfg.get('pool_size', 4))
 
         self.logger = structlog.get_logger()
 
@@ -54,38 +117,124 @@ class LdapGroupsAuthz(base.BaseAuthz):
         else:
             return None
 
-    def get_user_groups(self, mail):
+    def get_users_permissions(self, emails):
+        return dict((email, None if groups is None else self._groups_to_perms(groups))
+                    for email, groups in self.get_users_groups(emails).iteritems())
+
+    def get_users_groups(self, mails):
+        """Get the groups for each of the given users, as a dictionary keyed
+        by mail, with None for users that do not exist.  Users that are not
+        cached are looked up with a pooled LDAP connection, using three
+        searches for each batch of users."""
+        mails = sorted(set(mails))
+        groups = self._get_cached_groups(mails)
+        missing = [mail for mail in mails if mail not in groups]
+        if not missing:
+            return groups
         if self.debug:
-            self.logger.debug('Making LDAP query for %s', mail)
+            self.logger.debug('Making batched LDAP queries for %d users', len(missing))
+
         try:
-            l = ldap.initialize(self.uri)
-            l.simple_bind_s(self.login_dn, self.login_password)
-            groups = []
-
-            # convert mail to DN and search for groupOfNames with member=$dn
-            people = l.search_s(self.user_base, ldap.SCOPE_SUBTREE,
-                                '(&(objectClass=inetOrgPerson)(mail=%s))' % (mail,), [])
-            if not people or len(people) != 1:
-                return None
-            user_dn = people[0][0]
+            found = self._search_with_retry(missing)
+        except ldap.LDAPError:
+            self.logger.exception("While connecting to the LDAP server")
+            # failures are not cached
+            groups.update((mail, None) for mail in missing)
+            return groups
+
+        self._set_cached_groups(found)
+        groups.update(found)
+        return groups
+
+    def _search_with_retry(self, mails):
+        try:
+            return self._search(mails)
+        except ldap.SERVER_DOWN:
+            # the server may have closed idle connections, so discard them and
+            # try once more with a new connection
+            self.pool.clear()
+            return self._search(mails)
+
+    def _search(self, mails):
+        groups = {}
+        with self.pool.connection() as l:
+            for i in xrange(0, len(mails), self.batch_size):
+                groups.update(self._search_users_groups(l, mails[i:i + self.batch_size]))
+        return groups
+
+    def _cache_key(self, mail):
+        # mails may contain characters that are not valid in keys
+        return 'ldap-groups:' + hashlib.sha1(mail.lower().encode('utf-8')).hexdigest()
+
+    def _get_cached_groups(self, mails):
+        if not self.cache_config:
+            return {}
+        keys = dict((self._cache_key(mail), mail) for mail in mails)
+        with current_app.memcached.cache(self.cache_config) as mc:
+            cached = mc.get_multi(keys.keys())
+        return dict((keys[key], json.loads(value)) for key, value in cached.iteritems())
+
+    def _set_cached_groups(self, groups):
+        if not self.cache_config:
+            return
+        data = dict((self._cache_key(mail), json.dumps(g))
+                    for mail, g in groups.iteritems())
+        with current_app.memcached.cache(self.cache_config) as mc:
+            mc.set_multi(data, time=self.cache_ttl)
+
+    def _search_users_groups(self, l, mails):
+        def any_of(attr, values):
+            return '(|%s)' % ''.join('(%s=%s)' % (attr, ldap.filter.escape_filter_chars(v))
+                                     for v in values)
+        # LDAP matches these attributes case-insensitively, so do the same
+        # when matching results to users
+        by_lower = dict((mail.lower(), mail) for mail in mails)
+
+        # convert mails to DNs, ignoring any mail without exactly one match
+        dns = {}
+        people = l.search_s(self.user_base, ldap.SCOPE_SUBTREE,
+                            '(&(objectClass=inetOrgPerson)%s)' % any_of('mail', mails),
+                            ['mail'])
+        for dn, attrs in people:
+            for mail in set(by_lower.get(m.lower()) for m in attrs.get('mail', [])):
+                if mail:
+                    dns.setdefault(mail, []).append(dn)
+        user_dns = dict((mail, dn[0]) for mail, dn in dns.iteritems() if len(dn) == 1)
+        groups = dict((mail, set()) for mail in user_dns)
+
+        if user_dns:
+            dn_to_mail = dict((dn.lower(), mail) for mail, dn in user_dns.iteritems())
             result = l.search_s(self.group_base, ldap.SCOPE_SUBTREE,
-                                '(&(objectClass=groupOfNames)(member=%s))' % user_dn, ['cn'])
-            for glist in [g[1]['cn'] for g in result]:
-                groups.extend(glist)
+                                '(&(objectClass=groupOfNames)%s)' % any_of(
+                                    'member', user_dns.values()),
+                                ['cn', 'member'])
+            for _, attrs in result:
+                for member in attrs.get('member', []):
+                    mail = dn_to_mail.get(member.lower())
+                    if mail:
+                        groups[mail].update(attrs['cn'])
 
             # Mozilla uses some POSIX groups, which have a different class.
-            # The scm_level_N groups also have the unusual trait of using the mail
-            # in the memberUid attribute; other POSIX groups use the actual uid,
-            # and won't be matched by this clause
+            # The scm_level_N groups also have the unusual trait of using the
+            # mail in the memberUid attribute; other POSIX groups use the
+            # actual uid, and won't be matched by this clause
             result = l.search_s(self.group_base, ldap.SCOPE_SUBTREE,
-                                '(&(objectClass=posixGroup)(memberUid=%s))' % mail, ['cn'])
-            for glist in [g[1]['cn'] for g in result]:
-                groups.extend(glist)
+                                '(&(objectClass=posixGroup)%s)' % any_of(
+                                    'memberUid', user_dns.keys()),
+                                ['cn', 'memberUid'])
+            for _, attrs in result:
+                for uid in attrs.get('memberUid', []):
+                    mail = by_lower.get(uid.lower())
+                    if mail in groups:
+                        groups[mail].update(attrs['cn'])
+
+        return dict((mail, list(groups[mail]) if mail in groups else None)
+                    for mail in mails)
 
-            return list(set(groups))
-        except ldap.LDAPError:
-            self.logger.exception("While connecting to the LDAP server")
-            return None
+    def get_user_groups(self, mail):
+        if self.debug:
+            self.logger.debug('Making LDAP query for %s', mail)
+        return self.get_users_groups([mail])[mail]
 
     def on_permissions_stale(self, sender, user, permissions):
         groups = self.get_user_groups(user.authenticated_email)
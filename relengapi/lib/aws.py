@@ -4,9 +4,11 @@
 
 from __future__ import absolute_import
 
+import httplib
 import importlib
 import json
 import logging
+import socket
 import threading
 import time
 
@@ -14,36 +16,152 @@ import boto
 import structlog
 import wsme.rest.json
 from boto.sqs import message as sqs_message
+from boto.sqs import queue as sqs_queue
+from flask import current_app
+from flask import g
+from flask import has_app_context
+
+from relengapi.lib import pool
 
 logger = structlog.get_logger()
 
+# defaults for the bounds on each pool of connections
+DEFAULT_POOL_SIZE = 10
+DEFAULT_POOL_TIMEOUT = 10.0
+DEFAULT_MAX_CONNECTION_AGE = 3600
+
+# an app context torn down by one of these discards its connections, rather
+# than returning them to their pools
+NETWORK_ERRORS = (socket.error, httplib.HTTPException)
+
 
 class _StopListening(Exception):
 
     pass
 
 
+# raised when no connection becomes available within the pool timeout
+PoolTimeout = pool.PoolTimeout
+
+
+def _pool_for(connect, size, timeout, max_age):
+    """Return a pool of boto connections to one service in one region.  Each
+    boto connection keeps its HTTP connections alive for reuse, so the pool
+    reuses the warmest.  Connections older than `max_age` seconds are
+    discarded, so that they pick up new credentials and DNS."""
+    return pool.Pool(connect, size, timeout,
+                     lambda created, checked_in: created + max_age <= time.time(),
+                     description='AWS connection')
+
+
+class _Connections(object):
+
+    "The connections held by the app contexts on one thread, or by one thread"
+
+    def __init__(self):
+        self.connections = {}  # key: connection
+
+
 class AWS(object):
 
     def __init__(self, config):
         self.config = config
-        self._connections = {}
-        self._queues = {}
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._local = threading.local()
         self._listeners = []
+        self._queue_urls = {}
 
     def connect_to(self, service_name, region_name):
+        """Get a connection to the given service in the given region.
+
+        Within an app context, the connection is checked out of a pool and
+        used only by that context until it is torn down.  App contexts
+        nested on the same thread share the outermost context's connections,
+        so a thread never holds more than one connection from each pool, and
+        cannot wait on the pool for a connection that it holds itself.
+        Elsewhere, as in the SQS listener threads, each thread has its own
+        connection."""
         key = service_name, region_name
-        if key in self._connections:
-            return self._connections[key]
+        held = self._held()
+        if key in held.connections:
+            return held.connections[key]
+
+        if self._in_app_context():
+            conn = self._pool(key).checkout()
+        else:
+            conn = self._connect(service_name, region_name)
+        held.connections[key] = conn
+        return conn
 
+    def _connect(self, service_name, region_name):
         # handle special cases
         try:
             fn = getattr(self, 'connect_to_' + service_name)
         except AttributeError:
             fn = self.connect_to_default
-        conn = fn(service_name, region_name)
-        self._connections[key] = conn
-        return conn
+        return fn(service_name, region_name)
+
+    def _pool(self, key):
+        # pools are never removed, so only their creation needs the lock
+        try:
+            return self._pools[key]
+        except KeyError:
+            pass
+        with self._pools_lock:
+            if key not in self._pools:
+                self._pools[key] = _pool_for(
+                    lambda: self._connect(*key),
+                    self.config.get('pool_size', DEFAULT_POOL_SIZE),
+                    self.config.get('pool_timeout', DEFAULT_POOL_TIMEOUT),
+                    self.config.get('max_connection_age',
+                                    DEFAULT_MAX_CONNECTION_AGE))
+            return self._pools[key]
+
+    def _in_app_context(self):
+        # only this app's contexts return connections when torn down
+        return has_app_context() and getattr(current_app, 'aws', None) is self
+
+    def _held(self):
+        if self._in_app_context():
+            try:
+                return g.aws_connections
+            except AttributeError:
+                pass
+            # the context that first uses a connection on this thread
+            # returns the connections when it is torn down
+            held = getattr(self._local, 'context_held', None)
+            if held is None:
+                held = self._local.context_held = _Connections()
+                g.aws_release_connections = True
+            g.aws_connections = held
+            return held
+        try:
+            return self._local.held
+        except AttributeError:
+            held = self._local.held = _Connections()
+            return held
+
+    def release_connections(self, exc=None):
+        """Return the current app context's connections to their pools;
+        this is called automatically when the app context is torn down."""
+        held = getattr(g, 'aws_connections', None)
+        if held is None:
+            return
+        del g.aws_connections
+        if not getattr(g, 'aws_release_connections', False):
+            return
+        del g.aws_release_connections
+        del self._local.context_held
+        healthy = not isinstance(exc, NETWORK_ERRORS)
+        for key, conn in held.connections.iteritems():
+            self._pools[key].checkin(conn, healthy)
+
+    def pool_status(self):
+        """Return a dictionary of pool statistics, keyed by
+        "service/region"."""
+        return {'%s/%s' % key: pool.status()
+                for key, pool in self._pools.items()}
 
     def connect_to_default(self, service_name, region_name):
         # for the service, import 'boto.$service'
@@ -70,16 +188,19 @@ class AWS(object):
                                          aws_secret_access_key=self.config.get('secret_access_key'))
 
     def get_sqs_queue(self, region_name, queue_name):
+        # queues are bound to a connection, but their URLs are not, so only
+        # the URL is cached, and the first lookup needs a round-trip
         key = (region_name, queue_name)
-        if key in self._queues:
-            return self._queues[key]
-
         sqs = self.connect_to('sqs', region_name)
+        url = self._queue_urls.get(key)
+        if url:
+            return sqs_queue.Queue(sqs, url)
+
         queue = sqs.get_queue(queue_name)
         if not queue:
             raise RuntimeError("no such queue %r in %s" %
                                (queue_name, region_name))
-        self._queues[key] = queue
+        self._queue_urls[key] = queue.url
         return queue
 
     def sqs_write(self, region_name, queue_name, body):
@@ -144,6 +265,7 @@ class AWS(object):
 
 def init_app(app):
     app.aws = AWS(app.config.get('AWS', {}))
+    app.teardown_appcontext(app.aws.release_connections)
     # disable boto debug logging unless DEBUG = True
     if not app.debug:
         logging.getLogger('boto').setLevel(logging.INFO)
@@ -4,14 +4,25 @@
 
 from __future__ import absolute_import
 
+import collections
+import hashlib
 import logging
 import os
+import random
+import re
 import threading
+import time
 
 import pytz
 import sqlalchemy as sa
 import structlog
+import wrapt
 from flask import current_app
+from flask import g
+from flask import has_app_context
+from flask import has_request_context
+from flask import request
+from flask import session as flask_session
 from sqlalchemy import event
 from sqlalchemy import exc
 from sqlalchemy import orm
@@ -19,9 +30,8 @@ from sqlalchemy import types
 from sqlalchemy.engine import url
 from sqlalchemy.ext import declarative
 from sqlalchemy.orm import scoping
-from sqlalchemy.pool import Pool
-
-from relengapi.util import synchronized
+from sqlalchemy.sql.selectable import CompoundSelect
+from sqlalchemy.sql.selectable import Select
 
 logger = structlog.get_logger()
 
@@ -47,6 +57,172 @@ def declarative_base(dbname):
         return b
 
 
+# options that may be given, along with 'uri', for each database in
+# SQLALCHEMY_DATABASE_URIS, and passed to sa.create_engine
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+# by default, connections idle for longer than this many seconds are tested
+# before they are used
+DEFAULT_PING_IDLE = 30
+
+
+# statements taking at least this many seconds are logged
+DEFAULT_SLOW_QUERY_TIME = 1.0
+
+# requests running the same statement at least this many times are flagged
+# as possible N+1 query patterns
+DEFAULT_REPEATED_QUERY_COUNT = 10
+
+_normalize_res = [
+    # string and numeric literals
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    # bind parameters in other paramstyles
+    (re.compile(r'%\(\w+\)s|%s|(?<!:):\w+'), '?'),
+    (re.compile(r'\s+'), ' '),
+    # lists of values, as for IN
+    (re.compile(r'\?(?: ?, ?\?)+'), '?, ...'),
+]
+_normalized = {}
+
+
+def normalize_sql(statement):
+    """Return the given SQL statement with its literals and parameters
+    replaced by ``?``, so that different executions of the same query look
+    the same"""
+    try:
+        return _normalized[statement]
+    except KeyError:
+        pass
+    normalized = statement
+    for regexp, replacement in _normalize_res:
+        normalized = regexp.sub(replacement, normalized)
+    normalized = normalized.strip()
+    # only a limited number of distinct statements are remembered
+    if len(_normalized) >= 1000:
+        _normalized.clear()
+    _normalized[statement] = normalized
+    return normalized
+
+
+class QueryStats(object):
+
+    """Database queries made while handling one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        # normalized statement -> number of executions
+        self.statements = collections.Counter()
+
+    def add(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.statements[statement] += 1
+
+
+class EndpointQueryStats(object):
+
+    """Database queries made by all requests to one endpoint"""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.time = 0.0
+        self.max_queries = 0
+        # normalized statement -> number of requests that repeated it
+        self.repeated = collections.Counter()
+
+
+class PoolStats(object):
+
+    """Counts of connection pool events for one engine"""
+
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.pings = 0
+        self.ping_failures = 0
+
+
+@wrapt.decorator
+def replica_reads(wrapped, instance, args, kwargs):
+    """Decorate a view function so that, for the rest of the request, its
+    queries are sent to the read replicas of any database that has them."""
+    g.db_replica_reads = True
+    return wrapped(*args, **kwargs)
+
+
+def _replica_reads_allowed(dbname, sticky, sticky_cache):
+    if not has_request_context() or not getattr(g, 'db_replica_reads', False):
+        return False
+    if sticky:
+        return time.time() - _last_write(dbname, sticky_cache) >= sticky
+    return True
+
+
+def _last_write(dbname, sticky_cache):
+    """Return the time of the current client's last write to the given
+    database, from its session cookie or, for clients which send credentials
+    in a header, from `sticky_cache`"""
+    try:
+        last_writes = g.db_last_writes
+    except AttributeError:
+        last_writes = g.db_last_writes = {}
+    if dbname not in last_writes:
+        last_write = flask_session.get('db_writes', {}).get(dbname, 0)
+        key = _credentials_key(dbname)
+        if sticky_cache and key:
+            with current_app.memcached.cache(sticky_cache) as mc:
+                last_write = max(last_write, mc.get(key) or 0)
+        last_writes[dbname] = last_write
+    return last_writes[dbname]
+
+
+def _credentials_key(dbname):
+    """Return a memcached key for the given database and the credentials
+    in the current request's headers, or None if there are none.  Clients
+    using tokens do not keep cookies, so they are identified this way."""
+    creds = request.headers.get('Authorization') or \
+        request.headers.get('Authentication')
+    if not creds:
+        return None
+    if isinstance(creds, unicode):
+        creds = creds.encode('utf-8')
+    return 'db-writes:' + hashlib.sha1(dbname + ':' + creds).hexdigest()
+
+
+class RoutingSession(orm.Session):
+
+    """
+    A session for a database with read replicas.  Within views decorated with
+    `replica_reads`, SELECTs go to one of the replicas, chosen at random.
+    Everything else goes to the primary engine, the session's bind, as do all
+    reads once this session has executed anything else, or (if `sticky` is
+    set) for `sticky` seconds after the client's last write.
+    """
+
+    def __init__(self, dbname, replicas, sticky, sticky_cache=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.dbname = dbname
+        self.replicas = replicas
+        self.sticky = sticky
+        self.sticky_cache = sticky_cache
+        self.replica = None
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        # anything but a SELECT, such as a textual statement, may write
+        if self._flushing or not isinstance(clause, (Select, CompoundSelect)):
+            self.wrote = True
+        elif not self.wrote and _replica_reads_allowed(
+                self.dbname, self.sticky, self.sticky_cache):
+            if self.replica is None:
+                self.replica = random.choice(self.replicas)
+            return self.replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
 class Alchemies(object):
 
     """
@@ -56,21 +232,52 @@ class Alchemies(object):
 
     def __init__(self, app):
         self.app = app
+        # engines and sessions are created once, under this lock, and then
+        # looked up without it
+        self._lock = threading.RLock()
         self._engines = {}
+        self._replicas = {}
         self._sessions = {}
+        # engine and PoolStats, keyed by database name, or by database name
+        # and replica number
+        self._pools = {}
+        # EndpointQueryStats, keyed by endpoint
+        self._query_stats = {}
+        self._query_stats_lock = threading.Lock()
+        self.slow_query_time = app.config.get(
+            'SQLALCHEMY_SLOW_QUERY_TIME', DEFAULT_SLOW_QUERY_TIME)
+        self.repeated_query_count = app.config.get(
+            'SQLALCHEMY_REPEATED_QUERY_COUNT', DEFAULT_REPEATED_QUERY_COUNT)
 
-        # destroy sessions after each Flask request
+        # Set the log level for db logs
+        sqla_logger = logging.getLogger('sqlalchemy.engine')
+        if app.config.get('SQLALCHEMY_DB_LOG', False):
+            sqla_logger.setLevel(logging.INFO)
+        else:
+            sqla_logger.setLevel(logging.WARNING)
+
+        # remember when users write to databases with sticky replicas
+        @app.after_request
+        def after_request(response):
+            self._record_writes()
+            return response
+
+        # summarize queries and destroy sessions after each Flask request
         @app.teardown_request
         def teardown_request(response_or_exc):
+            self._record_queries()
             self.flush_sessions()
 
-    def _get_db_config(self, dbname):
+    def _get_db_options(self, dbname):
         uris = self.app.config.get('SQLALCHEMY_DATABASE_URIS')
         if uris is not None:
             if dbname not in uris:
                 raise KeyError(
                     "No configuration for database '{}'".format(dbname))
-            return uris[dbname]
+            options = uris[dbname]
+            if isinstance(options, dict):
+                return options
+            return {'uri': options}
         else:
             # apply a universal default for all databases; this isn't the
             # optimal location, but works well for the developer who just
@@ -80,35 +287,63 @@ class Alchemies(object):
             uri = 'sqlite:///{}'.format(
                 os.path.join(dir, '{}.db'.format(dbname)))
             logger.warning("Using URI {} for database {}".format(uri, dbname))
-            return uri
+            return {'uri': uri}
 
-    @synchronized(threading.Lock())
-    def engine(self, dbname):
-        # Set the log level for db logs
-        sqla_logger = logging.getLogger('sqlalchemy.engine')
-        if self.app.config.get('SQLALCHEMY_DB_LOG', False):
-            sqla_logger.setLevel(logging.INFO)
-        else:
-            sqla_logger.setLevel(logging.WARNING)
-
-        if dbname not in self._engines:
-            uri = self._get_db_config(dbname)
-            u = url.make_url(uri)
-            dialect = u.drivername.split('+')[0]
-
-            try:
-                create_engine = getattr(self, 'create_{}_engine'.format(dialect))
-            except AttributeError:
-                create_engine = self.create_generic_engine
+    def _get_db_config(self, dbname):
+        return self._get_db_options(dbname)['uri']
 
-            self._engines[dbname] = create_engine(u)
-        return self._engines[dbname]
+    def engine(self, dbname):
+        try:
+            return self._engines[dbname]
+        except KeyError:
+            pass
+        with self._lock:
+            if dbname not in self._engines:
+                options = self._get_db_options(dbname)
+                self._engines[dbname] = self._create_engine(
+                    dbname, options['uri'], options)
+            return self._engines[dbname]
+
+    def replica_engines(self, dbname):
+        """Return a list of engines for the read replicas configured for the
+        given database; this is usually empty"""
+        try:
+            return self._replicas[dbname]
+        except KeyError:
+            pass
+        with self._lock:
+            if dbname not in self._replicas:
+                options = self._get_db_options(dbname)
+                self._replicas[dbname] = [
+                    self._create_engine('{}/replica-{}'.format(dbname, i), uri, options)
+                    for i, uri in enumerate(options.get('replicas', []))]
+            return self._replicas[dbname]
+
+    def _create_engine(self, name, uri, options):
+        u = url.make_url(uri)
+        dialect = u.drivername.split('+')[0]
+        kwargs = dict((k, options[k]) for k in POOL_OPTIONS if k in options)
+
+        try:
+            create_engine = getattr(self, 'create_{}_engine'.format(dialect))
+        except AttributeError:
+            create_engine = self.create_generic_engine
+
+        engine = create_engine(u, **kwargs)
+        # the server can't go away from under an SQLite database
+        ping = options.get('ping', 'never' if dialect == 'sqlite' else 'idle')
+        stats = PoolStats()
+        _listen_pool(engine, stats, ping,
+                     options.get('ping_idle', DEFAULT_PING_IDLE))
+        _listen_queries(engine, name, self.slow_query_time)
+        self._pools[name] = (engine, stats)
+        return engine
 
-    def create_generic_engine(self, url):
-        return sa.create_engine(url)
+    def create_generic_engine(self, url, **kwargs):
+        return sa.create_engine(url, **kwargs)
 
-    def create_sqlite_engine(self, url):
-        engine = sa.create_engine(url)
+    def create_sqlite_engine(self, url, **kwargs):
+        engine = sa.create_engine(url, **kwargs)
 
         # Enable checking of foreign key constraints by setting
         # a pragma on each DB connection
@@ -118,10 +353,10 @@ class Alchemies(object):
 
         return engine
 
-    def create_mysql_engine(self, url):
+    def create_mysql_engine(self, url, **kwargs):
         url.query['use_unicode'] = "True"
         url.query['charset'] = "utf8"
-        engine = sa.create_engine(url)
+        engine = sa.create_engine(url, **kwargs)
 
         @event.listens_for(engine, "connect")
         def foreign_keys_on(dbapi_con, con_record):
@@ -142,19 +377,97 @@ class Alchemies(object):
 
         return engine
 
-    @synchronized(threading.Lock())
     def session(self, dbname):
+        try:
+            return self._sessions[dbname]
+        except KeyError:
+            pass
         # set up a session for each db; this uses scoped_session (based on the
         # thread ID) to ensure only one session per thread
-        if dbname not in self._sessions:
-            Session = orm.sessionmaker(bind=self.engine(dbname))
-            self._sessions[dbname] = scoping.scoped_session(Session)
-        return self._sessions[dbname]
+        with self._lock:
+            if dbname not in self._sessions:
+                replicas = self.replica_engines(dbname)
+                if replicas:
+                    options = self._get_db_options(dbname)
+                    Session = orm.sessionmaker(
+                        bind=self.engine(dbname), class_=RoutingSession,
+                        dbname=dbname, replicas=replicas,
+                        sticky=options.get('replica_sticky', 0),
+                        sticky_cache=options.get('replica_sticky_cache'))
+                else:
+                    Session = orm.sessionmaker(bind=self.engine(dbname))
+                self._sessions[dbname] = scoping.scoped_session(Session)
+            return self._sessions[dbname]
+
+    def _record_writes(self):
+        for dbname, scoped in self._sessions.items():
+            if not scoped.registry.has():
+                continue
+            session = scoped()
+            if isinstance(session, RoutingSession) and session.sticky and session.wrote:
+                now = int(time.time())
+                writes = dict(flask_session.get('db_writes', {}))
+                writes[dbname] = now
+                flask_session['db_writes'] = writes
+                key = _credentials_key(dbname)
+                if session.sticky_cache and key:
+                    with current_app.memcached.cache(session.sticky_cache) as mc:
+                        mc.set(key, now, time=session.sticky)
 
     def flush_sessions(self):
+        """Close and discard the current thread's sessions.  The scoped
+        session registries themselves are kept, so other threads' sessions
+        are unaffected, and the next request reuses the registries."""
         for s in self._sessions.values():
             s.remove()
-        self._sessions = {}
+
+    def _record_queries(self):
+        stats = getattr(g, 'db_query_stats', None)
+        if stats is None:
+            return
+        del g.db_query_stats
+        endpoint = request.endpoint or '(none)'
+
+        repeated = [stmt for stmt, count in stats.statements.iteritems()
+                    if count >= self.repeated_query_count]
+        for stmt in repeated:
+            logger.warning("possible N+1 query pattern", endpoint=endpoint,
+                           statement=stmt, count=stats.statements[stmt])
+        logger.debug("database queries", endpoint=endpoint,
+                     queries=stats.count, db_time=round(stats.time, 3))
+
+        with self._query_stats_lock:
+            ep = self._query_stats.get(endpoint)
+            if not ep:
+                ep = self._query_stats[endpoint] = EndpointQueryStats()
+            ep.requests += 1
+            ep.queries += stats.count
+            ep.time += stats.time
+            ep.max_queries = max(ep.max_queries, stats.count)
+            ep.repeated.update(repeated)
+
+    def query_status(self):
+        """Return a dictionary describing the database queries made by the
+        requests to each endpoint so far, keyed by endpoint"""
+        with self._query_stats_lock:
+            return dict((endpoint, dict(vars(ep), repeated=dict(ep.repeated)))
+                        for endpoint, ep in self._query_stats.iteritems())
+
+    def pool_status(self):
+        """Return a dictionary describing the connection pool of each engine
+        created so far, keyed by database name (with a replica number, for
+        replicas)"""
+        status = {}
+        for name, (engine, stats) in self._pools.items():
+            pool = engine.pool
+            info = dict(pool_class=type(pool).__name__)
+            # only some pool classes can count their connections
+            for count in 'size', 'checkedin', 'checkedout', 'overflow':
+                method = getattr(pool, count, None)
+                info[count] = method() if callable(method) else None
+            info.update(vars(stats))
+            status[name] = info
+        return status
 
     @property
     def database_names(self):
@@ -164,28 +477,73 @@ class Alchemies(object):
     def metadata(self):
         return dict((k, v.metadata) for k, v in _declarative_bases.iteritems())
 
-# Pessimistically try *all* connections on checkout, in case the server has
-# gone away.  This will apply to SQLite DBs too, where the server can't go
-# away, but that's OK - SQLite is only used in development
-#
-# from
-# http://docs.sqlalchemy.org/en/rel_0_9/core/pooling.html#disconnect-handling-pessimistic
-
 
-@event.listens_for(Pool, "checkout")
-def ping_connection(dbapi_connection, connection_record, connection_proxy):
-    cursor = dbapi_connection.cursor()
-    try:
-        cursor.execute("SELECT 1")
-    except Exception:  # pragma: no cover
-        # optional - dispose the whole pool
-        # instead of invalidating one at a time
-        connection_proxy._pool.dispose()
-
-        # raise DisconnectionError - pool will try
-        # connecting again up to three times before raising.
-        raise exc.DisconnectionError()
-    cursor.close()
+def _listen_pool(engine, stats, ping, ping_idle):
+    """Count pool events for `engine` in `stats`, and test connections on
+    checkout: always, never, or (for 'idle') only those that have been
+    unused for more than `ping_idle` seconds, in case the server has gone
+    away in the interim."""
+    if ping not in ('always', 'idle', 'never'):
+        raise RuntimeError("invalid database ping setting {!r}".format(ping))
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        stats.connects += 1
+        connection_record.info['last_used'] = time.time()
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        connection_record.info['last_used'] = time.time()
+
+    # from
+    # http://docs.sqlalchemy.org/en/rel_0_9/core/pooling.html#disconnect-handling-pessimistic
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.checkouts += 1
+        if ping == 'never':
+            return
+        if ping == 'idle':
+            idle = time.time() - connection_record.info.get('last_used', 0)
+            if idle <= ping_idle:
+                return
+        stats.pings += 1
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        except Exception:
+            stats.ping_failures += 1
+            # optional - dispose the whole pool
+            # instead of invalidating one at a time
+            connection_proxy._pool.dispose()
+
+            # raise DisconnectionError - pool will try
+            # connecting again up to three times before raising.
+            raise exc.DisconnectionError()
+        cursor.close()
+
+
+def _listen_queries(engine, name, slow_query_time):
+    """Time each statement executed by `engine`, logging slow statements and
+    adding each to the current request's QueryStats"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info['query_start'] = time.time()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = time.time() - conn.info.pop('query_start')
+        statement = normalize_sql(statement)
+        if elapsed >= slow_query_time:
+            logger.warning("slow query", database=name,
+                           duration=round(elapsed, 3), statement=statement)
+        if has_app_context():
+            stats = getattr(g, 'db_query_stats', None)
+            if stats is None:
+                stats = g.db_query_stats = QueryStats()
+            stats.add(statement, elapsed)
 
 
 def make_db(app):
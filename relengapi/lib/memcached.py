@@ -4,7 +4,12 @@
 
 from __future__ import absolute_import
 
+import collections
 import contextlib
+import hashlib
+import json
+import math
+import random
 import socket
 import threading
 import time
@@ -13,15 +18,41 @@ import urlparse
 import elasticache_auto_discovery
 import memcache
 import structlog
+import wsme.rest.json
+from flask import current_app
+from flask import g
+from flask import has_app_context
+
+from relengapi.lib import pool
 
 logger = structlog.get_logger()
 
 
+# defaults for the bounds on each pool of memcached clients
+DEFAULT_POOL_SIZE = 16
+DEFAULT_POOL_TIMEOUT = 5.0
+DEFAULT_IDLE_TIMEOUT = 300
+
+
+# raised when no client becomes available within the pool timeout
+PoolTimeout = pool.PoolTimeout
+
+
+# a client with no servers, which misses on every get and fails every set,
+# just as a client does when its servers are unreachable
+_unavailable = memcache.Client([])
+
+
 class BaseCacheFinder(object):
 
-    def __init__(self):
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 pool_timeout=DEFAULT_POOL_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
         self.lock = threading.Lock()
         self._values = {}  # format is up to the subclass
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.idle_timeout = idle_timeout
 
     def acquire_cache(self, config):
         '''Lock and return a cache client with the given config.  Returns a
@@ -30,6 +61,10 @@ class BaseCacheFinder(object):
     def release_cache(self, cookie):
         '''Release the cache client with the given cookie'''
 
+    def pool_status(self):
+        '''Return a dictionary of pool statistics, keyed by config'''
+        return {}
+
     def _value_for_config(self, config):
         '''Make a new value for self._get; called with the finder lock
         held.'''
@@ -38,6 +73,11 @@ class BaseCacheFinder(object):
         '''Get, making if necessary, a new value for the given name and
         configuration.  If `config` is omitted, then the value must already
         exist.'''
+        # values are never removed, so only their creation needs the lock
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
         with self.lock:
             try:
                 return self._values[name]
@@ -65,44 +105,50 @@ class MockCacheFinder(BaseCacheFinder):
         lock.release()
 
 
+def _pool_for(make_wrapper, size, timeout, idle_timeout):
+    """Return a pool of client wrappers for a single configuration.  Wrappers
+    idle for `idle_timeout` seconds are closed, so that the connections of
+    a quiet pool do not linger."""
+    return pool.Pool(make_wrapper, size, timeout,
+                     lambda created, checked_in: checked_in + idle_timeout < time.time(),
+                     description='memcached client')
+
+
 class MemcachedCacheFinder(BaseCacheFinder):
 
     def _value_for_config(self, config):
-        # an empty list of wrappers; acquire_cache will add wrappers to
-        # this list as necessary
-        return []
+        return _pool_for(self._make_wrapper_factory(config),
+                         self.pool_size, self.pool_timeout, self.idle_timeout)
+
+    def _make_wrapper_factory(self, config):
+        '''Return a function that makes a new client wrapper for config'''
+        return lambda: self.client_wrapper_class(config)
 
     def acquire_cache(self, config):
-        name = str(config)
-        wrappers = self._get(name, config)
-        # find an unlocked cache (again under the finder lock)
-        with self.lock:
-            for i in xrange(len(wrappers)):
-                if wrappers[i].lock.acquire(False):
-                    cookie = name, i
-                    return wrappers[i].checkout(), cookie
-            # or make a new one (note that these are never collected)
-            else:
-                cookie = name, len(wrappers)
-                wrapper = self.client_wrapper_class(config)
-                wrappers.append(wrapper)
-                wrapper.lock.acquire()
-                return wrapper.checkout(), cookie
+        pool = self._get(str(config), config)
+        wrapper = pool.checkout()
+        return wrapper.checkout(), (pool, wrapper)
 
     def release_cache(self, cookie):
-        name, i = cookie
-        wrappers = self._get(name)
-        wrappers[i].lock.release()
+        pool, wrapper = cookie
+        pool.checkin(wrapper)
+
+    def pool_status(self):
+        return {name: pool.status() for name, pool in self._values.items()}
 
 
 class ClientWrapper(object):
 
     def __init__(self, config):
-        self.lock = threading.Lock()
+        pass
 
     def checkout(self):
         '''Get the actual memcached.Client object'''
 
+    def close(self):
+        '''Close the client's connections, as it will not be used again'''
+        self.client.disconnect_all()
+
 
 class DirectCacheClientWrapper(ClientWrapper):
 
@@ -119,31 +165,65 @@ class DirectCacheFinder(MemcachedCacheFinder):
     client_wrapper_class = DirectCacheClientWrapper
 
 
-class ElastiCacheClientWrapper(ClientWrapper):
+class ElastiCacheDiscovery(object):
+
+    """Discover the memcached servers in an ElastiCache cluster in a
+    background thread, every POLL_INTERVAL seconds (or RETRY_INTERVAL
+    seconds until discovery first succeeds).  Each round publishes a new
+    ``servers`` list, replacing the attribute in a single assignment, so
+    readers never block and never see a partial list.  Until the first
+    round completes, the list is empty and every cache lookup misses."""
 
     POLL_INTERVAL = 600  # check for config updates every ten minutes
+    RETRY_INTERVAL = 10
+    TIMEOUT = 5.0
 
     def __init__(self, config):
-        super(ElastiCacheClientWrapper, self).__init__(config)
         self.elasticache_config = config
+        self.servers = []
         self.last_memcache_config = None
-        self.last_poll = time.time()
-        memcache_config = self.get_memcache_config()
-        self.client = memcache.Client(memcache_config)
+        self.ready = threading.Event()  # set after the first round
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='elasticache-discovery')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Unexpected error discovering ElastiCache '
+                                 'servers for %s' % self.elasticache_config)
+            self.ready.set()
+            interval = self.POLL_INTERVAL
+            if self.last_memcache_config is None:
+                interval = self.RETRY_INTERVAL
+            self._stop.wait(interval)
+
+    def refresh(self):
+        # always publish a new list, even if unchanged, as setting the
+        # servers on a client has the side-effect of marking dead servers
+        # as live again
+        self.servers = list(self.get_memcache_config())
 
     def get_memcache_config(self):
-        '''Try to get the config from Amazon in a short time.  If this
-        fails, fall back to the existing config, or if there is none,
-        to a dummy connection to localhost'''
-        have_config = self.last_memcache_config is not None
-        timeout = 0.5 if have_config else 5.0
+        '''Try to get the config from Amazon.  If this fails, fall back to
+        the existing config, or if there is none, to a dummy connection to
+        localhost'''
         try:
             discovered = elasticache_auto_discovery.discover(
-                self.elasticache_config, time_to_timeout=timeout)
+                self.elasticache_config, time_to_timeout=self.TIMEOUT)
         except socket.error:
             logger.warning('Could not fetch ElastiCache configuration for %s'
                            % self.elasticache_config, exc_info=True)
-            if have_config:
+            if self.last_memcache_config is not None:
                 return self.last_memcache_config
             # return a dummy value
             logger.warning('No existing ElastiCache configuration for %s; '
@@ -155,13 +235,22 @@ class ElastiCacheClientWrapper(ClientWrapper):
         self.last_memcache_config = memcache_config
         return memcache_config
 
+
+class ElastiCacheClientWrapper(ClientWrapper):
+
+    def __init__(self, discovery):
+        super(ElastiCacheClientWrapper, self).__init__(discovery)
+        self.discovery = discovery
+        self.servers = discovery.servers
+        self.client = memcache.Client(self.servers)
+
     def checkout(self):
-        if self.last_poll + self.POLL_INTERVAL < time.time():
-            # reconfigure (this has the side-effect of marking dead
-            # servers as live again)
-            self.last_poll = time.time()
-            memcache_config = self.get_memcache_config()
-            self.client.set_servers(memcache_config)
+        # pick up the servers from the latest discovery round, if this
+        # client has not already; this never waits for the network
+        servers = self.discovery.servers
+        if servers is not self.servers:
+            self.servers = servers
+            self.client.set_servers(servers)
         return self.client
 
 
@@ -169,13 +258,22 @@ class ElastiCacheFinder(MemcachedCacheFinder):
 
     client_wrapper_class = ElastiCacheClientWrapper
 
+    def __init__(self, **pool_options):
+        super(ElastiCacheFinder, self).__init__(**pool_options)
+        self.discoveries = {}
+
+    def _make_wrapper_factory(self, config):
+        discovery = self.discoveries[config] = ElastiCacheDiscovery(config)
+        discovery.start()
+        return lambda: self.client_wrapper_class(discovery)
+
 
 class CacheFinder(object):
 
-    def __init__(self):
+    def __init__(self, **pool_options):
         self._finders = {
-            'direct': DirectCacheFinder(),
-            'elasticache': ElastiCacheFinder(),
+            'direct': DirectCacheFinder(**pool_options),
+            'elasticache': ElastiCacheFinder(**pool_options),
             'mock': MockCacheFinder(),
         }
 
@@ -188,12 +286,213 @@ class CacheFinder(object):
         else:
             style = 'direct'
 
-        mc, cookie = self._finders[style].acquire_cache(config)
+        start = time.time()
+        try:
+            mc, cookie = self._finders[style].acquire_cache(config)
+        except PoolTimeout:
+            # a saturated pool is treated like an unreachable server, so
+            # callers see cache misses rather than errors
+            logger.warning("no memcached client available; treating as a miss",
+                           exc_info=True)
+            mc, cookie = _unavailable, None
         try:
             yield mc
         finally:
-            self._finders[style].release_cache(cookie)
+            if cookie is not None:
+                self._finders[style].release_cache(cookie)
+            # record the time spent with a client checked out, for profiling
+            if has_app_context():
+                g.cache_uses = getattr(g, 'cache_uses', 0) + 1
+                g.cache_time = getattr(g, 'cache_time', 0.0) + time.time() - start
+
+    def pool_status(self):
+        """Return statistics for each pool of memcached clients, keyed by
+        "style:config"."""
+        return {'%s:%s' % (style, name): status
+                for style, finder in self._finders.iteritems()
+                for name, status in finder.pool_status().iteritems()}
+
+
+# hit/miss counters for each Cache namespace, in this process
+_cache_stats = collections.defaultdict(collections.Counter)
+_cache_stats_lock = threading.Lock()
+
+CACHE_COUNTERS = ('hits', 'misses', 'sets', 'deletes', 'refreshes', 'waits')
+
+
+def cache_status():
+    """Return a dictionary of counters for each Cache namespace"""
+    with _cache_stats_lock:
+        return {namespace: dict((c, counts[c]) for c in CACHE_COUNTERS)
+                for namespace, counts in _cache_stats.iteritems()}
+
+
+class Cache(object):
+
+    """A typed, namespaced view of the cache configured in the app config
+    item `config_name`.  If that is not set, nothing is cached.
+
+    Keys may be any JSON-serializable values, such as strings or tuples;
+    they are hashed, with the namespace and version, to make memcached
+    keys, so bumping the version invalidates everything cached with the
+    previous one.  Values are serialized as JSON, via the WSME type
+    `datatype` if given.  Values expire after `timeout` seconds, or never
+    if it is zero."""
+
+    # a miss in get_or_set takes a lock for this long while computing the
+    # value, and other callers wait up to LOCK_WAIT seconds for it
+    LOCK_TIMEOUT = 30
+    LOCK_WAIT = 1.0
+    LOCK_POLL = 0.05
+
+    def __init__(self, namespace, config_name, datatype=None, version=1,
+                 timeout=0):
+        self.namespace = namespace
+        self.config_name = config_name
+        self.datatype = datatype
+        self.version = version
+        self.timeout = timeout
+
+    @contextlib.contextmanager
+    def _client(self):
+        config = current_app.config.get(self.config_name)
+        if not config:
+            yield None
+        else:
+            with current_app.memcached.cache(config) as mc:
+                yield mc
+
+    def _count(self, **counts):
+        with _cache_stats_lock:
+            _cache_stats[self.namespace].update(counts)
+
+    def _key(self, key):
+        digest = hashlib.sha1(json.dumps(key)).hexdigest()
+        return '%s:%d:%s' % (self.namespace, self.version, digest)
+
+    def _dumps(self, value, timeout, delta=0):
+        # the time taken to compute the value and its expiration time are
+        # stored alongside it, for get_or_set's early refresh
+        if self.datatype is not None:
+            value = wsme.rest.json.tojson(self.datatype, value)
+        expiry = time.time() + timeout if timeout else 0
+        return json.dumps([value, delta, expiry])
+
+    def _loads(self, data):
+        value, delta, expiry = json.loads(data)
+        if self.datatype is not None:
+            value = wsme.rest.json.fromjson(self.datatype, value)
+        return value, delta, expiry
+
+    def _get_entries(self, keys, count=True):
+        mc_keys = dict((self._key(key), key) for key in keys)
+        with self._client() as mc:
+            if not mc:
+                found = {}
+            else:
+                found = mc.get_multi(mc_keys.keys())
+        if count:
+            self._count(hits=len(found), misses=len(keys) - len(found))
+        return dict((mc_keys[k], self._loads(v)) for k, v in found.iteritems())
+
+    def get(self, key):
+        """Get the value for `key`, or None if it is not cached"""
+        return self.get_multi([key]).get(key)
+
+    def get_multi(self, keys):
+        """Get the values for `keys`, returning a dictionary containing only
+        those keys which are cached"""
+        return dict((key, entry[0])
+                    for key, entry in self._get_entries(keys).iteritems())
+
+    def set(self, key, value, timeout=None):
+        """Cache `value` for `key`, for `timeout` seconds if given, or the
+        cache's default timeout otherwise"""
+        self.set_multi({key: value}, timeout=timeout)
+
+    def set_multi(self, mapping, timeout=None, _delta=0):
+        """Cache each of the values in the dictionary `mapping`"""
+        if timeout is None:
+            timeout = self.timeout
+        data = dict((self._key(key), self._dumps(value, timeout, _delta))
+                    for key, value in mapping.iteritems())
+        with self._client() as mc:
+            if not mc:
+                return
+            mc.set_multi(data, time=timeout)
+        self._count(sets=len(data))
+
+    def delete(self, key):
+        """Remove any cached value for `key`"""
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        """Remove any cached values for `keys`"""
+        mc_keys = [self._key(key) for key in keys]
+        with self._client() as mc:
+            if not mc:
+                return
+            mc.delete_multi(mc_keys)
+        self._count(deletes=len(mc_keys))
+
+    def get_or_set(self, key, fn, timeout=None, beta=1.0):
+        """Get the value for `key`, calling `fn` to compute and cache it if
+        it is not cached.
+
+        To avoid a stampede of callers all computing the same value, a
+        value with a timeout is recomputed early, with a probability that
+        rises as its expiration approaches and with the time `fn` took
+        (scaled by `beta`).  On a miss, the first caller takes a lock while
+        computing the value, and others wait briefly for it to appear."""
+        entry = self._get_entries([key]).get(key)
+        if entry:
+            value, delta, expiry = entry
+            early = delta * beta * -math.log(1.0 - random.random())
+            if not expiry or time.time() + early < expiry:
+                return value
+            # this caller refreshes early, while others (most likely) still
+            # get the cached value
+            self._count(refreshes=1)
+            return self._compute(key, fn, timeout)
+
+        lock_key = self._key(key) + ':lock'
+        with self._client() as mc:
+            if not mc:
+                return self._compute(key, fn, timeout)
+            locked = mc.add(lock_key, '1', time=self.LOCK_TIMEOUT)
+            # add also fails when no server is reachable; only wait if the
+            # lock is really held by another caller
+            held = not locked and mc.get(lock_key) is not None
+        if not locked and not held:
+            return self._compute(key, fn, timeout)
+        if held:
+            self._count(waits=1)
+            deadline = time.time() + self.LOCK_WAIT
+            while time.time() < deadline:
+                time.sleep(self.LOCK_POLL)
+                entry = self._get_entries([key], count=False).get(key)
+                if entry:
+                    return entry[0]
+            # the caller holding the lock is slow, or failed; go ahead
+            return self._compute(key, fn, timeout)
+        try:
+            return self._compute(key, fn, timeout)
+        finally:
+            with self._client() as mc:
+                mc.delete(lock_key)
+
+    def _compute(self, key, fn, timeout):
+        start = time.time()
+        value = fn()
+        self.set_multi({key: value}, timeout=timeout,
+                       _delta=time.time() - start)
+        return value
 
 
 def init_app(app):
-    app.memcached = CacheFinder()
+    app.memcached = CacheFinder(
+        pool_size=app.config.get('MEMCACHED_POOL_SIZE', DEFAULT_POOL_SIZE),
+        pool_timeout=app.config.get('MEMCACHED_POOL_TIMEOUT',
+                                    DEFAULT_POOL_TIMEOUT),
+        idle_timeout=app.config.get('MEMCACHED_IDLE_TIMEOUT',
+                                    DEFAULT_IDLE_TIMEOUT))
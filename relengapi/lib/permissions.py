@@ -4,6 +4,8 @@
 
 from __future__ import absolute_import
 
+import itertools
+
 import wrapt
 import wsme.types
 from flask import abort
@@ -12,13 +14,27 @@ from flask.ext.login import current_user
 
 from relengapi import util
 
+# bits are allocated to documented permissions in the order they are
+# documented, keyed by the permission's name so that equal permissions from
+# different registries share a bit.  They are not stable between processes.
+_bits = itertools.count()
+_masks = {}
+
 
 class Permission(tuple):
 
     def doc(self, doc):
         self.__doc__ = doc
+        key = tuple(self)
+        if key not in _masks:
+            _masks[key] = 1 << next(_bits)
         self._all[self] = self
 
+    @property
+    def _mask(self):
+        # this permission's bit in PermissionSet masks; zero until documented
+        return _masks.get(self, 0)
+
     def __getattr__(self, attr):
         new = Permission(self + (attr,))
         new._all = self._all
@@ -64,7 +80,7 @@ class Permissions(Permission):
         Verify that the current user has all of the specified permissions.
         """
         assert permissions, "Must specify at least one permission"
-        return all(perm in current_user.permissions for perm in permissions)
+        return _has(permissions, _mask(permissions))
 
     @staticmethod
     def require(*permissions):
@@ -77,10 +93,11 @@ class Permissions(Permission):
             if not perm.exists():
                 raise RuntimeError(
                     "Cannot require undocumented permission %s" % (perm,))
+        mask = _mask(permissions)
 
         @wrapt.decorator
         def req(wrapped, instance, args, kwargs):
-            if not can(*permissions):
+            if not _has(permissions, mask):
                 # redirect browsers when the user is not logged in, but
                 # just return 403 to REST clients
                 if util.is_browser() and current_user.is_anonymous:
@@ -93,6 +110,42 @@ class Permissions(Permission):
 require = Permissions.require
 can = Permissions.can
 
+
+class PermissionSet(frozenset):
+
+    """
+    An immutable set of permissions which also carries a bitmask of its
+    documented permissions, so that `can` and `require` can check several
+    permissions with a single integer operation.  If any permission in the
+    set was undocumented when the set was created, its mask is None and the
+    set is checked by membership instead.
+    """
+
+    def __new__(cls, permissions=()):
+        self = super(PermissionSet, cls).__new__(cls, permissions)
+        self.mask = _mask(self)
+        return self
+
+
+def _mask(permissions):
+    """Return the bitmask for the given permissions, or None if any of them
+    is undocumented"""
+    mask = 0
+    for perm in permissions:
+        bit = _masks.get(perm)
+        if not bit:
+            return None
+        mask |= bit
+    return mask
+
+
+def _has(permissions, mask):
+    user_permissions = current_user.permissions
+    user_mask = getattr(user_permissions, 'mask', None)
+    if mask is not None and user_mask is not None:
+        return user_mask & mask == mask
+    return all(perm in user_permissions for perm in permissions)
+
 # this object is generally accessed at `relengapi.p`, but can be accessed here
 # for imports in relengapi itself, which occur before `relengapi.p` exists.
 p = Permissions()
@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+import structlog
+
+logger = structlog.get_logger()
+
+
+class PoolTimeout(RuntimeError):
+
+    "No resource became available within the pool timeout"
+
+
+class Pool(object):
+
+    """A bounded pool of resources, such as clients or connections, each used
+    by one thread at a time.  Idle resources are kept on a free-list, most
+    recently used last, so that checkout reuses the warmest.  New resources
+    are made by calling `create`, without the pool's lock held, as that may
+    involve a network round-trip; resources leave the pool by way of their
+    `close` method.
+
+    An idle resource is discarded rather than reused once
+    `expired(created, checked_in)` is true, given the times at which the
+    resource was created and last checked in.  When `size` resources are in
+    use, checkout waits up to `timeout` seconds for one to be checked in,
+    then raises PoolTimeout.  `description` names the resources in errors
+    and logs."""
+
+    def __init__(self, create, size, timeout, expired, description='resource'):
+        self.create = create
+        self.size = size
+        self.timeout = timeout
+        self.expired = expired
+        self.description = description
+        self.cond = threading.Condition(threading.Lock())
+        self.free = collections.deque()  # (resource, created, checked in)
+        self.in_use = {}  # resource: time created
+        self.open = 0  # resources in existence, or being created
+        self.stats = dict.fromkeys(
+            ['created', 'checkouts', 'waits', 'timeouts', 'discarded'], 0)
+
+    def checkout(self):
+        deadline = None
+        with self.cond:
+            discarded = self._discard_expired()
+            while not self.free and self.open >= self.size:
+                if deadline is None:
+                    self.stats['waits'] += 1
+                    deadline = time.time() + self.timeout
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout("no %s available after %s seconds"
+                                      % (self.description, self.timeout))
+                self.cond.wait(remaining)
+            self.stats['checkouts'] += 1
+            if self.free:
+                resource, created, _ = self.free.pop()
+                self.in_use[resource] = created
+            else:
+                # reserve the slot, but create the resource without the lock
+                resource = None
+                self.open += 1
+                self.stats['created'] += 1
+        self._close(discarded)
+        if resource is not None:
+            return resource
+        created = time.time()
+        try:
+            resource = self.create()
+        except Exception:
+            with self.cond:
+                self.open -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.in_use[resource] = created
+        return resource
+
+    def checkin(self, resource, healthy=True):
+        """Return a resource to the pool; if it is not `healthy`, it is
+        discarded instead"""
+        now = time.time()
+        with self.cond:
+            created = self.in_use.pop(resource)
+            if healthy and not self.expired(created, now):
+                self.free.append((resource, created, now))
+                resource = None
+            else:
+                self.open -= 1
+                self.stats['discarded'] += 1
+            self.cond.notify()
+        if resource is not None:
+            self._close([resource])
+
+    def status(self):
+        with self.cond:
+            return dict(self.stats, size=self.size, open=self.open,
+                        idle=len(self.free), in_use=self.open - len(self.free))
+
+    def _discard_expired(self):
+        # called with the lock held; returns the discarded resources for
+        # _close.  The free-list is never longer than the pool's size.
+        if not self.free:
+            return []
+        kept, discarded = collections.deque(), []
+        for entry in self.free:
+            if self.expired(entry[1], entry[2]):
+                discarded.append(entry[0])
+            else:
+                kept.append(entry)
+        if discarded:
+            self.free = kept
+            self.open -= len(discarded)
+            self.stats['discarded'] += len(discarded)
+        return discarded
+
+    def _close(self, resources):
+        for resource in resources:
+            try:
+                resource.close()
+            except Exception:
+                logger.warning("error closing %s" % self.description,
+                               exc_info=True)
@@ -0,0 +1,211 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import collections
+import cProfile
+import hashlib
+import json
+import pstats
+import threading
+import time
+from cStringIO import StringIO
+
+import structlog
+import wsme.types
+from flask import current_app
+from flask import g
+from flask import request
+from flask.ext.login import current_user
+from werkzeug.datastructures import ImmutableMultiDict
+from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import NotFound
+
+from relengapi.lib import api
+from relengapi.lib.permissions import p
+
+logger = structlog.get_logger()
+
+p.base.profile.doc("Profile requests and see the resulting profiles")
+
+# a request is profiled if it has this header, or this query argument
+PROFILE_HEADER = 'X-RelengAPI-Profile'
+PROFILE_ARG = '_profile'
+
+# the response to a profiled request has this header, giving the request ID
+# under which the profile is stored
+PROFILE_ID_HEADER = 'X-RelengAPI-Profile-Id'
+
+# number of functions included in each profile
+PROFILE_LINES = 50
+
+# profiles are kept in memcached for this long, if RELENGAPI_PROFILE_CACHE
+# is set; otherwise the most recent profiles are kept in each process
+PROFILE_TTL = 3600
+LOCAL_PROFILES = 50
+
+
+class RequestProfile(wsme.types.Base):
+
+    "A profile of a single request"
+
+    #: The request ID, also given in the ``X-RelengAPI-Profile-Id`` header
+    request_id = unicode
+
+    #: HTTP method
+    method = unicode
+
+    #: Request path
+    path = unicode
+
+    #: Flask endpoint that handled the request
+    endpoint = unicode
+
+    #: User making the request
+    user = unicode
+
+    #: Total time, in seconds
+    elapsed = float
+
+    #: Number of database queries
+    db_queries = int
+
+    #: Time spent on those queries, in seconds
+    db_time = float
+
+    #: Number of times a memcached client was used
+    cache_uses = int
+
+    #: Time spent with a memcached client checked out, in seconds
+    cache_time = float
+
+    #: Profile of the most expensive functions, sorted by cumulative time
+    profile = unicode
+
+
+class ProfileStore(object):
+
+    """Stores profiles in memcached, if configured, or else in a small
+    per-process store"""
+
+    def __init__(self, app):
+        self.cache_config = app.config.get('RELENGAPI_PROFILE_CACHE')
+        self.lock = threading.Lock()
+        self._profiles = collections.OrderedDict()
+
+    def _key(self, request_id):
+        # request IDs may come from a client-supplied header, so they are
+        # hashed to make a valid key
+        if isinstance(request_id, unicode):
+            request_id = request_id.encode('utf-8')
+        return 'relengapi:profile:' + hashlib.sha1(request_id).hexdigest()
+
+    def put(self, profile):
+        if self.cache_config:
+            with current_app.memcached.cache(self.cache_config) as mc:
+                mc.set(self._key(profile['request_id']), json.dumps(profile),
+                       time=PROFILE_TTL)
+            return
+        with self.lock:
+            self._profiles[profile['request_id']] = profile
+            while len(self._profiles) > LOCAL_PROFILES:
+                self._profiles.popitem(last=False)
+
+    def get(self, request_id):
+        if self.cache_config:
+            with current_app.memcached.cache(self.cache_config) as mc:
+                data = mc.get(self._key(request_id))
+            return json.loads(data) if data else None
+        with self.lock:
+            return self._profiles.get(request_id)
+
+
+def _profile_requested():
+    if PROFILE_ARG in request.args:
+        # hide the argument from the view function
+        args = request.args.copy()
+        del args[PROFILE_ARG]
+        request.args = ImmutableMultiDict(args)
+        return True
+    return PROFILE_HEADER in request.headers
+
+
+def start_profile():
+    if not _profile_requested():
+        return
+    if not p.base.profile.can():
+        raise Forbidden("Profiling requires the base.profile permission")
+    g.profiler = cProfile.Profile()
+    g.profile_start = time.time()
+    g.profiler.enable()
+
+
+def finish_profile(response):
+    profiler = getattr(g, 'profiler', None)
+    if not profiler:
+        return response
+    profiler.disable()
+    del g.profiler
+    elapsed = time.time() - g.profile_start
+
+    # profiling must never cause the request itself to fail
+    try:
+        _store_profile(profiler, elapsed)
+    except Exception:
+        logger.exception("while storing profile")
+        return response
+
+    response.headers[PROFILE_ID_HEADER] = g.request_id
+    return response
+
+
+def _store_profile(profiler, elapsed):
+    out = StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+    db_stats = getattr(g, 'db_query_stats', None)
+    profile = dict(
+        request_id=g.request_id,
+        method=request.method,
+        path=request.path,
+        endpoint=request.endpoint,
+        user=str(current_user),
+        elapsed=elapsed,
+        db_queries=db_stats.count if db_stats else 0,
+        db_time=db_stats.time if db_stats else 0.0,
+        cache_uses=getattr(g, 'cache_uses', 0),
+        cache_time=getattr(g, 'cache_time', 0.0),
+        profile=out.getvalue().decode('utf-8', 'replace'))
+    current_app.profile_store.put(profile)
+    logger.info("profiled request", endpoint=request.endpoint,
+                elapsed=round(elapsed, 3), db_time=round(profile['db_time'], 3),
+                cache_time=round(profile['cache_time'], 3))
+
+
+def stop_profile(response_or_exc):
+    # a request which failed never reached finish_profile
+    profiler = getattr(g, 'profiler', None)
+    if profiler:
+        profiler.disable()
+        del g.profiler
+
+
+@p.base.profile.require()
+@api.apimethod(RequestProfile, unicode)
+def get_profile(request_id):
+    """Get the profile of the request with the given ID.  Profiles are only
+    kept for a limited time."""
+    profile = current_app.profile_store.get(request_id)
+    if not profile:
+        raise NotFound("No such profile")
+    return RequestProfile(**profile)
+
+
+def init_app(app):
+    app.profile_store = ProfileStore(app)
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(stop_profile)
+    app.route('/profiles/<request_id>')(get_profile)
@@ -0,0 +1,26 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import threading
+import time
+
+
+def in_threads(threads, fn):
+    """Run `fn` in each of `threads` threads at once, and return the elapsed
+    time, in seconds"""
+    start_barrier = threading.Event()
+
+    def target():
+        start_barrier.wait()
+        fn()
+    thds = [threading.Thread(target=target) for _ in xrange(threads)]
+    for thd in thds:
+        thd.start()
+    start = time.time()
+    start_barrier.set()
+    for thd in thds:
+        thd.join()
+    return time.time() - start
@@ -12,6 +12,8 @@ from flask import g
 from nose.tools import eq_
 
 import relengapi.app
+from relengapi.lib import memcached
+from relengapi.lib.permissions import p
 from relengapi.lib.testing.context import TestContext
 
 test_context = TestContext(reuse_app=False)
@@ -76,3 +78,75 @@ def test_versions(client):
     eq_(resp.status_code, 200, resp.data)
     versions = json.loads(resp.data)
     assert 'base' in versions['result']['blueprints'], versions
+
+
+@test_context.specialize(perms=[p.base.metrics.view], databases=['relengapi'])
+def test_db_metrics(app, client):
+    """The /metrics/db API method returns pool statistics for each engine"""
+    app.db.engine('relengapi')
+    resp = client.get('/metrics/db')
+    eq_(resp.status_code, 200, resp.data)
+    metrics = json.loads(resp.data)['result']
+    eq_(metrics['relengapi']['pool_class'], 'SingletonThreadPool')
+
+
+@test_context
+def test_db_metrics_forbidden(client):
+    """The /metrics/db API method requires permission"""
+    eq_(client.get('/metrics/db').status_code, 403)
+
+
+@test_context.specialize(perms=[p.base.metrics.view], databases=['relengapi'])
+def test_query_metrics(app, client):
+    """The /metrics/queries API method returns query statistics for each
+    endpoint"""
+    @app.route('/query')
+    def query():
+        app.db.session('relengapi').execute('SELECT 1')
+        return 'ok'
+    client.get('/query')
+    resp = client.get('/metrics/queries')
+    eq_(resp.status_code, 200, resp.data)
+    metrics = json.loads(resp.data)['result']
+    eq_(metrics['query']['queries'], 1)
+
+
+@test_context.specialize(perms=[p.base.metrics.view])
+def test_memcached_metrics(app, client):
+    """The /metrics/memcached API method returns statistics for each pool
+    of memcached clients"""
+    with mock.patch('memcache.Client', autospec=True):
+        with app.memcached.cache(['1.1.1.1']):
+            pass
+    resp = client.get('/metrics/memcached')
+    eq_(resp.status_code, 200, resp.data)
+    metrics = json.loads(resp.data)['result']
+    eq_(metrics["direct:['1.1.1.1']"]['checkouts'], 1)
+
+
+@test_context.specialize(perms=[p.base.metrics.view],
+                         config={'TEST_CACHE': 'mock://metrics'})
+def test_cache_metrics(app, client):
+    """The /metrics/caches API method returns counters for each cache
+    namespace"""
+    cache = memcached.Cache('test:metrics', 'TEST_CACHE')
+    with app.app_context():
+        cache.get('x')
+    resp = client.get('/metrics/caches')
+    eq_(resp.status_code, 200, resp.data)
+    metrics = json.loads(resp.data)['result']
+    eq_(metrics['test:metrics']['misses'], 1)
+
+
+@test_context.specialize(perms=[p.base.metrics.view])
+def test_aws_metrics(app, client):
+    """The /metrics/aws API method returns statistics for each pool of AWS
+    connections"""
+    with mock.patch.object(app.aws, 'connect_to_default',
+                           return_value=mock.Mock()):
+        with app.app_context():
+            app.aws.connect_to('sqs', 'us-east-1')
+    resp = client.get('/metrics/aws')
+    eq_(resp.status_code, 200, resp.data)
+    metrics = json.loads(resp.data)['result']
+    eq_(metrics['sqs/us-east-1']['checkouts'], 1)
@@ -6,7 +6,9 @@ from __future__ import absolute_import
 
 import datetime
 import os
+import threading
 
+import mock
 import pytz
 import sqlalchemy as sa
 from nose.tools import assert_not_equal
@@ -15,6 +17,7 @@ from nose.tools import eq_
 from nose.tools import ok_
 from nose.tools import with_setup
 
+from relengapi.lib import auth
 from relengapi.lib import db
 from relengapi.lib.testing.context import TestContext
 from relengapi.util import tz
@@ -64,6 +67,85 @@ def test_get_db_config_configured_not_this_db(app):
                   app.db._get_db_config('xyz'))
 
 
+@TestContext()
+def test_get_db_config_options(app):
+    app.config['SQLALCHEMY_DATABASE_URIS'] = {
+        'abc': {'uri': 'foo:///bar', 'pool_size': 3}}
+    eq_(app.db._get_db_config('abc'), 'foo:///bar')
+    eq_(app.db._get_db_options('abc'), {'uri': 'foo:///bar', 'pool_size': 3})
+
+
+def pings_for(app, ping, **options):
+    options['uri'] = 'sqlite://'
+    if ping:
+        options['ping'] = ping
+    app.config['SQLALCHEMY_DATABASE_URIS']['abc'] = options
+    engine = app.db.engine('abc')
+    for _ in range(3):
+        engine.execute('SELECT 1')
+    return app.db.pool_status()['abc']['pings']
+
+
+@TestContext()
+def test_ping_always(app):
+    eq_(pings_for(app, 'always'), 3)
+
+
+@TestContext()
+def test_ping_idle(app):
+    eq_(pings_for(app, 'idle', ping_idle=0), 3)
+
+
+@TestContext()
+def test_ping_idle_recent(app):
+    eq_(pings_for(app, 'idle', ping_idle=1000), 0)
+
+
+@TestContext()
+def test_ping_never(app):
+    # the default for SQLite
+    eq_(pings_for(app, None), 0)
+
+
+@TestContext()
+def test_ping_invalid(app):
+    assert_raises(RuntimeError, lambda: pings_for(app, 'sometimes'))
+
+
+@TestContext()
+def test_pool_options(app):
+    app.config['SQLALCHEMY_DATABASE_URIS']['abc'] = {
+        'uri': 'sqlite://', 'pool_size': 2}
+    eq_(app.db.engine('abc').pool.size, 2)
+
+
+@TestContext(databases=['test_db'])
+def test_pool_status(app):
+    app.db.engine('test_db').execute('SELECT 1')
+    status = app.db.pool_status()['test_db']
+    eq_(status['pool_class'], 'SingletonThreadPool')
+    eq_(status['connects'], 1)
+    ok_(status['checkouts'] >= 1)
+    eq_(status['pings'], 0)
+    eq_(status['size'], None)
+
+
+@TestContext()
+def test_engine_session_created_once(app):
+    app.config['SQLALCHEMY_DATABASE_URIS']['abc'] = 'sqlite://'
+    found = []
+
+    def get():
+        found.append((app.db.engine('abc'), app.db.session('abc')))
+    thds = [threading.Thread(target=get) for _ in range(10)]
+    for thd in thds:
+        thd.start()
+    for thd in thds:
+        thd.join()
+    eq_(len(set(found)), 1)
+    eq_(app.db.pool_status().keys(), ['abc'])
+
+
 @TestContext(databases=['test_db'])
 def test_ensure_empty(app):
     session = app.db.session('test_db')
@@ -278,3 +360,177 @@ def test_flush_sessions(app):
         # same id, but different Python objects
         eq_(obj2.id, obj_id)
         assert obj1 is not obj2
+
+
+@TestContext(databases=['test_db'])
+def test_flush_sessions_keeps_registries(app):
+    scoped = app.db.session('test_db')
+    other = {}
+    flushed = threading.Event()
+    done = threading.Event()
+
+    def other_thread():
+        other['before'] = scoped()
+        flushed.wait()
+        other['after'] = app.db.session('test_db')()
+        done.set()
+    thd = threading.Thread(target=other_thread)
+    thd.start()
+
+    mine = scoped()
+    app.db.flush_sessions()
+    flushed.set()
+    done.wait()
+    thd.join()
+
+    # the registry is the same, and this thread gets a new session ..
+    assert app.db.session('test_db') is scoped
+    assert scoped() is not mine
+    # .. while the other thread's session is untouched
+    assert other['after'] is other['before']
+
+
+def setup_replica(app, **options):
+    "Set up test_db with one replica, with row 1 on the primary and 2 on the replica"
+    options.update(uri='sqlite://', replicas=['sqlite://'])
+    app.config['SQLALCHEMY_DATABASE_URIS']['test_db'] = options
+    meta = app.db.metadata['test_db']
+    engines = [app.db.engine('test_db')] + app.db.replica_engines('test_db')
+    for id, engine in enumerate(engines, 1):
+        meta.create_all(bind=engine)
+        engine.execute(DevTable.__table__.insert().values(id=id))
+
+    def ids():
+        return ','.join(str(r.id) for r in DevTable.query.order_by(DevTable.id))
+
+    @app.route('/read')
+    @db.replica_reads
+    def read():
+        return ids()
+
+    @app.route('/write-then-read')
+    @db.replica_reads
+    def write_then_read():
+        session = app.db.session('test_db')
+        session.add(DevTable(id=3))
+        session.commit()
+        return ids()
+
+    @app.route('/execute-then-read')
+    @db.replica_reads
+    def execute_then_read():
+        session = app.db.session('test_db')
+        session.execute(sa.text("INSERT INTO users (id) VALUES (4)"))
+        session.commit()
+        return ids()
+
+    @app.route('/read-primary')
+    def read_primary():
+        return ids()
+
+
+@TestContext()
+def test_replica_reads(app, client):
+    setup_replica(app)
+    eq_(client.get('/read').data, '2')
+    eq_(client.get('/read-primary').data, '1')
+    # writes go to the primary, as do reads after them
+    eq_(client.get('/write-then-read').data, '1,3')
+    eq_(client.get('/read').data, '2')
+    eq_(sorted(app.db.pool_status()), ['test_db', 'test_db/replica-0'])
+
+
+@TestContext()
+def test_replica_reads_after_execute(app, client):
+    setup_replica(app)
+    # a textual statement may write, so later reads go to the primary
+    eq_(client.get('/execute-then-read').data, '1,4')
+
+
+@TestContext()
+def test_replica_reads_sticky(app, client):
+    setup_replica(app, replica_sticky=60)
+    eq_(client.get('/read').data, '2')
+    eq_(client.get('/write-then-read').data, '1,3')
+    # this user's reads stay on the primary for a while
+    eq_(client.get('/read').data, '1,3')
+
+
+@TestContext()
+def test_replica_reads_sticky_credentials(app):
+    setup_replica(app, replica_sticky=60, replica_sticky_cache='mock://db-writes')
+    # clients using tokens don't keep cookies; the tokens here are not
+    # valid, so don't try to load users from them
+    client = app.test_client(use_cookies=False)
+
+    def get(path, token):
+        return client.get(path, headers=[
+            ('Authorization', 'Bearer ' + token)]).data
+    with mock.patch.object(auth, '_request_loaders', []):
+        eq_(get('/read', 'abc'), '2')
+        eq_(get('/write-then-read', 'abc'), '1,3')
+        # reads with the same credentials stay on the primary for a while
+        eq_(get('/read', 'abc'), '1,3')
+        eq_(get('/read', 'xyz'), '2')
+        eq_(client.get('/read').data, '2')
+
+
+@TestContext()
+def test_replica_reads_outside_request(app):
+    setup_replica(app)
+    with app.app_context():
+        eq_(DevTable.query.one().id, 1)
+
+
+def test_normalize_sql():
+    eq_(db.normalize_sql("SELECT t1.a FROM t1\n WHERE t1.b IN (?, ?, ?) "
+                         "AND t1.c = 'it''s' LIMIT 10"),
+        "SELECT t1.a FROM t1 WHERE t1.b IN (?, ...) AND t1.c = ? LIMIT ?")
+    eq_(db.normalize_sql("INSERT INTO t (a) VALUES (%(a)s)"),
+        "INSERT INTO t (a) VALUES (?)")
+
+
+def add_n_plus_one(app):
+    @app.route('/n-plus-one')
+    def n_plus_one():
+        session = app.db.session('test_db')
+        for id in range(5):
+            session.query(DevTable).filter(DevTable.id == id).first()
+        return 'ok'
+
+
+@TestContext(databases=['test_db'],
+             config={'SQLALCHEMY_REPEATED_QUERY_COUNT': 3})
+def test_query_stats(app, client):
+    add_n_plus_one(app)
+    with mock.patch.object(db, 'logger') as logger:
+        client.get('/n-plus-one')
+        client.get('/n-plus-one')
+    stats = app.db.query_status()['n_plus_one']
+    eq_((stats['requests'], stats['queries'], stats['max_queries']), (2, 10, 5))
+    ok_(stats['time'] > 0)
+    [(statement, requests)] = stats['repeated'].items()
+    ok_(statement.endswith('FROM users WHERE users.id = ? LIMIT ? OFFSET ?'),
+        statement)
+    eq_(requests, 2)
+    logger.warning.assert_any_call("possible N+1 query pattern",
+                                   endpoint='n_plus_one', statement=statement,
+                                   count=5)
+
+
+@TestContext(databases=['test_db'])
+def test_query_stats_not_repeated(app, client):
+    add_n_plus_one(app)
+    with mock.patch.object(db, 'logger') as logger:
+        client.get('/n-plus-one')
+    eq_(app.db.query_status()['n_plus_one']['repeated'], {})
+    eq_(logger.warning.call_args_list, [])
+
+
+@TestContext(databases=['test_db'],
+             config={'SQLALCHEMY_SLOW_QUERY_TIME': 0})
+def test_slow_query(app):
+    with mock.patch.object(db, 'logger') as logger:
+        app.db.engine('test_db').execute('SELECT 1')
+    logger.warning.assert_called_with("slow query", database='test_db',
+                                      duration=mock.ANY, statement='SELECT ?')
@@ -3,12 +3,14 @@
 
 from __future__ import absolute_import
 
+import threading
 import time
 
 from flask import session
 from flask.ext.login import current_user
 from nose.tools import assert_raises
 from nose.tools import eq_
+from nose.tools import ok_
 from nose.tools import with_setup
 
 from relengapi.lib import auth
@@ -47,32 +49,110 @@ def test_HumanUser(app):
         eq_(u.permissions, set())
 
 
+def wait_for_refresh(app):
+    app.permissions_cache._queue.join()
+
+
+def set_loaded(app, email, loaded):
+    cache = app.permissions_cache
+    cache._entries[email] = (loaded, cache._entries[email][1])
+
+
 @test_context
-def test_HumanUser_perms_in_session(app):
-    u = auth.HumanUser("florence@nightingale.com")
+def test_HumanUser_perms_cached(app):
+    calls = []
+
+    @auth.permissions_stale.connect_via(app)
+    def set_perms(app, user, permissions):
+        calls.append(user.authenticated_email)
+        permissions.add(p.test_lib_auth.a)
     with app.test_request_context('/'):
-        session['perms'] = ['test_lib_auth.a']
-        session['perms_exp'] = time.time() + 10000
+        u = auth.HumanUser("florence@nightingale.com")
         eq_(u.permissions, set([p.test_lib_auth.a]))
-        del session['perms']
-        # .. and still cached
+        # .. and cached on the server, not in the session
+        u = auth.HumanUser("florence@nightingale.com")
         eq_(u.permissions, set([p.test_lib_auth.a]))
+        eq_(calls, ['florence@nightingale.com'])
+        assert 'perms' not in session
 
 
 @test_context
-def test_HumanUser_perms_session_expired(app):
+def test_HumanUser_perms_refreshed_in_background(app):
+    perms = [p.test_lib_auth.a]
+
     @auth.permissions_stale.connect_via(app)
     def set_perms(app, user, permissions):
+        permissions.update(perms)
+    email = "florence@nightingale.com"
+    with app.test_request_context('/'):
+        eq_(auth.HumanUser(email).permissions, set([p.test_lib_auth.a]))
+        perms.append(p.test_lib_auth.b)
+        set_loaded(app, email, time.time() - 3000)
+        # the stale permissions are used while the refresh runs
+        eq_(auth.HumanUser(email).permissions, set([p.test_lib_auth.a]))
+        wait_for_refresh(app)
+        eq_(auth.HumanUser(email).permissions,
+            set([p.test_lib_auth.a, p.test_lib_auth.b]))
+
+
+@test_context
+def test_HumanUser_perms_single_refresher(app):
+    calls = []
+
+    @auth.permissions_stale.connect_via(app)
+    def set_perms(app, user, permissions):
+        calls.append(user.authenticated_email)
+    emails = ['user%d@example.com' % i for i in range(10)]
+    with app.test_request_context('/'):
+        for email in emails:
+            auth.HumanUser(email).permissions
+            set_loaded(app, email, time.time() - 3000)
+        threads_before = threading.active_count()
+        for email in emails:
+            auth.HumanUser(email).permissions
+            auth.HumanUser(email).permissions
+        # one thread refreshes everyone, once each
+        ok_(threading.active_count() <= threads_before + 1)
+        wait_for_refresh(app)
+        eq_(sorted(calls), sorted(emails * 2))
+
+
+@test_context
+def test_HumanUser_perms_refresh_fails(app):
+    fail = []
+
+    @auth.permissions_stale.connect_via(app)
+    def set_perms(app, user, permissions):
+        if fail:
+            raise RuntimeError("oh noes")
         permissions.add(p.test_lib_auth.a)
-        permissions.add(p.test_lib_auth.b)
-    u = auth.HumanUser("florence@nightingale.com")
+    email = "florence@nightingale.com"
     with app.test_request_context('/'):
-        session['perms'] = ['test_lib_auth.a']
-        session['perms_exp'] = time.time() - 10000
-        eq_(u.permissions, set([p.test_lib_auth.a, p.test_lib_auth.b]))
-        eq_(sorted(session['perms']),
-            ['test_lib_auth.a', 'test_lib_auth.b'])
-        assert session['perms_exp'] > time.time()
+        eq_(auth.HumanUser(email).permissions, set([p.test_lib_auth.a]))
+        fail.append(True)
+        set_loaded(app, email, time.time() - 3000)
+        eq_(auth.HumanUser(email).permissions, set([p.test_lib_auth.a]))
+        wait_for_refresh(app)
+        # still using the old permissions, and retrying the refresh
+        eq_(auth.HumanUser(email).permissions, set([p.test_lib_auth.a]))
+        wait_for_refresh(app)
+        eq_(app.permissions_cache._refreshing, set())
+
+
+@test_context
+def test_HumanUser_perms_expired(app):
+    perms = [p.test_lib_auth.a]
+
+    @auth.permissions_stale.connect_via(app)
+    def set_perms(app, user, permissions):
+        permissions.update(perms)
+    email = "florence@nightingale.com"
+    with app.test_request_context('/'):
+        eq_(auth.HumanUser(email).permissions, set([p.test_lib_auth.a]))
+        perms[:] = [p.test_lib_auth.b]
+        set_loaded(app, email, time.time() - 10000)
+        # expired permissions are never used
+        eq_(auth.HumanUser(email).permissions, set([p.test_lib_auth.b]))
 
 
 @with_setup(clear_loaders, clear_loaders)
@@ -124,9 +204,35 @@ def test_clear_perms_cache(app):
     with app.test_request_context('/'):
         session['perms'] = ['test_lib_auth.a']
         session['perms_exp'] = time.time() + 10000
-        auth._clear_perms_cache()
+        u = auth.HumanUser("florence@nightingale.com")
+        eq_(u.permissions, set())
+        auth._clear_perms_cache(u)
         assert 'perms' not in session
         assert 'perms_exp' not in session
+        assert u.authenticated_email not in app.permissions_cache._entries
+
+
+@test_context.specialize(
+    config={'RELENGAPI_PERMISSIONS': {'cache': 'mock://perms'}},
+    reuse_app=False)
+def test_clear_perms_cache_shared(app):
+    perms = [p.test_lib_auth.a]
+
+    @auth.permissions_stale.connect_via(app)
+    def set_perms(app, user, permissions):
+        permissions.update(perms)
+    email = "florence@nightingale.com"
+    # another process, sharing the same memcached
+    other = auth.PermissionsCache(app, 3600, 2700, 'mock://perms')
+    with app.test_request_context('/'):
+        eq_(other.get(email), set([p.test_lib_auth.a]))
+        perms[:] = [p.test_lib_auth.b]
+        eq_(other.get(email), set([p.test_lib_auth.a]))
+        auth._clear_perms_cache(auth.HumanUser(email))
+        eq_(other.get(email), set([p.test_lib_auth.b]))
+        # and the reloaded permissions are cached again
+        perms[:] = []
+        eq_(other.get(email), set([p.test_lib_auth.b]))
 
 
 @test_context
@@ -9,6 +9,7 @@ import logging
 import logging.handlers
 import unittest
 
+import ldap
 import mockldap
 from nose.tools import assert_raises
 from nose.tools import eq_
@@ -39,6 +40,8 @@ CONFIG = {
         },
     },
 }
+CACHE_CONFIG = copy.deepcopy(CONFIG)
+CACHE_CONFIG['RELENGAPI_PERMISSIONS']['cache'] = 'mock://ldap'
 BAD_CONFIG = copy.deepcopy(CONFIG)
 BAD_CONFIG['RELENGAPI_PERMISSIONS']['login_password'] = 'invalid'
 test_context = TestContext(reuse_app=True, config=CONFIG)
@@ -133,6 +136,78 @@ class TestGetUserGroups(unittest.TestCase):
     def test_get_user_groups_posix(self):
         self.call(mail='tom@tom.com', exp_groups=['scm_level_17'])
 
+    @test_context
+    def call_batched(self, app, mails, exp_groups, batch_size=50):
+        lg = ldap_groups.LdapGroupsAuthz(app)
+        lg.batch_size = batch_size
+        groups = lg.get_users_groups(mails)
+        eq_(dict((mail, g if g is None else sorted(g))
+                 for mail, g in groups.iteritems()),
+            exp_groups)
+
+    users_groups = {
+        'jimmy@org.org': ['authors'],
+        'mary@org.org': ['authors', 'editors', 'scm_level_17'],
+        'steve@org.org': None,
+        'tom@tom.com': ['scm_level_17'],
+    }
+
+    def test_get_users_groups(self):
+        self.call_batched(mails=self.users_groups.keys(),
+                          exp_groups=self.users_groups)
+
+    def test_get_users_groups_small_batches(self):
+        self.call_batched(mails=self.users_groups.keys(),
+                          exp_groups=self.users_groups, batch_size=3)
+
+    def test_get_users_groups_duplicates(self):
+        self.call_batched(mails=['tom@tom.com', 'tom@tom.com'],
+                          exp_groups={'tom@tom.com': ['scm_level_17']})
+
+    def test_get_users_groups_one_connection(self):
+        self.call_batched(mails=self.users_groups.keys(),
+                          exp_groups=self.users_groups, batch_size=2)
+        eq_(self.ldapobj.methods_called().count('simple_bind_s'), 1)
+
+    @test_context
+    def test_connections_pooled(self, app):
+        lg = ldap_groups.LdapGroupsAuthz(app)
+        eq_(lg.get_user_groups('jimmy@org.org'), ['authors'])
+        eq_(lg.get_user_groups('tom@tom.com'), ['scm_level_17'])
+        eq_(self.ldapobj.methods_called().count('simple_bind_s'), 1)
+
+    @test_context
+    def test_server_down_retried(self, app):
+        lg = ldap_groups.LdapGroupsAuthz(app)
+        eq_(lg.get_user_groups('jimmy@org.org'), ['authors'])
+        real_search_s = self.ldapobj.search_s
+        calls = []
+
+        def search_s(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise ldap.SERVER_DOWN()
+            return real_search_s(*args, **kwargs)
+        self.ldapobj.search_s = search_s
+        eq_(lg.get_user_groups('jimmy@org.org'), ['authors'])
+        # the failed connection was closed and replaced with a new one
+        eq_(self.ldapobj.methods_called().count('unbind_s'), 1)
+        eq_(self.ldapobj.methods_called().count('simple_bind_s'), 2)
+
+    @test_context.specialize(config=CACHE_CONFIG, reuse_app=False)
+    def test_groups_cached(self, app):
+        with app.app_context():
+            lg = ldap_groups.LdapGroupsAuthz(app)
+            eq_(lg.get_user_groups('jimmy@org.org'), ['authors'])
+            eq_(lg.get_user_groups('steve@org.org'), None)
+            searches = self.ldapobj.methods_called().count('search_s')
+
+            # a new authz object (as in another process) uses the cache
+            lg = ldap_groups.LdapGroupsAuthz(app)
+            eq_(lg.get_users_groups(['jimmy@org.org', 'steve@org.org']),
+                {'jimmy@org.org': ['authors'], 'steve@org.org': None})
+            eq_(self.ldapobj.methods_called().count('search_s'), searches)
+
     @test_context.specialize(config=BAD_CONFIG)
     def test_login_fail(self, app):
         hdlr = logging.handlers.BufferingHandler(100)
@@ -140,6 +215,9 @@ class TestGetUserGroups(unittest.TestCase):
         try:
             lg = ldap_groups.LdapGroupsAuthz(app)
             eq_(lg.get_user_groups('x@y'), None)
+            # the connections that failed to bind were closed
+            eq_(self.ldapobj.methods_called().count('unbind_s'),
+                self.ldapobj.methods_called().count('simple_bind_s'))
             # make sure the error was logged
             for rec in hdlr.buffer:
                 if rec.msg.startswith('While connecting to the LDAP server'):
@@ -215,6 +293,18 @@ def test_get_user_permissions_no_groups(app):
     eq_(lg.get_user_permissions('lonely'), set([]))
 
 
+@test_context
+def test_get_users_permissions(app):
+    lg = ldap_groups.LdapGroupsAuthz(app)
+    lg.get_users_groups = lambda mails: dict(
+        (mail, fake_get_user_groups(mail)) for mail in mails)
+    eq_(lg.get_users_permissions(['foo@foo.com', 'lonely', 'bar@bar.com']), {
+        'foo@foo.com': set([p.test_lga.foo, p.test_lga.bar]),
+        'lonely': set(),
+        'bar@bar.com': None,
+    })
+
+
 @test_context
 def test_get_user_permissions_with_groups(app):
     lg = ldap_groups.LdapGroupsAuthz(app)
@@ -7,14 +7,20 @@ from __future__ import absolute_import
 import json
 import logging
 import Queue
+import socket
+import threading
 from logging import handlers
 
+import boto.s3.connection
 import mock
 import moto
 from moto import mock_sqs
+from moto.server import create_backend_app
 from nose.plugins.skip import SkipTest
 from nose.tools import assert_raises
 from nose.tools import eq_
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.serving import make_server
 
 from relengapi.lib import aws
 from relengapi.lib.testing.context import TestContext
@@ -89,8 +95,13 @@ def test_get_sqs_queue(app):
     queue = app.aws.get_sqs_queue('us-east-1', 'my-sqs-queue')
     # check it's a queue
     assert hasattr(queue, 'get_messages')
-    # check caching
-    assert app.aws.get_sqs_queue('us-east-1', 'my-sqs-queue') is queue
+    # check the URL is cached, and the queue uses the context's connection
+    with mock.patch('boto.sqs.connection.SQSConnection.get_queue') as get_queue:
+        with app.app_context():
+            cached = app.aws.get_sqs_queue('us-east-1', 'my-sqs-queue')
+            assert cached.connection is app.aws.connect_to('sqs', 'us-east-1')
+    eq_(cached.url, queue.url)
+    eq_(get_queue.call_count, 0)
 
 
 @mock_sqs
@@ -163,3 +174,141 @@ def test_sqs_listen(app):
         # good way to programmatically verify that messages are being deleted
     finally:
         logging.getLogger().removeHandler(log_buffer)
+
+
+class Conn(object):
+
+    "A stand-in for a boto connection"
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@test_context.specialize(config=aws_cfg)
+def test_connect_to_app_context(app):
+    """Within an app context, connect_to returns the same connection each
+    time, and returns it to the pool when the context is torn down"""
+    with mock.patch.object(app.aws, 'connect_to_default',
+                           side_effect=lambda *args: Conn()):
+        with app.app_context():
+            conn = app.aws.connect_to('sqs', 'us-east-1')
+            assert app.aws.connect_to('sqs', 'us-east-1') is conn
+            eq_(app.aws.pool_status()['sqs/us-east-1']['in_use'], 1)
+            # a nested context shares the outer context's connection
+            with app.app_context():
+                assert app.aws.connect_to('sqs', 'us-east-1') is conn
+            eq_(app.aws.pool_status()['sqs/us-east-1']['in_use'], 1)
+        eq_(app.aws.pool_status()['sqs/us-east-1']['idle'], 1)
+        with app.app_context():
+            assert app.aws.connect_to('sqs', 'us-east-1') is conn
+
+
+@test_context.specialize(config={'AWS': {'access_key_id': 'aa',
+                                         'secret_access_key': 'ss',
+                                         'pool_size': 1,
+                                         'pool_timeout': 0.01}})
+def test_connect_to_nested_app_context(app):
+    """A connection first used in a nested context is returned when that
+    context is torn down, and nested contexts never wait on the pool for
+    their own thread's connection"""
+    with mock.patch.object(app.aws, 'connect_to_default',
+                           side_effect=lambda *args: Conn()):
+        with app.app_context():
+            with app.app_context():
+                conn = app.aws.connect_to('sqs', 'us-east-1')
+            eq_(app.aws.pool_status()['sqs/us-east-1']['idle'], 1)
+            assert app.aws.connect_to('sqs', 'us-east-1') is conn
+            with app.app_context():
+                with app.app_context():
+                    assert app.aws.connect_to('sqs', 'us-east-1') is conn
+        eq_(app.aws.pool_status()['sqs/us-east-1']['timeouts'], 0)
+
+
+@test_context.specialize(config=aws_cfg)
+def test_connect_to_network_error(app):
+    """An app context torn down by a network error discards its
+    connections"""
+    with mock.patch.object(app.aws, 'connect_to_default',
+                           side_effect=lambda *args: Conn()):
+        ctx = app.app_context()
+        ctx.push()
+        conn = app.aws.connect_to('sqs', 'us-east-1')
+        ctx.pop(socket.error())
+    assert conn.closed
+    eq_(app.aws.pool_status()['sqs/us-east-1']['open'], 0)
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+@test_context.specialize(config={'AWS': {'access_key_id': 'aa',
+                                         'secret_access_key': 'ss',
+                                         'pool_size': 4}})
+def test_concurrent_s3(app):
+    """Many threads using S3 at once, against moto's S3 server, share a
+    small pool of connections which keep their HTTP connections alive"""
+    server = make_server('127.0.0.1', 0, create_backend_app('s3'),
+                         threaded=True,
+                         request_handler=KeepAliveRequestHandler)
+    # kept-alive connections leave handler threads blocked on reads
+    server.daemon_threads = True
+    accepted = []
+    get_request = server.get_request
+
+    def counting_get_request():
+        accepted.append(None)
+        return get_request()
+    server.get_request = counting_get_request
+    server_thd = threading.Thread(target=server.serve_forever)
+    server_thd.daemon = True
+    server_thd.start()
+
+    def connect_to_s3(service_name, region_name):
+        return boto.s3.connection.S3Connection(
+            'aa', 'ss', host='127.0.0.1', port=server.server_port,
+            is_secure=False,
+            calling_format=boto.s3.connection.OrdinaryCallingFormat())
+
+    errors = []
+
+    def use_s3(n):
+        try:
+            for i in xrange(10):
+                with app.app_context():
+                    s3 = app.aws.connect_to('s3', 'us-east-1')
+                    bucket = s3.get_bucket('bucket', validate=False)
+                    name = 'key-%d-%d' % (n, i)
+                    bucket.new_key(name).set_contents_from_string(name)
+                    eq_(bucket.get_key(name).get_contents_as_string(), name)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        with mock.patch.object(app.aws, 'connect_to_s3',
+                               side_effect=connect_to_s3):
+            with app.app_context():
+                app.aws.connect_to('s3', 'us-east-1').create_bucket('bucket')
+            threads = [threading.Thread(target=use_s3, args=(n,))
+                       for n in xrange(16)]
+            for thd in threads:
+                thd.start()
+            for thd in threads:
+                thd.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    eq_(errors, [])
+    status = app.aws.pool_status()['s3/us-east-1']
+    eq_(status['checkouts'], 161)
+    assert status['created'] <= 4, status
+    # each connection opened only a few HTTP connections for its 321 requests
+    assert len(accepted) <= 3 * status['created'], (len(accepted), status)
@@ -7,10 +7,13 @@ from __future__ import absolute_import
 import contextlib
 import itertools
 import socket
+import time
 
 import mock
+import wsme.types
 from nose.tools import eq_
 
+from relengapi.lib import memcached
 from relengapi.lib.testing.context import TestContext
 
 test_context = TestContext(reuse_app=False)
@@ -85,59 +88,244 @@ def test_direct(app):
 @test_context
 def test_elasticache(app):
     response = [['host1', '1.1.1.1', '11211'], ['host2', '2.2.2.2', '11211']]
+    finder = app.memcached._finders['elasticache']
     with mock.patch('memcache.Client', autospec=True) as Client, \
-            mock_auto_discovery([response]), \
-            app.memcached.cache('elasticache://9.9.9.9:9'):
-        pass
+            mock_auto_discovery([response]):
+        # create the pool, and wait for the first discovery round
+        finder._get('9.9.9.9:9', '9.9.9.9:9')
+        assert finder.discoveries['9.9.9.9:9'].ready.wait(5)
+        with app.memcached.cache('elasticache://9.9.9.9:9'):
+            pass
+    finder.discoveries['9.9.9.9:9'].stop()
 
     Client.assert_called_with(['1.1.1.1:11211', '2.2.2.2:11211'])
 
 
-@test_context
-def test_elasticache_polling(app):
+def test_elasticache_before_discovery():
+    """Until the first discovery round completes, clients have no servers"""
+    discovery = memcached.ElastiCacheDiscovery('9.9.9.9')
+    with mock.patch('memcache.Client', autospec=True) as Client:
+        wrapper = memcached.ElastiCacheClientWrapper(discovery)
+        wrapper.checkout()
+    eq_(Client.mock_calls, [mock.call([])])
+
+
+def test_elasticache_polling():
     response1 = [['host1', '1.1.1.1', '11211'], ['host2', '2.2.2.2', '11211']]
     response2 = [['host3', '3.3.3.3', '11211'], ['host2', '2.2.2.2', '11211']]
-    with mock.patch('time.time', autospec=True) as time, \
-            mock.patch('memcache.Client', autospec=True) as Client, \
+    discovery = memcached.ElastiCacheDiscovery('9.9.9.9')
+    with mock.patch('memcache.Client', autospec=True) as Client, \
             mock_auto_discovery([response1, response2]):
-        time.return_value = 1000
-        with app.memcached.cache('elasticache://9.9.9.9') as mc1:
-            eq_(Client.mock_calls, [
-                mock.call(['1.1.1.1:11211', '2.2.2.2:11211'])])
-            Client.reset_mock()
-        time.return_value = 2000
-        with app.memcached.cache('elasticache://9.9.9.9') as mc2:
-            # no new client
-            assert mc1 is mc2
-            # but reconfigured
-            eq_(Client.mock_calls, [
-                mock.call().set_servers(['3.3.3.3:11211', '2.2.2.2:11211'])])
+        discovery.refresh()
+        wrapper = memcached.ElastiCacheClientWrapper(discovery)
+        mc1 = wrapper.checkout()
+        eq_(Client.mock_calls, [
+            mock.call(['1.1.1.1:11211', '2.2.2.2:11211'])])
+        Client.reset_mock()
+        discovery.refresh()
+        mc2 = wrapper.checkout()
+        # no new client
+        assert mc1 is mc2
+        # but reconfigured, only once
+        wrapper.checkout()
+        eq_(Client.mock_calls, [
+            mock.call().set_servers(['3.3.3.3:11211', '2.2.2.2:11211'])])
 
 
-@test_context
-def test_elasticache_socket_error_keep(app):
+def test_elasticache_socket_error_keep():
     response = [['host1', '1.1.1.1', '11211'], ['host2', '2.2.2.2', '11211']]
-    with mock.patch('time.time', autospec=True) as time, \
-            mock.patch('memcache.Client', autospec=True) as Client, \
+    discovery = memcached.ElastiCacheDiscovery('9.9.9.9')
+    with mock.patch('memcache.Client', autospec=True) as Client, \
             mock_auto_discovery([response, socket.error(1234)]):
-        time.return_value = 1000
-        with app.memcached.cache('elasticache://9.9.9.9') as mc1:
-            eq_(Client.mock_calls, [
-                mock.call(['1.1.1.1:11211', '2.2.2.2:11211'])])
-            Client.reset_mock()
-        time.return_value = 2000
-        with app.memcached.cache('elasticache://9.9.9.9') as mc2:
-            # no new client
-            assert mc1 is mc2
-            # reconfigured, but with the old config
-            eq_(Client.mock_calls, [
-                mock.call().set_servers(['1.1.1.1:11211', '2.2.2.2:11211'])])
+        discovery.refresh()
+        wrapper = memcached.ElastiCacheClientWrapper(discovery)
+        Client.reset_mock()
+        discovery.refresh()
+        wrapper.checkout()
+        # reconfigured, but with the old config
+        eq_(Client.mock_calls, [
+            mock.call().set_servers(['1.1.1.1:11211', '2.2.2.2:11211'])])
+
+
+def test_elasticache_socket_error_fallback():
+    discovery = memcached.ElastiCacheDiscovery('9.9.9.9')
+    with mock_auto_discovery([socket.error(1234)]):
+        discovery.refresh()
+    # the fallback server
+    eq_(discovery.servers, ['127.0.0.1:11211'])
+
+
+def test_elasticache_discovery_thread():
+    """The discovery thread retries quickly until discovery succeeds, then
+    polls at the usual interval"""
+    response = [['host1', '1.1.1.1', '11211']]
+    discovery = memcached.ElastiCacheDiscovery('9.9.9.9')
+    discovery.RETRY_INTERVAL = 0.01
+    with mock_auto_discovery([socket.error(1234), response]):
+        discovery.start()
+        for _ in xrange(500):
+            if discovery.servers == ['1.1.1.1:11211']:
+                break
+            time.sleep(0.01)
+        discovery.stop()
+    eq_(discovery.servers, ['1.1.1.1:11211'])
+
+
+@test_context.specialize(config={'MEMCACHED_POOL_SIZE': 1,
+                                 'MEMCACHED_POOL_TIMEOUT': 0.01})
+def test_direct_pool_config(app):
+    """The pool bounds are read from the app config, and each pool's
+    status is available.  When the pool is exhausted, the caller gets a
+    client which misses, rather than an error."""
+    with mock.patch('memcache.Client', autospec=True):
+        with app.memcached.cache(['1.1.1.1']):
+            with app.memcached.cache(['1.1.1.1']) as mc:
+                eq_(mc.get('foo'), None)
+                eq_(mc.set('foo', 'bar'), 0)
+    status = app.memcached.pool_status()["direct:['1.1.1.1']"]
+    eq_((status['size'], status['checkouts'], status['timeouts']), (1, 1, 1))
+
+
+class Thing(wsme.types.Base):
+    name = unicode
+    count = int
+
+
+cache_test_context = TestContext(config={'TEST_CACHE': 'mock://cache'})
+
+
+def counts(namespace):
+    return memcached.cache_status().get(namespace, {})
 
 
 @test_context
-def test_elasticache_socket_error_fallback(app):
-    with mock.patch('memcache.Client', autospec=True) as Client:
-        with app.memcached.cache('elasticache://127.0.0.1:0'):
-            eq_(Client.mock_calls, [
-                # the fallback server
-                mock.call(['127.0.0.1:11211'])])
+def test_cache_no_config(app):
+    """With no cache configured, a Cache always misses"""
+    cache = memcached.Cache('test:noconfig', 'TEST_CACHE')
+    fn = mock.Mock(return_value='v')
+    with app.app_context():
+        cache.set('k', 'v')
+        eq_(cache.get('k'), None)
+        eq_(cache.get_multi(['k']), {})
+        cache.delete_multi(['k'])
+        eq_(cache.get_or_set('k', fn), 'v')
+        eq_(cache.get_or_set('k', fn), 'v')
+    eq_(fn.call_count, 2)
+
+
+@cache_test_context
+def test_cache_multi(app):
+    """A Cache gets, sets and deletes multiple keys at once, with keys of
+    any JSON type"""
+    cache = memcached.Cache('test:multi', 'TEST_CACHE')
+    with app.app_context():
+        cache.set_multi({'a': 1, ('b', 2): [2, 'two'], u'\u2603': None})
+        eq_(cache.get_multi(['a', ('b', 2), 'c', u'\u2603']),
+            {'a': 1, ('b', 2): [2, 'two'], u'\u2603': None})
+        cache.delete_multi(['a', 'c'])
+        eq_(cache.get_multi(['a', ('b', 2)]), {('b', 2): [2, 'two']})
+        cache.delete(('b', 2))
+        eq_(cache.get(('b', 2)), None)
+    eq_(counts('test:multi')['hits'], 4)
+    eq_(counts('test:multi')['misses'], 3)
+
+
+@cache_test_context
+def test_cache_datatype(app):
+    """A Cache with a datatype serializes values with WSME"""
+    cache = memcached.Cache('test:datatype', 'TEST_CACHE', datatype=Thing)
+    with app.app_context():
+        cache.set('x', Thing(name=u'x', count=3))
+        thing = cache.get('x')
+    assert isinstance(thing, Thing)
+    eq_((thing.name, thing.count), (u'x', 3))
+
+
+@cache_test_context
+def test_cache_namespace_version(app):
+    """Caches with different namespaces or versions do not share keys"""
+    v1 = memcached.Cache('test:version', 'TEST_CACHE')
+    v2 = memcached.Cache('test:version', 'TEST_CACHE', version=2)
+    other = memcached.Cache('test:other', 'TEST_CACHE')
+    with app.app_context():
+        v1.set('k', 'v1')
+        eq_(v2.get('k'), None)
+        eq_(other.get('k'), None)
+        eq_(v1.get('k'), 'v1')
+
+
+@cache_test_context
+def test_cache_get_or_set(app):
+    """get_or_set computes a missing value once, then serves it from the
+    cache"""
+    cache = memcached.Cache('test:get_or_set', 'TEST_CACHE')
+    fn = mock.Mock(return_value=['v'])
+    with app.app_context():
+        eq_(cache.get_or_set('k', fn), ['v'])
+        eq_(cache.get_or_set('k', fn), ['v'])
+        # the lock is released
+        with app.memcached.cache('mock://cache') as mc:
+            eq_(mc.get(cache._key('k') + ':lock'), None)
+    eq_(fn.call_count, 1)
+
+
+@cache_test_context
+def test_cache_early_refresh(app):
+    """get_or_set recomputes a value early as its expiration approaches,
+    depending on how long it took to compute"""
+    cache = memcached.Cache('test:early', 'TEST_CACHE', timeout=100)
+    fn = mock.Mock(return_value='v')
+    with app.app_context(), \
+            mock.patch('time.time') as time_, \
+            mock.patch('random.random') as random:
+        time_.return_value = 1000
+        cache.set_multi({'k': 'old'}, _delta=5)
+        # -log(1 - 0.5) * 5 is about 3.5 seconds early
+        random.return_value = 0.5
+        time_.return_value = 1095
+        eq_(cache.get_or_set('k', fn), 'old')
+        time_.return_value = 1097
+        eq_(cache.get_or_set('k', fn), 'v')
+    eq_(counts('test:early')['refreshes'], 1)
+
+
+@cache_test_context
+def test_cache_get_or_set_locked(app):
+    """While another caller is computing a missing value, get_or_set waits
+    for it to appear, and computes it anyway if it does not"""
+    cache = memcached.Cache('test:locked', 'TEST_CACHE')
+    fn = mock.Mock(return_value='mine')
+    with app.app_context():
+        with app.memcached.cache('mock://cache') as mc:
+            mc.set(cache._key('k') + ':lock', '1')
+
+        def other_caller_finishes(seconds):
+            cache.set('k', 'theirs')
+        with mock.patch('time.sleep', side_effect=other_caller_finishes):
+            eq_(cache.get_or_set('k', fn), 'theirs')
+
+        cache.delete('k')
+        with mock.patch('time.sleep'), \
+                mock.patch.object(cache, 'LOCK_WAIT', 0):
+            eq_(cache.get_or_set('k', fn), 'mine')
+    eq_(fn.call_count, 1)
+    eq_(counts('test:locked')['waits'], 2)
+
+
+@cache_test_context
+def test_cache_get_or_set_no_server(app):
+    """When memcached is unreachable, so the lock cannot be taken, get_or_set
+    computes the value at once rather than waiting"""
+    cache = memcached.Cache('test:noserver', 'TEST_CACHE')
+    fn = mock.Mock(return_value='v')
+    with app.app_context():
+        with app.memcached.cache('mock://cache') as mc:
+            # python-memcached returns 0 from add and None from get with
+            # no live servers
+            add = mock.patch.object(type(mc), 'add', return_value=0)
+            get = mock.patch.object(type(mc), 'get', return_value=None)
+        with add, get, mock.patch('time.sleep') as sleep:
+            eq_(cache.get_or_set('k', fn), 'v')
+        eq_(sleep.call_count, 0)
+    eq_(fn.call_count, 1)
+    eq_(counts('test:noserver').get('waits', 0), 0)
@@ -4,6 +4,8 @@
 
 from __future__ import absolute_import
 
+import warnings
+
 import mock
 import werkzeug.exceptions
 from flask.ext.login import current_user
@@ -54,6 +56,44 @@ def test_Permission_iter():
     assert (('x', 'y'), 'XY') in list(permissions.p)
 
 
+def test_PermissionSet_mask():
+    "A PermissionSet's mask has a distinct bit for each documented permission"
+    perms = permissions.Permissions()
+    perms.mask.a.doc("A")
+    perms.mask.b.doc("B")
+    ps = permissions.PermissionSet([perms.mask.a, perms.mask.b])
+    eq_(ps, set([perms.mask.a, perms.mask.b]))
+    ok_(perms.mask.a._mask != perms.mask.b._mask)
+    eq_(ps.mask, perms.mask.a._mask | perms.mask.b._mask)
+    eq_(permissions.PermissionSet().mask, 0)
+
+
+def test_PermissionSet_mask_undocumented():
+    "A PermissionSet containing an undocumented permission has no mask"
+    perms = permissions.Permissions()
+    perms.undoc.a.doc("A")
+    ps = permissions.PermissionSet([perms.undoc.a, perms.undoc.b])
+    eq_(ps.mask, None)
+
+
+def test_PermissionSet_mask_shared():
+    "Equal permissions from different registries share a bit"
+    perms = permissions.Permissions()
+    perms.shared.a.doc("A")
+    other = permissions.Permissions()
+    other.shared.a.doc("other A")
+    eq_(perms.shared.a._mask, other.shared.a._mask)
+    eq_(permissions.PermissionSet([perms.shared.a]).mask,
+        permissions.PermissionSet([other.shared.a]).mask)
+
+
+def test_PermissionSet_no_warnings():
+    "Creating a PermissionSet does not warn"
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        eq_(permissions.PermissionSet([('a', 'b')]), set([('a', 'b')]))
+
+
 class TestUser(auth.BaseUser):
 
     anonymous = False
@@ -132,3 +172,41 @@ def test_require_can(app):
         # empty are invalid
         assert_raises(AssertionError, permissions.require)
         assert_raises(AssertionError, permissions.can)
+
+
+@TestContext()
+def test_can_PermissionSet(app):
+    "`can` and `require` work with the masks of PermissionSets"
+    perms = permissions.Permissions()
+    perms.test.writer.doc("Test writer")
+    perms.test.reader.doc("Test reader")
+    perms.test.deleter.doc("Test deleter")
+
+    with app.test_request_context():
+        login_user(TestUser())
+        current_user.permissions = permissions.PermissionSet(
+            [perms.test.writer, perms.test.reader, perms.test.undocumented])
+        ok_(permissions.can(perms.test.writer, perms.test.reader))
+        ok_(not permissions.can(perms.test.writer, perms.test.deleter))
+        # undocumented permissions are checked by membership
+        ok_(permissions.can(perms.test.undocumented))
+        ok_(not permissions.can(perms.test.other))
+
+        @perms.test.reader.require()
+        def func():
+            return "ok"
+        eq_(func(), "ok")
+
+        @perms.test.deleter.require()
+        def bad_func():
+            return "ok"
+        with mock.patch('relengapi.util.is_browser') as is_browser:
+            is_browser.return_value = False
+            assert_raises(werkzeug.exceptions.Forbidden, bad_func)
+
+        # permissions from another registry with the same names are equal
+        other = permissions.Permissions()
+        other.test.writer.doc("Other writer")
+        current_user.permissions = permissions.PermissionSet([other.test.writer])
+        ok_(permissions.can(perms.test.writer))
+        ok_(not permissions.can(perms.test.reader))
@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import itertools
+import socket
+import threading
+
+import mock
+from nose.tools import assert_raises
+from nose.tools import eq_
+
+from relengapi.lib import pool as pool_mod
+
+
+def never(created, checked_in):
+    return False
+
+
+def make_pool(size=2, timeout=0.01, expired=never):
+    resources = itertools.count(1)
+    return pool_mod.Pool(lambda: mock.Mock(name=str(resources.next())),
+                         size, timeout, expired)
+
+
+def test_reuses_most_recent():
+    """The pool hands out the most recently checked-in resource, creating
+    resources only when none are free"""
+    pool = make_pool()
+    r1 = pool.checkout()
+    r2 = pool.checkout()
+    pool.checkin(r1)
+    pool.checkin(r2)
+    assert pool.checkout() is r2
+    eq_(pool.status()['created'], 2)
+
+
+def test_bounded():
+    """When all resources are in use, checkout times out"""
+    pool = make_pool()
+    pool.checkout()
+    pool.checkout()
+    assert_raises(pool_mod.PoolTimeout, pool.checkout)
+    status = pool.status()
+    eq_((status['open'], status['in_use'], status['waits'], status['timeouts']),
+        (2, 2, 1, 1))
+
+
+def test_waits_for_checkin():
+    """A checkout waits for a resource to be checked in"""
+    pool = make_pool(size=1, timeout=10)
+    r1 = pool.checkout()
+    timer = threading.Timer(0.05, pool.checkin, [r1])
+    timer.start()
+    assert pool.checkout() is r1
+    timer.join()
+    eq_(pool.status()['waits'], 1)
+
+
+def test_create_failure():
+    """If creating a resource fails, its slot in the pool is freed"""
+    pool = pool_mod.Pool(mock.Mock(side_effect=socket.error), 1, 0.01, never)
+    assert_raises(socket.error, pool.checkout)
+    eq_(pool.status()['open'], 0)
+
+
+def test_expired_at_checkout():
+    """Idle resources for which the predicate is true are closed, not
+    reused, and the predicate sees their creation and checkin times"""
+    with mock.patch('time.time', autospec=True) as time:
+        time.return_value = 1000
+        pool = make_pool(expired=lambda created, checked_in: checked_in < 1030)
+        r1 = pool.checkout()
+        r2 = pool.checkout()
+        pool.checkin(r1)
+        time.return_value = 1030
+        pool.checkin(r2)
+        # r1 is discarded, and r2 is reused
+        assert pool.checkout() is r2
+    r1.close.assert_called_with()
+    eq_(pool.status()['discarded'], 1)
+    eq_(pool.status()['open'], 1)
+
+
+def test_expired_at_checkin():
+    """A resource for which the predicate is true when it is checked in is
+    closed"""
+    with mock.patch('time.time', autospec=True) as time:
+        time.return_value = 1000
+        pool = make_pool(expired=lambda created, checked_in: checked_in > created + 60)
+        r1 = pool.checkout()
+        time.return_value = 1061
+        pool.checkin(r1)
+    r1.close.assert_called_with()
+    eq_((pool.status()['open'], pool.status()['idle']), (0, 0))
+
+
+def test_unhealthy():
+    """Resources checked in as unhealthy are closed, and errors closing
+    them are logged"""
+    pool = make_pool()
+    r1 = pool.checkout()
+    r1.close.side_effect = socket.error
+    with mock.patch.object(pool_mod, 'logger') as logger:
+        pool.checkin(r1, healthy=False)
+    r1.close.assert_called_with()
+    eq_(logger.warning.call_count, 1)
+    eq_((pool.status()['open'], pool.status()['discarded']), (0, 1))
+
+
+def test_concurrent():
+    """Many threads sharing a small pool never use more resources than its
+    size, and never share a resource"""
+    pool = make_pool(size=4, timeout=10)
+    in_use = set()
+    lock = threading.Lock()
+    errors = []
+
+    def use():
+        for _ in xrange(50):
+            resource = pool.checkout()
+            with lock:
+                if resource in in_use or len(in_use) >= 4:
+                    errors.append(resource)
+                in_use.add(resource)
+            with lock:
+                in_use.remove(resource)
+            pool.checkin(resource)
+    threads = [threading.Thread(target=use) for _ in xrange(16)]
+    for thd in threads:
+        thd.start()
+    for thd in threads:
+        thd.join()
+    eq_(errors, [])
+    status = pool.status()
+    eq_(status['checkouts'], 800)
+    assert status['created'] <= 4, status
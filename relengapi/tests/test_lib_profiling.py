@@ -0,0 +1,137 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import json
+
+import mock
+from flask import request
+from nose.tools import eq_
+
+from relengapi.lib import auth
+from relengapi.lib import profiling
+from relengapi.lib.permissions import p
+from relengapi.lib.testing.context import TestContext
+
+
+def with_permissions(permissions):
+    def app_setup(app):
+        # the profiling hook checks permissions, so the user must be set up
+        # before it runs; TestContext's `perms` option sets it up later
+        def set_user():
+            user = auth.HumanUser('test@test.test')
+            user._permissions = permissions
+            auth.login_manager.reload_user(user)
+        app.before_request_funcs.setdefault(None, []).insert(0, set_user)
+        add_work_view(app)
+    return app_setup
+
+
+def add_work_view(app):
+    @app.route('/work')
+    def work():
+        app.db.session('relengapi').execute('SELECT 1')
+        with app.memcached.cache('mock://prof') as mc:
+            mc.set('x', 'y')
+        return ','.join(sorted(request.args))
+
+test_context = TestContext(databases=['relengapi'],
+                           app_setup=with_permissions([p.base.profile]),
+                           reuse_app=False)
+
+
+def get_profile(client, resp):
+    request_id = resp.headers[profiling.PROFILE_ID_HEADER]
+    resp = client.get('/profiles/' + request_id)
+    eq_(resp.status_code, 200, resp.data)
+    return json.loads(resp.data)['result']
+
+
+@test_context
+def test_not_profiled(client):
+    """Requests are not profiled by default"""
+    resp = client.get('/work')
+    eq_(resp.status_code, 200)
+    assert profiling.PROFILE_ID_HEADER not in resp.headers
+
+
+@test_context
+def test_profile_header(client):
+    """A request with the profile header is profiled, and its profile
+    includes database and cache usage"""
+    resp = client.get('/work', headers={profiling.PROFILE_HEADER: '1'})
+    eq_(resp.status_code, 200)
+    profile = get_profile(client, resp)
+    eq_(profile['endpoint'], 'work')
+    eq_(profile['path'], '/work')
+    eq_(profile['db_queries'], 1)
+    eq_(profile['cache_uses'], 1)
+    assert 'cumulative' in profile['profile'], profile['profile']
+
+
+@test_context
+def test_profile_arg(client):
+    """A request with the profile query argument is profiled, and the
+    argument is hidden from the view"""
+    resp = client.get('/work?_profile=1&other=2')
+    eq_(resp.status_code, 200)
+    eq_(resp.data, 'other')
+    eq_(get_profile(client, resp)['method'], 'GET')
+
+
+@test_context.specialize(app_setup=with_permissions([]))
+def test_profile_forbidden(client):
+    """Profiling a request requires permission"""
+    resp = client.get('/work', headers={profiling.PROFILE_HEADER: '1'})
+    eq_(resp.status_code, 403)
+
+
+@test_context
+def test_get_profile_missing(client):
+    """Getting a profile that does not exist is a 404"""
+    eq_(client.get('/profiles/nosuch').status_code, 404)
+
+
+@test_context.specialize(config={'RELENGAPI_PROFILE_CACHE': 'mock://profiles'})
+def test_profile_memcached(app, client):
+    """With RELENGAPI_PROFILE_CACHE set, profiles are stored in memcached"""
+    resp = client.get('/work', headers={profiling.PROFILE_HEADER: '1'})
+    request_id = resp.headers[profiling.PROFILE_ID_HEADER]
+    with app.memcached.cache('mock://profiles') as mc:
+        assert mc.get(app.profile_store._key(request_id))
+    eq_(get_profile(client, resp)['request_id'], request_id)
+
+
+@test_context.specialize(config={'RELENGAPI_PROFILE_CACHE': 'mock://profiles',
+                                 'REQUEST_ID_HEADER': 'X-Request-Id'})
+def test_profile_memcached_client_request_id(app, client):
+    """Client-supplied request IDs which are not valid memcached keys are
+    hashed to make the key"""
+    request_id = 'has spaces ' + 'x' * 300
+    resp = client.get('/work', headers={profiling.PROFILE_HEADER: '1',
+                                        'X-Request-Id': request_id})
+    eq_(resp.status_code, 200)
+    key = app.profile_store._key(request_id)
+    assert ' ' not in key and len(key) < 250, key
+    with app.memcached.cache('mock://profiles') as mc:
+        assert mc.get(key)
+
+
+@test_context
+def test_profile_store_fails(app, client):
+    """A failure to store the profile does not fail the request"""
+    with mock.patch.object(app.profile_store, 'put',
+                           side_effect=RuntimeError('oh noes')):
+        resp = client.get('/work', headers={profiling.PROFILE_HEADER: '1'})
+    eq_(resp.status_code, 200)
+    assert profiling.PROFILE_ID_HEADER not in resp.headers
+
+
+@test_context
+def test_local_profiles_bounded(app, client):
+    """Only the most recent profiles are kept in the process"""
+    for _ in range(profiling.LOCAL_PROFILES + 5):
+        client.get('/work', headers={profiling.PROFILE_HEADER: '1'})
+    eq_(len(app.profile_store._profiles), profiling.LOCAL_PROFILES)
@@ -0,0 +1,25 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import absolute_import
+
+import threading
+
+from nose.tools import eq_
+from nose.tools import ok_
+
+from relengapi.lib.testing.benchmark import in_threads
+
+
+def test_in_threads():
+    "in_threads runs the function once in each thread, and times them"
+    lock = threading.Lock()
+    idents = []
+
+    def fn():
+        with lock:
+            idents.append(threading.current_thread().ident)
+    elapsed = in_threads(4, fn)
+    eq_(len(set(idents)), 4)
+    ok_(elapsed >= 0)
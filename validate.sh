@@ -222,6 +222,9 @@ git_only='
     src
     settings_example.py
     misc/release.sh
+    misc/clobberer_benchmark.py
+    misc/db_benchmark.py
+    misc/memcached_benchmark.py
     requirements.txt
 '
 git ls-files . | while read f; do